@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""Benchmark of the stages of calculate_snow_coverage_numpy.py
+
+Runs the stages of the snow coverage pipeline against a local fake
+ImageServer (see fake_image_server.py) for several sizes of the Area of
+Interest and numbers of days and times every stage separately:
+
+- metadata: service description of the snow service
+- id_query: IDs of the images in the time period
+- link_resolution: export of the images of the AOI (links to the images)
+- download: download and decoding of the images
+- accumulation: per-pixel mean snow cover over the images
+- dtm_warp: DTM of the AOI aggregated to the snow grid
+- band_statistics: snow statistics per elevation band
+
+Every run also checks that statistics merged over tiles are identical to
+statistics of the whole AOI ("tiled_equals_untiled").
+
+Startup of the script is measured in fresh interpreters (not against the
+server) and compared to a budget:
+
+- startup_process: start of the interpreter and import of the script
+- startup_import: import of the script (GDAL and NumPy are deferred)
+- startup_first_use: import of GDAL and NumPy on first use
+
+Results are written as JSON (one record per stage, AOI size and number of
+days with median and minimum time over the repeats), so runs can be
+compared to spot regressions.
+
+Usage:
+    python benchmark_snow_coverage.py --sizes 64 256 1024 --days 1 7 30 \
+        --output benchmark.json
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import platform
+from pathlib import Path
+from statistics import median
+import subprocess
+import sys
+import time
+
+from osgeo import gdal, osr
+import numpy as np
+
+import calculate_snow_coverage_numpy as snow
+from fake_image_server import DTM_SERVICE, SNOW_SERVICE, start_fake_image_server
+
+
+def create_window(service_description, size):
+    """Create an aligned window of size x size pixels in the center of the service"""
+    extent = service_description["fullExtent"]
+    pixel_size_x = service_description["pixelSizeX"]
+    pixel_size_y = service_description["pixelSizeY"]
+    cols = round((extent["xmax"] - extent["xmin"]) / pixel_size_x)
+    rows = round((extent["ymax"] - extent["ymin"]) / pixel_size_y)
+    size = min(size, cols, rows)
+    window = {
+        "xmin": extent["xmin"] + (cols - size) // 2 * pixel_size_x,
+        "ymax": extent["ymax"] - (rows - size) // 2 * pixel_size_y,
+        "pixelSizeX": pixel_size_x,
+        "pixelSizeY": pixel_size_y,
+        "width": size,
+        "height": size,
+        "is_latlong": False,
+    }
+    window["xmax"] = window["xmin"] + size * pixel_size_x
+    window["ymin"] = window["ymax"] - size * pixel_size_y
+    window["bbox"] = (
+        f"{window['xmin']}, {window['ymin']}, {window['xmax']}, {window['ymax']}"
+    )
+    return window
+
+
+STARTUP_CODE = """
+import json, time
+start = time.perf_counter()
+import calculate_snow_coverage_numpy as snow
+imported = time.perf_counter()
+snow.np.zeros(1)
+snow.gdal.VersionInfo()
+print(json.dumps([imported - start, time.perf_counter() - imported]))
+"""
+
+
+def measure_startup(repeats):
+    """Measure startup of the script in fresh interpreters
+    :return: dict with list of times in seconds per startup stage
+    :rtype: dict
+    """
+    startup_times = {
+        "startup_process": [],
+        "startup_import": [],
+        "startup_first_use": [],
+    }
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_CODE],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        import_time, first_use_time = json.loads(output)
+        startup_times["startup_process"].append(
+            time.perf_counter() - start - first_use_time
+        )
+        startup_times["startup_import"].append(import_time)
+        startup_times["startup_first_use"].append(first_use_time)
+    return startup_times
+
+
+def check_tiling(window, np_snow_ma, zone_raster, np_dtm, tile_size):
+    """Check that statistics merged over tiles equal untiled statistics
+    :return: True if the results of both are identical
+    :rtype: bool
+    """
+    band_edges = snow.get_band_edges()
+    results = []
+    for tiles in (
+        snow.split_window(window),
+        snow.split_window(window, tile_size),
+    ):
+        snow_statistics = snow.SnowStatistics(band_edges)
+        for tile in tiles:
+            tile_slice = np.s_[
+                tile["row_offset"] : tile["row_offset"] + tile["height"],
+                tile["col_offset"] : tile["col_offset"] + tile["width"],
+            ]
+            snow_statistics.merge(
+                snow.SnowStatistics(band_edges).update(
+                    np_snow_ma[tile_slice],
+                    zone_raster[tile_slice],
+                    np_dtm=np_dtm[tile_slice],
+                )
+            )
+        try:
+            results.append(snow.get_result_dict(snow_statistics, drop_zero_band=True))
+        except Exception as err:
+            results.append(str(err))
+    return results[0] == results[1]
+
+
+def run_stages(server, size, days, nprocs=4):
+    """Run all stages once and return the time of every stage in seconds"""
+    client = snow.ImageServerClient()
+    snow_image_service = f"{server}/{SNOW_SERVICE}/ImageServer/"
+    dtm_image_service = f"{server}/{DTM_SERVICE}/ImageServer/"
+    date_end = datetime.now().strftime("%Y-%m-%d")
+    date_start = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    query = {
+        "where": f"""opptakstidspunkt >= date '{date_start} 00:00:00' AND opptakstidspunkt <= date '{date_end} 23:59:59'"""
+    }
+    stage_times = {}
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        stage_times[stage] = time.perf_counter() - start
+        return result
+
+    service_description = timed(
+        "metadata",
+        snow.query_image_server,
+        image_service=snow_image_service,
+        print_metadata="service_description",
+        client=client,
+    )
+    spatial_ref = osr.SpatialReference()
+    spatial_ref.ImportFromEPSG(
+        service_description["fullExtent"]["spatialReference"]["wkid"]
+    )
+    window = create_window(service_description, size)
+
+    object_ids = timed(
+        "id_query",
+        snow.query_image_server,
+        image_service=snow_image_service,
+        query_params=query,
+        print_metadata="object_ids",
+        service_description=service_description,
+        client=client,
+    )
+    images = timed(
+        "link_resolution",
+        snow.query_image_server,
+        image_service=snow_image_service,
+        aoi=window,
+        nprocs=nprocs,
+        object_ids=object_ids,
+        service_description=service_description,
+        client=client,
+    )
+    image_arrays = timed(
+        "download",
+        list,
+        snow.fetch_images(images.values(), nprocs=nprocs, client=client),
+    )
+
+    def accumulate():
+        accumulator = snow.SnowAccumulator(
+            (window["height"], window["width"]), max_images=len(image_arrays)
+        )
+        for img in image_arrays:
+            accumulator.add(img)
+        return accumulator.mean()
+
+    np_snow = timed("accumulation", accumulate)
+
+    dtm_service_description = snow.query_image_server(
+        image_service=dtm_image_service,
+        print_metadata="service_description",
+        client=client,
+    )
+    np_dtm = timed(
+        "dtm_warp",
+        snow.read_dtm,
+        window,
+        dtm_image_service,
+        dtm_service_description,
+        spatial_ref,
+        client=client,
+    )
+
+    zone_raster = np.ones(np_snow.shape, dtype=np.bool_)
+    np_snow_ma = np.ma.masked_where(np_snow < 20.0, np_snow)
+    timed(
+        "band_statistics",
+        snow.SnowStatistics(snow.get_band_edges()).update,
+        np_snow_ma,
+        zone_raster,
+        np_dtm=np_dtm,
+    )
+    return stage_times, {
+        "images": len(image_arrays),
+        "pixels": int(np_snow.size),
+        "size": window["width"],
+        "tiled_equals_untiled": check_tiling(
+            window, np_snow_ma, zone_raster, np_dtm, max(size // 3, 1)
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[64, 256, 1024],
+        help="AOI size in pixels",
+    )
+    parser.add_argument(
+        "--days", type=int, nargs="+", default=[1, 7, 30], help="number of days"
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--nprocs", type=int, default=4)
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=0.15,
+        help="maximum time in seconds to import the script",
+    )
+    parser.add_argument(
+        "--server", help="URL of an ImageServer to use instead of the fake server"
+    )
+    parser.add_argument("--output", help="JSON file to write (default is stdout)")
+    args = parser.parse_args()
+
+    fake_server = None
+    server = args.server
+    if not server:
+        fake_server = start_fake_image_server(days=max(args.days))
+        server = fake_server.url.rstrip("/")
+
+    results = []
+    startup_times = measure_startup(args.repeats)
+    for stage, times in startup_times.items():
+        results.append(
+            {
+                "stage": stage,
+                "median_seconds": median(times),
+                "min_seconds": min(times),
+                "repeats": args.repeats,
+            }
+        )
+    startup_budget = {
+        "budget_seconds": args.startup_budget,
+        "import_seconds": median(startup_times["startup_import"]),
+    }
+    startup_budget["within_budget"] = (
+        startup_budget["import_seconds"] <= args.startup_budget
+    )
+    if not startup_budget["within_budget"]:
+        snow.logger.warning(
+            "Import av skriptet tar {:.3f} s (budsjett {:.3f} s)".format(
+                startup_budget["import_seconds"], args.startup_budget
+            )
+        )
+
+    for days in args.days:
+        for size in args.sizes:
+            runs = [
+                run_stages(server, size, days, nprocs=args.nprocs)
+                for _ in range(args.repeats)
+            ]
+            for stage in runs[0][0]:
+                times = [stage_times[stage] for stage_times, _ in runs]
+                results.append(
+                    {
+                        "stage": stage,
+                        "days": days,
+                        **runs[0][1],
+                        "median_seconds": median(times),
+                        "min_seconds": min(times),
+                        "repeats": args.repeats,
+                    }
+                )
+            if not all(info["tiled_equals_untiled"] for _, info in runs):
+                snow.logger.warning(
+                    "Statistikk over fliser avviker fra statistikk uten fliser"
+                )
+            snow.logger.info(
+                "{} piksler, {} dager: {:.3f} s".format(
+                    size * size, days, sum(runs[0][0].values())
+                )
+            )
+
+    if fake_server:
+        fake_server.shutdown()
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "server": args.server or "fake",
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "gdal": gdal.__version__,
+        "nprocs": args.nprocs,
+        "startup": startup_budget,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,36 +6,85 @@
 # Imports from builtin libs
 # import atexit
 import os
-from datetime import datetime, timedelta
+import argparse
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from datetime import datetime, timedelta, timezone
+import csv
+from functools import lru_cache
+import hashlib
+import http.client
+import importlib
+from itertools import islice
 import json
 import logging
-from math import ceil, floor
+from math import ceil, floor, isclose, sqrt
 from pathlib import Path
-from urllib import request, parse
+from urllib import parse
+import socketserver
 import sys
-import tempfile
+import threading
+import time
+from uuid import uuid4
 from warnings import warn
 
 # Imports from non-standards Python libraries
 # gdal må være tilgjengelig for Python interpreteren
-# nedenfor defineres omgivelsesvariablene for CONDA
-
-if "GDAL_DATA" not in os.environ or "PROJ_LIB" not in os.environ:
-    if "CONDA_PREFIX" in os.environ:
-        if not Path(os.environ["CONDA_PREFIX"] + r"\Library\share\gdal").exists():
-            raise Exception(
-                f"Mappe med GDAL: {os.environ['CONDA_PREFIX']}/Library/share/gdal finnes ikke."
-            )
-        os.environ["GDAL_DATA"] = os.environ["CONDA_PREFIX"] + r"\Library\share\gdal"
-        if not Path(os.environ["CONDA_PREFIX"] + r"\Library\share\proj").exists():
-            raise Exception(
-                f"Mappe med PROJ: {os.environ['CONDA_PREFIX']}/Library/share/proj finnes ikke."
+# GDAL and NumPy are imported on first use (see LazyModule), so starting the
+# script (e.g. a worker waiting for jobs) does not pay for importing them
+
+
+def setup_gdal_environment():
+    """Define environment variables for GDAL and PROJ in CONDA environments"""
+    # nedenfor defineres omgivelsesvariablene for CONDA
+    if "GDAL_DATA" not in os.environ or "PROJ_LIB" not in os.environ:
+        if "CONDA_PREFIX" in os.environ:
+            if not Path(os.environ["CONDA_PREFIX"] + r"\Library\share\gdal").exists():
+                raise Exception(
+                    f"Mappe med GDAL: {os.environ['CONDA_PREFIX']}/Library/share/gdal finnes ikke."
+                )
+            os.environ["GDAL_DATA"] = (
+                os.environ["CONDA_PREFIX"] + r"\Library\share\gdal"
             )
-        os.environ["PROJ_LIB"] = os.environ["CONDA_PREFIX"] + r"\Library\share\proj"
+            if not Path(os.environ["CONDA_PREFIX"] + r"\Library\share\proj").exists():
+                raise Exception(
+                    f"Mappe med PROJ: {os.environ['CONDA_PREFIX']}/Library/share/proj finnes ikke."
+                )
+            os.environ["PROJ_LIB"] = os.environ["CONDA_PREFIX"] + r"\Library\share\proj"
 
 
-from osgeo import ogr, osr, gdal
-import numpy as np
+class LazyModule:
+    """Placeholder for a module that is imported on first attribute access
+    On first access, the module is imported and replaces the placeholder in
+    the globals of this script, so later access goes to the module directly.
+    """
+
+    def __init__(self, alias, module_name, setup=None):
+        """
+        :param alias: name of the module in the globals of this script
+        :type alias: str
+        :param module_name: full name of the module to import
+        :type module_name: str
+        :param setup: function to call before the module is imported
+        :type setup: callable
+        """
+        self._alias = alias
+        self._module_name = module_name
+        self._setup = setup
+
+    def __getattr__(self, name):
+        if self._setup:
+            self._setup()
+        module = importlib.import_module(self._module_name)
+        globals()[self._alias] = module
+        return getattr(module, name)
+
+
+gdal = LazyModule("gdal", "osgeo.gdal", setup=setup_gdal_environment)
+ogr = LazyModule("ogr", "osgeo.ogr", setup=setup_gdal_environment)
+osr = LazyModule("osr", "osgeo.osr", setup=setup_gdal_environment)
+np = LazyModule("np", "numpy")
 
 
 def setup_logging():
@@ -56,6 +105,20 @@ def setup_logging():
     return basic_logger
 
 
+def get_grid_size(window):
+    """Get the number of columns and rows of a window
+    Extent divided by pixel size is rounded (not truncated), so floating
+    point errors in the extent do not drop a row or column. All grids
+    (windows, tiles, GDAL rasters, exported images) are sized with this.
+    :return: width and height in pixels
+    :rtype: tuple
+    """
+    return (
+        round((window["xmax"] - window["xmin"]) / window["pixelSizeX"]),
+        round((window["ymax"] - window["ymin"]) / window["pixelSizeY"]),
+    )
+
+
 def align_windows(window, ref):
     """Align two regions
     Python version of:
@@ -70,6 +133,10 @@ def align_windows(window, ref):
     taken into consideration to make sure that the ymax doesn't go
     above 90 degrees (for lat/lon) or that the xmax does "wrap" past
     the xmin, etc.
+    Unlike align_window.c, ymin and xmax are snapped to the grid starting at
+    the origin (xmin, ymax) of ``ref``, not to the ymin and xmax of ``ref``,
+    so the window is a whole number of pixels also when the extent of
+    ``ref`` is not (e.g. for grids coarser than the grid of the service).
     :param window: dict of window to align, with keys ymax, ymin, xmax,
                    xmin, pixelSizeY, pixelSizeX, is_latlong
     :type window: dict
@@ -95,8 +162,9 @@ def align_windows(window, ref):
         - floor((ref["ymax"] - window["ymax"]) / ref["pixelSizeY"]) * ref["pixelSizeY"]
     )
     window["ymin"] = (
-        ref["ymin"]
-        - ceil((ref["ymin"] - window["ymin"]) / ref["pixelSizeY"]) * ref["pixelSizeY"]
+        window["ymax"]
+        - ceil((window["ymax"] - window["ymin"]) / ref["pixelSizeY"])
+        * ref["pixelSizeY"]
     )
     # Rast_easting_to_col() wraps easting:
     # xmax can become < xmin, or both xmin and xmax are shifted */
@@ -105,8 +173,9 @@ def align_windows(window, ref):
         + floor((window["xmin"] - ref["xmin"]) / ref["pixelSizeX"]) * ref["pixelSizeX"]
     )
     window["xmax"] = (
-        ref["xmax"]
-        + ceil((window["xmax"] - ref["xmax"]) / ref["pixelSizeX"]) * ref["pixelSizeX"]
+        window["xmin"]
+        + ceil((window["xmax"] - window["xmin"]) / ref["pixelSizeX"])
+        * ref["pixelSizeX"]
     )
 
     if window["is_latlong"]:
@@ -115,8 +184,14 @@ def align_windows(window, ref):
         while window["ymin"] < -90.0 - window["pixelSizeY"] / 2.0:
             window["ymin"] += window["pixelSizeY"]
 
-    window["width"] = int((window["xmax"] - window["xmin"]) / window["pixelSizeX"])
-    window["height"] = int((window["ymax"] - window["ymin"]) / window["pixelSizeY"])
+    window["width"], window["height"] = get_grid_size(window)
+    if not (
+        isclose(window["width"] * window["pixelSizeX"], window["xmax"] - window["xmin"])
+        and isclose(
+            window["height"] * window["pixelSizeY"], window["ymax"] - window["ymin"]
+        )
+    ):
+        raise ValueError("Vinduet er ikke et helt antall piksler.")
     window[
         "bbox"
     ] = f"{window['xmin']}, {window['ymin']}, {window['xmax']}, {window['ymax']}"
@@ -130,24 +205,52 @@ def align_windows(window, ref):
     return window
 
 
+def split_window(window, tile_size=None):
+    """Split an aligned window into tiles aligned to the same grid
+    Tiles are ``tile_size`` x ``tile_size`` pixels large, except for the
+    last row and column of tiles, which hold the remaining pixels.
+    :param window: dict of aligned window (as returned by ``align_windows``)
+    :type window: dict
+    :param tile_size: number of rows and columns per tile, ``None`` or 0
+                      returns the window as a single tile
+    :type tile_size: int
+    :return: list of windows with additional keys row_offset and col_offset
+             (position of the tile within ``window`` in pixels)
+    :rtype: list
+    """
+    if not tile_size:
+        tile_size = max(window["width"], window["height"])
+    tiles = []
+    for row_offset in range(0, window["height"], tile_size):
+        for col_offset in range(0, window["width"], tile_size):
+            tile = window.copy()
+            tile["row_offset"], tile["col_offset"] = row_offset, col_offset
+            tile["height"] = min(tile_size, window["height"] - row_offset)
+            tile["width"] = min(tile_size, window["width"] - col_offset)
+            tile["ymax"] = window["ymax"] - row_offset * window["pixelSizeY"]
+            tile["ymin"] = tile["ymax"] - tile["height"] * window["pixelSizeY"]
+            tile["xmin"] = window["xmin"] + col_offset * window["pixelSizeX"]
+            tile["xmax"] = tile["xmin"] + tile["width"] * window["pixelSizeX"]
+            tile[
+                "bbox"
+            ] = f"{tile['xmin']}, {tile['ymin']}, {tile['xmax']}, {tile['ymax']}"
+            tiles.append(tile)
+    return tiles
+
+
 def create_gdal_raster(
     reference_grid, srs, data_type, ds_name="dtm_raster", driver_name="MEM"
 ):
     driver = gdal.GetDriverByName(driver_name)
     target_ds = driver.Create(
         ds_name,
-        int(
-            (reference_grid["xmax"] - reference_grid["xmin"])
-            / reference_grid["pixelSizeX"]
-        ),
-        int(
-            (reference_grid["ymax"] - reference_grid["ymin"])
-            / reference_grid["pixelSizeY"]
-        ),
+        *get_grid_size(reference_grid),
         1,
         data_type,
     )
-    target_ds.GetRasterBand(1).Fill(0)
+    if driver_name != "MEM":
+        # MEM rasters are initialized with 0 already
+        target_ds.GetRasterBand(1).Fill(0)
     target_ds.SetGeoTransform(
         (
             (reference_grid["xmin"]),
@@ -166,10 +269,15 @@ def aggregate_raster(
     in_ds,
     reference_grid,
     spatial_ref,
-    data_type=gdal.GDT_Float32,
-    agg_alg=gdal.GRA_Average,
+    data_type=None,
+    agg_alg=None,
 ):
-    """Aggregate Raster to coarser resolution"""
+    """Aggregate Raster to coarser resolution
+    Data type defaults to gdal.GDT_Float32 and aggregation algorithm to
+    gdal.GRA_Average.
+    """
+    data_type = gdal.GDT_Float32 if data_type is None else data_type
+    agg_alg = gdal.GRA_Average if agg_alg is None else agg_alg
     target_ds = create_gdal_raster(reference_grid, spatial_ref, data_type)
     gdal.Warp(
         target_ds,
@@ -193,34 +301,632 @@ def reproject_geojson(geo_json, spatial_ref):
     s_srs = osr.SpatialReference()
     s_srs.ImportFromEPSG(4326)
 
-    # Create temporary (shape) file
-    tmp_shp = tempfile.NamedTemporaryFile().name + ".shp"
-
-    # Reproject AOI layer
-    gdal.VectorTranslate(
-        tmp_shp, geo_json, dstSRS=spatial_ref, srcSRS=s_srs, reproject=True
+    # Reproject AOI layer into an in-memory dataset
+    return gdal.VectorTranslate(
+        "",
+        geo_json,
+        format="Memory",
+        dstSRS=spatial_ref,
+        srcSRS=s_srs,
+        reproject=True,
     )
 
-    return gdal.OpenEx(tmp_shp)
 
+def create_zone_layer(aoi, id_column=None):
+    """Copy features of the AOI to an in-memory layer with a zone number
+    Zones are numbered 1 ... number of features in the order of the features.
+    :param aoi: GDAL vector dataset with Area(s) of Interest
+    :type aoi: gdal.Dataset
+    :param id_column: attribute column with feature IDs (default is the FID)
+    :type id_column: str
+    :return: tuple with GDAL vector dataset and a list of feature IDs
+    :rtype: tuple
+    """
+    aoi_layer = aoi.GetLayerByIndex(0)
+    zone_ds = gdal.GetDriverByName("Memory").Create("zones", 0, 0, 0, gdal.GDT_Unknown)
+    zone_layer = zone_ds.CreateLayer(
+        "zones", srs=aoi_layer.GetSpatialRef(), geom_type=aoi_layer.GetGeomType()
+    )
+    zone_layer.CreateField(ogr.FieldDefn("zone", ogr.OFTInteger))
+
+    feature_ids = []
+    aoi_layer.ResetReading()
+    for zone, feature in enumerate(aoi_layer, start=1):
+        zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+        zone_feature.SetGeometry(feature.GetGeometryRef())
+        zone_feature.SetField("zone", zone)
+        zone_layer.CreateFeature(zone_feature)
+        feature_ids.append(
+            feature.GetField(id_column) if id_column else feature.GetFID()
+        )
+    return zone_ds, feature_ids
 
-def rasterize_aoi(reference_grid, aoi, spatial_ref):
-    """Rasterize AOI on reference grid"""
+
+def rasterize_aoi(reference_grid, aoi, spatial_ref, attribute=None):
+    """Rasterize AOI on reference grid
+    Returns a boolean mask, or a zone raster with the values of ``attribute``
+    (0 outside all features) if an attribute is given. Where features overlap,
+    the last feature wins.
+    """
 
     # Create target raster map from reference grid
     target_ds = create_gdal_raster(
         reference_grid,
         spatial_ref,
-        gdal.GDT_Byte,
+        gdal.GDT_Int32 if attribute else gdal.GDT_Byte,
         ds_name="mask_raster",
         driver_name="MEM",
     )
 
     # Rasterize AOI on target raster map
     gdal.Rasterize(
-        target_ds, aoi, allTouched=True, layers=[aoi.GetLayerByIndex(0).GetName()]
+        target_ds,
+        aoi,
+        allTouched=True,
+        layers=[aoi.GetLayerByIndex(0).GetName()],
+        attribute=attribute,
     )
-    return np.array(target_ds.ReadAsArray(), dtype=np.bool_)
+    return target_ds.ReadAsArray().astype(
+        np.int32 if attribute else np.bool_, copy=False
+    )
+
+
+def get_aoi_key(aoi):
+    """Get a hash of the content of an AOI file (or of the AOI string itself)"""
+    aoi_content = Path(aoi).read_bytes() if Path(aoi).is_file() else aoi.encode()
+    return hashlib.sha256(aoi_content).hexdigest()
+
+
+class PackedMask:
+    """AOI mask or zone raster of a window in compact form
+    The mask is cropped to the bounding box of the pixels within the AOI.
+    Boolean masks are bit-packed row by row (one bit per pixel), zone rasters
+    are stored with the smallest integer type for the number of zones. The
+    full array is only unpacked when needed.
+    """
+
+    def __init__(self, data, shape, row_offset, col_offset, width, is_packed):
+        """
+        :param data: cropped (and bit-packed) mask
+        :type data: numpy.ndarray
+        :param shape: shape of the unpacked mask
+        :type shape: tuple
+        :param row_offset: first row of the crop in the unpacked mask
+        :type row_offset: int
+        :param col_offset: first column of the crop in the unpacked mask
+        :type col_offset: int
+        :param width: number of columns of the crop
+        :type width: int
+        :param is_packed: whether data is a bit-packed boolean mask
+        :type is_packed: bool
+        """
+        self.data = data
+        self.shape = tuple(shape)
+        self.row_offset = row_offset
+        self.col_offset = col_offset
+        self.width = width
+        self.is_packed = is_packed
+
+    @classmethod
+    def from_array(cls, mask):
+        """Pack a boolean mask or an integer zone raster"""
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size:
+            row_offset, col_offset = int(rows[0]), int(cols[0])
+            cropped = mask[row_offset : rows[-1] + 1, col_offset : cols[-1] + 1]
+        else:
+            row_offset, col_offset = 0, 0
+            cropped = mask[:0, :0]
+        if mask.dtype == np.bool_:
+            data = np.packbits(cropped, axis=1)
+        else:
+            data = cropped.astype(np.min_scalar_type(cropped.max(initial=0)))
+        return cls(
+            data,
+            mask.shape,
+            row_offset,
+            col_offset,
+            cropped.shape[1],
+            mask.dtype == np.bool_,
+        )
+
+    def any(self):
+        """Check if any pixel is within the AOI without unpacking"""
+        return bool(self.data.any())
+
+    def unpack(self):
+        """Unpack into a boolean mask or an int32 zone raster"""
+        mask = np.zeros(self.shape, dtype=np.bool_ if self.is_packed else np.int32)
+        if self.is_packed:
+            cropped = np.unpackbits(self.data, axis=1, count=self.width).view(np.bool_)
+        else:
+            cropped = self.data
+        mask[
+            self.row_offset : self.row_offset + cropped.shape[0],
+            self.col_offset : self.col_offset + self.width,
+        ] = cropped
+        return mask
+
+    def save(self, path):
+        """Save the packed mask to a numpy (.npz) file"""
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            data=self.data,
+            meta=np.array(
+                [*self.shape, self.row_offset, self.col_offset, self.width],
+                dtype=np.int64,
+            ),
+            is_packed=np.array(self.is_packed),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a packed mask saved with ``save``"""
+        with np.load(path) as packed_mask:
+            height, width, row_offset, col_offset, crop_width = packed_mask[
+                "meta"
+            ].tolist()
+            return cls(
+                packed_mask["data"],
+                (height, width),
+                row_offset,
+                col_offset,
+                crop_width,
+                bool(packed_mask["is_packed"]),
+            )
+
+
+class AOICache:
+    """In-memory cache of reprojected AOIs and their rasterized masks
+    Entries are keyed by a hash of the AOI content, the target spatial
+    reference and (for masks) the grid, so repeated requests for the same
+    AOI in a long-running process skip reprojection and rasterization.
+    Cached datasets are shared and must not be modified. Masks are kept as
+    PackedMask and, if ``mask_directory`` is set, also stored on disk, so
+    they can be reused by other processes.
+    """
+
+    def __init__(self, max_entries=64, mask_directory=None):
+        """
+        :param max_entries: number of entries to keep, least recently used
+                            entries are dropped first
+        :type max_entries: int
+        :param mask_directory: directory to store packed masks in
+        :type mask_directory: str
+        """
+        self.max_entries = max_entries
+        self.mask_directory = mask_directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, key, create):
+        """Get an entry from the cache or create and add it"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = create()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def reproject(self, aoi, spatial_ref, aoi_key=None):
+        """Get the AOI reprojected to spatial_ref (see ``reproject_geojson``)"""
+        key = ("aoi", aoi_key or get_aoi_key(aoi), spatial_ref.ExportToWkt())
+        return self._get_or_create(key, lambda: reproject_geojson(aoi, spatial_ref))
+
+    def rasterize(
+        self,
+        reference_grid,
+        aoi,
+        spatial_ref,
+        aoi_key,
+        attribute=None,
+        mask_directory=None,
+    ):
+        """Get the AOI rasterized on reference_grid (see ``rasterize_aoi``)
+        The returned PackedMask is shared and must not be modified.
+        :param aoi_key: hash of the AOI the (reprojected) dataset aoi is made from
+        :type aoi_key: str
+        :param mask_directory: directory to store packed masks in for this
+                               call (None to use ``mask_directory`` of the cache)
+        :type mask_directory: str
+        """
+        mask_directory = mask_directory or self.mask_directory
+        key = (
+            "mask",
+            aoi_key,
+            spatial_ref.ExportToWkt(),
+            reference_grid["bbox"],
+            reference_grid["pixelSizeX"],
+            reference_grid["pixelSizeY"],
+            attribute,
+        )
+
+        def create():
+            if mask_directory:
+                mask_digest = hashlib.sha256(
+                    json.dumps(key).encode("utf-8")
+                ).hexdigest()
+                mask_path = Path(mask_directory) / f"mask_{mask_digest[:16]}.npz"
+                if mask_path.exists():
+                    return PackedMask.load(mask_path)
+            packed_mask = PackedMask.from_array(
+                rasterize_aoi(reference_grid, aoi, spatial_ref, attribute=attribute)
+            )
+            if mask_directory:
+                Path(mask_directory).mkdir(parents=True, exist_ok=True)
+                packed_mask.save(mask_path)
+            return packed_mask
+
+        return self._get_or_create(key, create)
+
+
+aoi_cache = AOICache()
+
+# Time to live in seconds of service descriptions and queries, which can
+# change on the server (extent, capabilities, new images)
+VOLATILE_TTL = 300
+
+
+class MemoryCache:
+    """In-memory cache of service descriptions and DTM windows
+    Keeps data that rarely changes between runs of a long-running process
+    (worker or service). Least recently used entries are dropped first and
+    entries older than ``ttl`` seconds (or the time to live given for the
+    entry) are created again. Cached values are shared and must not be
+    modified, arrays are made read-only.
+    """
+
+    def __init__(self, max_entries=64, ttl=3600):
+        """
+        :param max_entries: number of entries to keep
+        :type max_entries: int
+        :param ttl: time to live of entries in seconds
+        :type ttl: float
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, create, ttl=None):
+        """Get an entry from the cache or create and add it
+        :param ttl: time to live of the entry in seconds (default is ``ttl``
+                    of the cache)
+        :type ttl: float
+        """
+        with self._lock:
+            if key in self._entries:
+                created, value = self._entries[key]
+                if time.monotonic() - created < (self.ttl if ttl is None else ttl):
+                    self._entries.move_to_end(key)
+                    return value
+        value = create()
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+
+memory_cache = MemoryCache()
+
+
+class ImageServerCache:
+    """Size bounded on-disk cache of ImageServer responses
+    Every entry is a file in ``cache_directory`` named by a hash of its key.
+    The time of last use is stored as access time of the file, so the least
+    recently used entries can be removed when the cache grows beyond
+    ``max_size`` bytes. The size of the cache is counted when it is opened
+    and kept up to date on every put, so the directory is only scanned when
+    entries have to be evicted, and then entries are evicted down to
+    ``low_water`` times ``max_size``. Entries used within the last ``min_age`` seconds are
+    kept, so images downloaded in the current run are not evicted before
+    they are read. Service descriptions and queries are volatile and only
+    served from the cache within ``ttl`` seconds after they were written.
+    """
+
+    def __init__(
+        self,
+        cache_directory,
+        max_size=2 * 1024**3,
+        ttl=VOLATILE_TTL,
+        min_age=600,
+        low_water=0.9,
+    ):
+        """
+        :param cache_directory: directory to store cached responses in
+        :type cache_directory: str
+        :param max_size: maximum size of the cache in bytes
+        :type max_size: int
+        :param ttl: time to live in seconds for volatile entries
+        :type ttl: int
+        :param min_age: minimum time in seconds since last use before an
+                        entry can be evicted
+        :type min_age: int
+        :param low_water: fraction of max_size to evict down to
+        :type low_water: float
+        """
+        self.cache_directory = Path(cache_directory)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_age = min_age
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(stat.st_size for stat, _ in self._entries())
+
+    def _path(self, key):
+        """Get path of the file for a cache key (tuple of strings and numbers)"""
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return self.cache_directory / digest
+
+    def _entries(self):
+        """Get stat and path of all entries in the cache directory"""
+        entries = []
+        for path in self.cache_directory.iterdir():
+            if path.suffix == ".tmp":
+                continue
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_path(self, key, ttl=None):
+        """Return path to the cached entry for key or None if it is not cached
+        :param key: key of the entry, e.g. (service URL, object id, bbox, pixel size)
+        :type key: tuple
+        :param ttl: time to live in seconds, None if the entry does not expire
+        :type ttl: int
+        """
+        path = self._path(key)
+        now = time.time()
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            self._count(False)
+            return None
+        if ttl is not None and now - mtime > ttl:
+            self._count(False)
+            return None
+        # Mark entry as recently used
+        os.utime(path, (now, mtime))
+        self._count(True)
+        return str(path)
+
+    def get(self, key, ttl=None):
+        """Return content of the cached entry for key or None if it is not cached"""
+        path = self.get_path(key, ttl=ttl)
+        if path is None:
+            return None
+        return Path(path).read_bytes()
+
+    def put(self, key, content):
+        """Store content for key in the cache and return the path to the entry"""
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        try:
+            replaced_size = path.stat().st_size
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += len(content) - replaced_size
+            evict = self._size > self.max_size
+        if evict:
+            self.evict()
+        return str(path)
+
+    def evict(self):
+        """Remove least recently used entries if the cache exceeds max_size
+        Entries are removed until the cache fits into low_water times max_size.
+        The directory is scanned again, so the size also counts entries
+        written by other processes using the same directory.
+        """
+        with self._lock:
+            entries = self._entries()
+            self._size = sum(stat.st_size for stat, _ in entries)
+            if self._size <= self.max_size:
+                return
+            target_size = self.max_size * self.low_water
+            now = time.time()
+            for stat, path in sorted(entries, key=lambda entry: entry[0].st_atime):
+                if self._size <= target_size or now - stat.st_atime < self.min_age:
+                    break
+                path.unlink(missing_ok=True)
+                self._size -= stat.st_size
+
+
+class Metrics:
+    """Timing of the stages of a run and counters (bytes, images, pixels, ...)
+    Disabled metrics cost next to nothing: ``stage`` returns a shared no-op
+    context manager and ``add`` returns immediately. Stages run in worker
+    threads (like image downloads) are summed over the threads.
+    """
+
+    _disabled_stage = nullcontext()
+
+    def __init__(self, enabled=False):
+        self.reset(enabled)
+
+    def reset(self, enabled=False):
+        """Clear all timings and counters and enable or disable metrics"""
+        self.enabled = enabled
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Context manager adding the time spent in it to the stage name"""
+        if not self.enabled:
+            return self._disabled_stage
+        return self._time_stage(name)
+
+    @contextmanager
+    def _time_stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def add(self, counter, value=1):
+        """Add value to a counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self):
+        """Get timings (in seconds) and counters as a JSON serializable dict"""
+        return {
+            "seconds": {name: round(value, 6) for name, value in self.timings.items()},
+            **self.counters,
+        }
+
+
+metrics = Metrics()
+
+
+def add_metrics(results):
+    """Add the metrics of the run as "_metrics" to every result record
+    Records of time series and per-feature results all get the metrics of
+    the whole run. Nothing is added if metrics are not enabled.
+    :param results: list of result dicts
+    :type results: list
+    """
+    if metrics.enabled:
+        run_metrics = metrics.as_dict()
+        for result in results:
+            result["_metrics"] = run_metrics
+
+
+class ImageServerClient:
+    """HTTP client for ArcGIS ImageServer services
+    Connections are kept alive and reused (one connection per host and
+    thread), so TCP/TLS connections are not set up for every request.
+    Requests time out after ``timeout`` seconds and failed requests are
+    retried with exponential backoff (all requests to the ImageServer are
+    idempotent GET requests).
+    """
+
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout=60, retries=3, backoff_factor=0.5):
+        """
+        :param timeout: timeout for connecting and reading in seconds
+        :type timeout: float
+        :param retries: number of retries of failed requests
+        :type retries: int
+        :param backoff_factor: wait backoff_factor * 2 ** retry seconds before a retry
+        :type backoff_factor: float
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._local = threading.local()
+
+    def _get_connection(self, scheme, netloc):
+        """Get the keep-alive connection to a host for the current thread"""
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        connection = self._local.connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = (
+                http.client.HTTPSConnection
+                if scheme == "https"
+                else http.client.HTTPConnection
+            )
+            connection = connection_class(netloc, timeout=self.timeout)
+            self._local.connections[(scheme, netloc)] = connection
+        return connection
+
+    def get(self, url, max_redirects=5):
+        """Send a GET request and return the content of the response
+        Connection errors, timeouts and responses with a status code in
+        ``retry_status`` are retried, other HTTP errors raise a RuntimeError.
+        """
+        url_parts = parse.urlsplit(url)
+        path = url_parts.path or "/"
+        if url_parts.query:
+            path += "?" + url_parts.query
+        for retry in range(self.retries + 1):
+            if retry:
+                logger.warning(
+                    "Forsøker på nytt ({}/{}): {}".format(retry, self.retries, error)
+                )
+                time.sleep(self.backoff_factor * 2 ** (retry - 1))
+            connection = self._get_connection(url_parts.scheme, url_parts.netloc)
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                # Drop the broken connection, it is re-opened on the next request
+                connection.close()
+                error = err
+                continue
+            if response.status in (301, 302, 303, 307, 308) and max_redirects:
+                return self.get(
+                    parse.urljoin(url, response.getheader("Location")),
+                    max_redirects=max_redirects - 1,
+                )
+            if response.status < 300:
+                metrics.add("requests")
+                metrics.add("bytes_downloaded", len(content))
+                return content
+            error = RuntimeError(
+                "ImageServeren svarte med {} på {}: {}".format(
+                    response.status, url, content[:200]
+                )
+            )
+            if response.status not in self.retry_status:
+                raise error
+        raise error
+
+    def get_json(self, url):
+        """Send a GET request and return the decoded JSON response
+        Errors reported by the ImageServer in the JSON response raise a RuntimeError.
+        """
+        response_json = json.loads(self.get(url).decode("utf-8"))
+        if isinstance(response_json, dict) and "error" in response_json:
+            raise RuntimeError(
+                "Feil med spørring til ImageServeren: {}".format(response_json["error"])
+            )
+        return response_json
+
+
+default_client = ImageServerClient()
+
+
+@lru_cache(maxsize=None)
+def get_client(timeout=60, retries=3):
+    """Get a client shared by all runs with the same timeout and retries
+    Keeps connections to the ImageServer open between jobs of a worker.
+    """
+    return ImageServerClient(timeout=timeout, retries=retries)
 
 
 def query_image_server(
@@ -228,44 +934,55 @@ def query_image_server(
     query_params=None,
     print_metadata=None,
     aoi=None,
+    nprocs=1,
+    object_ids=None,
+    service_description=None,
+    cache=None,
+    client=None,
 ):
     """Queries an ImageServer instance for data in space and time"""
     # ToDo: Probably more elegantly implemented as a class
     # (checking server, listing services, ...)
+    client = client or default_client
     # Get Service metadata
-    url = image_service + "?f=pjson"
-    with request.urlopen(url) as response:
-        if not response.getcode() != "200":
-            logger.error(response.read())
-            sys.exit("Kan ikke lese fra ImageServeren.")
-        response_text = response.read()
-    service_description = json.loads(response_text.decode("utf-8"))
+    if not service_description:
+        url = image_service + "?f=pjson"
+        response_text = cache.get((url,), ttl=cache.ttl) if cache else None
+        if response_text is None:
+            response_text = client.get(url)
+            if cache:
+                cache.put((url,), response_text)
+        service_description = json.loads(response_text.decode("utf-8"))
     if print_metadata and print_metadata == "service_description":
         return service_description
 
-    # Get IDs of image(s) for selected day(s)
-    params = {
-        "returnGeometry": "false",
-        "returnIdsOnly": "true",
-        "f": "json",
-    }
-    if query_params:
-        params.update(query_params)
+    if object_ids is None:
+        # Get IDs of image(s) for selected day(s)
+        params = {
+            "returnGeometry": "false",
+            "returnIdsOnly": "true",
+            "f": "json",
+        }
+        if query_params:
+            params.update(query_params)
 
-    query_string = parse.urlencode(params)
+        query_string = parse.urlencode(params)
 
-    url = image_service + "query?" + query_string
+        url = image_service + "query?" + query_string
 
-    with request.urlopen(url) as response:
-        response_text = response.read()
-    j = json.loads(response_text.decode("utf-8"))
-    if "objectIds" not in j:
-        logging.error("Feil med spørring til ImageServeren.")
-    images = j["objectIds"]
-    if not images:
-        logger.warning(
-            f"Ingen bilder på ImageServeren for {selected_day.strftime('%Y-%m-%d')}."
-        )
+        response_text = cache.get((url,), ttl=cache.ttl) if cache else None
+        if response_text is None:
+            response_text = client.get(url)
+            if cache:
+                cache.put((url,), response_text)
+        j = json.loads(response_text.decode("utf-8"))
+        if "objectIds" not in j:
+            raise RuntimeError("Feil med spørring til ImageServeren: {}".format(j))
+        object_ids = j["objectIds"]
+        if not object_ids:
+            logger.warning("Ingen bilder på ImageServeren for valgt tidsrom.")
+    if print_metadata and print_metadata == "object_ids":
+        return object_ids
 
     # Get url of image(s) for selected day
     if not aoi:
@@ -273,10 +990,7 @@ def query_image_server(
         aoi["pixelSizeX"] = service_description["pixelSizeX"]
         aoi["pixelSizeY"] = service_description["pixelSizeY"]
 
-    width, height = (
-        int((aoi["xmax"] - aoi["xmin"]) / aoi["pixelSizeX"]),
-        int((aoi["ymax"] - aoi["ymin"]) / aoi["pixelSizeY"]),
-    )
+    width, height = get_grid_size(aoi)
     bbox = ",".join(map(str, [aoi["xmin"], aoi["ymin"], aoi["xmax"], aoi["ymax"]]))
     image_params = {
         "bbox": bbox,
@@ -289,97 +1003,1205 @@ def query_image_server(
     }
     query_string = parse.urlencode(image_params)
 
-    image_links = {}
-    for i in images:
-        url = image_service + str(i) + "/image?" + query_string
-        with request.urlopen(url) as response:
-            response_text = response.read()
-        j = json.loads(response_text.decode("utf-8"))
-        image_links[i] = j["href"]
+    image_urls = {
+        i: image_service + str(i) + "/image?" + query_string for i in object_ids
+    }
+
+    if not cache:
+        # Resolve links to exported images in parallel
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            image_links = dict(
+                zip(
+                    image_urls,
+                    executor.map(
+                        resolve_image_link,
+                        image_urls.values(),
+                        [client] * len(image_urls),
+                    ),
+                )
+            )
+        return image_links
+
+    # Link to cached images and download missing images to the cache in parallel
+    cache_keys = {
+        i: (image_service, i, bbox, aoi["pixelSizeX"], aoi["pixelSizeY"])
+        for i in object_ids
+    }
+    image_links = {i: cache.get_path(cache_keys[i]) for i in object_ids}
+    missing = [i for i, image_link in image_links.items() if not image_link]
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        image_links.update(
+            zip(
+                missing,
+                executor.map(
+                    download_image,
+                    [image_urls[i] for i in missing],
+                    [cache] * len(missing),
+                    [cache_keys[i] for i in missing],
+                    [client] * len(missing),
+                ),
+            )
+        )
 
     return image_links
 
 
-def get_snow_statistics_for_height_interval(
-    snow_min_elevation, snow_max_elevation, np_dtm, np_snow_ma, class_nr
+def get_service_description(image_service, cache=None, client=None):
+    """Get the service description of an image service (kept in memory)
+    Descriptions expire like volatile entries of the on-disk cache, so a
+    long-running process picks up changes of the service.
+    """
+    return memory_cache.get_or_create(
+        ("service_description", image_service),
+        lambda: query_image_server(
+            image_service=image_service,
+            print_metadata="service_description",
+            cache=cache,
+            client=client,
+        ),
+        ttl=cache.ttl if cache else VOLATILE_TTL,
+    )
+
+
+def query_acquisition_dates(
+    image_service,
+    query_params=None,
+    date_field="opptakstidspunkt",
+    object_id_field="OBJECTID",
+    cache=None,
+    client=None,
+):
+    """Get IDs of images on an ImageServer grouped by acquisition date
+    Only the ID and date fields are requested. The server returns at most
+    maxRecordCount features per response (and sets exceededTransferLimit),
+    so the query is paged with resultOffset until all features are read.
+    :param date_field: attribute with the acquisition time of the images
+    :type date_field: str
+    :param object_id_field: attribute with the image ID (objectIdField of
+                            the service description)
+    :type object_id_field: str
+    :return: dict with acquisition date (YYYY-MM-DD, UTC) as key and list of
+             image IDs as value, sorted by date
+    :rtype: dict
+    """
+    client = client or default_client
+    params = {
+        "returnGeometry": "false",
+        "outFields": f"{object_id_field},{date_field}",
+        "orderByFields": object_id_field,
+        "f": "json",
+    }
+    if query_params:
+        params.update(query_params)
+
+    acquisition_dates = {}
+    result_offset = 0
+    while True:
+        params["resultOffset"] = result_offset
+        url = image_service + "query?" + parse.urlencode(params)
+        response_text = cache.get((url,), ttl=cache.ttl) if cache else None
+        if response_text is None:
+            response_text = client.get(url)
+            if cache:
+                cache.put((url,), response_text)
+        j = json.loads(response_text.decode("utf-8"))
+        if "features" not in j:
+            raise RuntimeError("Feil med spørring til ImageServeren: {}".format(j))
+
+        for feature in j["features"]:
+            attributes = feature["attributes"]
+            acquisition_date = datetime.fromtimestamp(
+                attributes[date_field] / 1000, tz=timezone.utc
+            ).strftime("%Y-%m-%d")
+            acquisition_dates.setdefault(acquisition_date, []).append(
+                attributes[object_id_field]
+            )
+        result_offset += len(j["features"])
+        if not j.get("exceededTransferLimit") or not j["features"]:
+            break
+    return dict(sorted(acquisition_dates.items()))
+
+
+def resolve_image_link(url, client=None):
+    """Get the link to an image exported by the ImageServer"""
+    return (client or default_client).get_json(url)["href"]
+
+
+def download_image(url, cache, cache_key, client=None):
+    """Export an image from the ImageServer into the cache
+    :return: path to the cached image
+    :rtype: str
+    """
+    client = client or default_client
+    return cache.put(cache_key, client.get(resolve_image_link(url, client)))
+
+
+@contextmanager
+def open_image(image_link, client=None):
+    """Open an image from a URL or a local (cached) file with GDAL
+    Images from URLs are downloaded over the keep-alive connection of the
+    client into GDAL's in-memory file system, which is cleaned up when
+    leaving the context.
+    """
+    if image_link.startswith("http"):
+        image_path = f"/vsimem/{uuid4().hex}.tif"
+        gdal.FileFromMemBuffer(image_path, (client or default_client).get(image_link))
+    else:
+        image_path = image_link
+    img_ds = gdal.Open(image_path)
+    try:
+        yield img_ds
+    finally:
+        img_ds = None
+        if image_path != image_link:
+            gdal.Unlink(image_path)
+
+
+def read_image(image_link, client=None):
+    """Read an image exported by the ImageServer into a numpy array"""
+    with metrics.stage("image_read"), open_image(image_link, client=client) as img_ds:
+        if not img_ds:
+            raise RuntimeError(f"Kan ikke lese bilde fra {image_link}.")
+        metrics.add("images_read")
+        return np.array(img_ds.ReadAsArray())
+
+
+def supports_server_mean(service_description):
+    """Check if an ImageServer can average images with a mosaic rule
+    Requires locking rasters (LockRaster in allowedMosaicMethods) and mosaic
+    operators (mosaicOperator), which only mosaic datasets have.
+    :param service_description: service description of the ImageServer
+    :type service_description: dict
+    :rtype: bool
+    """
+    mosaic_methods = service_description.get("allowedMosaicMethods", "").split(",")
+    return "LockRaster" in mosaic_methods and bool(
+        service_description.get("mosaicOperator")
+    )
+
+
+def compute_mean_on_server(
+    image_service, object_ids, aoi, cache=None, client=None, compact=False
+):
+    """Let the ImageServer compute the per-pixel mean snow cover of several images
+    Invalid values (outside 101-200) of every image are set to NoData with a
+    Remap raster function applied per item (itemRenderingRule of the mosaic
+    rule), before the valid values of the images are averaged (MT_MEAN), so
+    only one aggregated image is downloaded instead of every image.
+    :param object_ids: IDs of the images to average
+    :type object_ids: list
+    :param aoi: aligned window to export
+    :type aoi: dict
+    :param compact: return the mean as float32 instead of float64
+    :type compact: bool
+    :return: mean snow cover percentage (0 where no image has a valid value)
+    :rtype: numpy.ndarray
+    """
+    client = client or default_client
+    width, height = get_grid_size(aoi)
+    bbox = ",".join(map(str, [aoi["xmin"], aoi["ymin"], aoi["xmax"], aoi["ymax"]]))
+    # A renderingRule would be applied to the mean, so invalid values have to
+    # be masked per item
+    mosaic_rule = {
+        "mosaicMethod": "esriMosaicLockRaster",
+        "lockRasterIds": list(object_ids),
+        "mosaicOperation": "MT_MEAN",
+        "itemRenderingRule": {
+            "rasterFunction": "Remap",
+            "rasterFunctionArguments": {
+                "NoDataRanges": [0, 101, 201, 256],
+                "AllowUnmatched": True,
+            },
+        },
+    }
+    export_params = {
+        "bbox": bbox,
+        "size": f"{width},{height}",
+        "format": "tiff",
+        "pixelType": "F32",
+        "noData": -1,
+        "interpolation": "RSP_NearestNeighbor",
+        "mosaicRule": json.dumps(mosaic_rule),
+        "f": "json",
+    }
+    url = image_service + "exportImage?" + parse.urlencode(export_params)
+
+    cache_key = (
+        image_service,
+        "MT_MEAN_ITEM_REMAP",
+        sorted(object_ids),
+        bbox,
+        width,
+        height,
+    )
+    image_link = cache.get_path(cache_key) if cache else None
+    if not image_link:
+        if cache:
+            image_link = download_image(url, cache, cache_key, client)
+        else:
+            image_link = resolve_image_link(url, client)
+    img = read_image(image_link, client)
+
+    mean_snow = np.zeros(img.shape, dtype=np.float32 if compact else np.float64)
+    np.subtract(img, 100, out=mean_snow, where=img >= 100)
+    return mean_snow
+
+
+def gather_pixels(array, pixel_index=None):
+    """Gather pixels at flat indices of an array into a 1-D array
+    Returns the array unchanged if pixel_index (or array) is None.
+    """
+    if array is None or pixel_index is None:
+        return array
+    return np.take(array, pixel_index)
+
+
+def fetch_images(image_links, nprocs=1, client=None):
+    """Read images concurrently and yield them as they arrive
+    Not more than ``nprocs`` images are downloaded at the same time, so
+    memory use is bound by the number of workers, not by the number of images.
+    Images are yielded in order of arrival, not in the order of ``image_links``.
+    :param image_links: iterable with links to images exported by the ImageServer
+    :type image_links: iterable
+    :param nprocs: number of images to download in parallel
+    :type nprocs: int
+    :param client: client for downloading images from the ImageServer
+    :type client: ImageServerClient
+    :return: generator of numpy arrays
+    """
+    image_links = iter(image_links)
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        pending = {
+            executor.submit(read_image, image_link, client)
+            for image_link in islice(image_links, nprocs)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                image_link = next(image_links, None)
+                if image_link is not None:
+                    pending.add(executor.submit(read_image, image_link, client))
+                yield future.result()
+
+
+def read_dtm(
+    reference_grid,
+    dtm_image_service,
+    dtm_service_description,
+    spatial_ref,
+    cache=None,
+    client=None,
+    data_type=None,
+):
+    """Read DTM from the ImageServer and aggregate it to the reference grid
+    With data_type gdal.GDT_Int16, the aggregated elevation is rounded to
+    whole meters, which halves the memory used for the DTM.
+    """
+    dtm_ref_grid = dtm_service_description["fullExtent"].copy()
+    dtm_ref_grid["is_latlong"] = bool(spatial_ref.IsGeographic())
+    dtm_ref_grid["pixelSizeX"], dtm_ref_grid["pixelSizeY"] = (
+        dtm_service_description["pixelSizeX"],
+        dtm_service_description["pixelSizeY"],
+    )
+    dtm_aoi = align_windows(
+        {key: reference_grid[key] for key in ("xmin", "xmax", "ymin", "ymax")},
+        dtm_ref_grid,
+    )
+
+    dtm = query_image_server(
+        image_service=dtm_image_service,
+        aoi=dtm_aoi,
+        service_description=dtm_service_description,
+        cache=cache,
+        client=client,
+    )
+    with open_image(list(dtm.values())[0], client=client) as dtm_ds:
+        return aggregate_raster(
+            dtm_ds,
+            reference_grid,
+            spatial_ref,
+            data_type=data_type,
+            agg_alg=gdal.GRA_Average,
+        )
+
+
+class DTMStore:
+    """Persistent store of the DTM resampled to the grid of the snow service
+    The DTM is downloaded and aggregated to the full extent of the snow
+    service once and saved as a numpy file, together with rasters of
+    elevation band indices for the band edges in use. Both are memory-mapped,
+    so the DTM of a window is a slice of the stored array without network
+    access or copying.
+    In compact mode, the DTM is stored as int16 (whole meters) instead of
+    float32.
+    """
+
+    def __init__(self, store_directory, ref_grid, dtm_image_service, compact=False):
+        """
+        :param store_directory: directory to store the DTM in
+        :type store_directory: str
+        :param ref_grid: dict with full extent and pixel size of the snow service
+        :type ref_grid: dict
+        :param dtm_image_service: URL of the image service with the DTM
+        :type dtm_image_service: str
+        :param compact: store the DTM as int16 instead of float32
+        :type compact: bool
+        """
+        self.store_directory = Path(store_directory)
+        self.store_directory.mkdir(parents=True, exist_ok=True)
+        self.ref_grid = ref_grid
+        self.dtm_image_service = dtm_image_service
+        self.dtype = np.dtype(np.int16 if compact else np.float32)
+        self.shape = get_grid_size(ref_grid)[::-1]
+        grid_key = [dtm_image_service] + [
+            ref_grid[key]
+            for key in ("xmin", "ymin", "xmax", "ymax", "pixelSizeX", "pixelSizeY")
+        ]
+        self._key = hashlib.sha256(json.dumps(grid_key).encode("utf-8")).hexdigest()
+        self.dtm_path = (
+            self.store_directory / f"dtm_{self._key[:16]}_{self.dtype.name}.npy"
+        )
+        self._dtm = None
+        self._band_rasters = {}
+
+    def exists(self):
+        """Check if the DTM has been stored already"""
+        return self.dtm_path.exists()
+
+    def build(self, spatial_ref, cache=None, client=None):
+        """Download the DTM for the full extent and store it on the reference grid
+        The DTM is downloaded in tiles that do not exceed the export limits
+        of the image service.
+        """
+        dtm_service_description = query_image_server(
+            image_service=self.dtm_image_service,
+            print_metadata="service_description",
+            cache=cache,
+            client=client,
+        )
+        max_export = min(
+            dtm_service_description.get("maxImageWidth") or 4000,
+            dtm_service_description.get("maxImageHeight") or 4000,
+        )
+        tile_size = max(
+            1,
+            int(
+                max_export
+                * min(
+                    dtm_service_description["pixelSizeX"] / self.ref_grid["pixelSizeX"],
+                    dtm_service_description["pixelSizeY"] / self.ref_grid["pixelSizeY"],
+                )
+            )
+            - 1,
+        )
+        grid = dict(self.ref_grid, height=self.shape[0], width=self.shape[1])
+
+        tmp_path = self.dtm_path.with_suffix(".tmp.npy")
+        dtm = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=self.dtype, shape=self.shape
+        )
+        data_type = gdal.GDT_Int16 if self.dtype == np.int16 else gdal.GDT_Float32
+        for tile in split_window(grid, tile_size):
+            dtm[
+                tile["row_offset"] : tile["row_offset"] + tile["height"],
+                tile["col_offset"] : tile["col_offset"] + tile["width"],
+            ] = read_dtm(
+                tile,
+                self.dtm_image_service,
+                dtm_service_description,
+                spatial_ref,
+                cache=cache,
+                client=client,
+                data_type=data_type,
+            )
+        dtm.flush()
+        dtm = None
+        os.replace(tmp_path, self.dtm_path)
+
+    def _get_slice(self, window):
+        """Get the position of a window (aligned to the reference grid) in the store"""
+        row_offset = round(
+            (self.ref_grid["ymax"] - window["ymax"]) / self.ref_grid["pixelSizeY"]
+        )
+        col_offset = round(
+            (window["xmin"] - self.ref_grid["xmin"]) / self.ref_grid["pixelSizeX"]
+        )
+        height = round((window["ymax"] - window["ymin"]) / self.ref_grid["pixelSizeY"])
+        width = round((window["xmax"] - window["xmin"]) / self.ref_grid["pixelSizeX"])
+        return (
+            slice(row_offset, row_offset + height),
+            slice(col_offset, col_offset + width),
+        )
+
+    def contains(self, window):
+        """Check if a window lies within the extent of the store"""
+        rows, cols = self._get_slice(window)
+        return (
+            rows.start >= 0
+            and cols.start >= 0
+            and rows.stop <= self.shape[0]
+            and cols.stop <= self.shape[1]
+        )
+
+    def get_dtm(self, window):
+        """Get the DTM of a window as a (read-only) view of the memory-mapped store"""
+        if self._dtm is None:
+            self._dtm = np.load(self.dtm_path, mmap_mode="r")
+        return self._dtm[self._get_slice(window)]
+
+    def get_band_raster(self, window, band_edges):
+        """Get elevation band indices of a window for the given band edges
+        The band raster is computed from the stored DTM on first use and
+        stored next to it. Pixels below the lowest edge get index -1.
+        """
+        edges_key = hashlib.sha256(band_edges.tobytes()).hexdigest()[:16]
+        if edges_key not in self._band_rasters:
+            band_path = self.store_directory / f"bands_{self._key[:16]}_{edges_key}.npy"
+            if not band_path.exists():
+                self._build_band_raster(band_path, band_edges)
+            self._band_rasters[edges_key] = np.load(band_path, mmap_mode="r")
+        return self._band_rasters[edges_key][self._get_slice(window)]
+
+    def _build_band_raster(self, band_path, band_edges, chunk_rows=1024):
+        """Digitize the stored DTM into band indices chunk by chunk"""
+        dtm = np.load(self.dtm_path, mmap_mode="r")
+        tmp_path = band_path.with_suffix(".tmp.npy")
+        band_raster = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.int16, shape=self.shape
+        )
+        for row in range(0, self.shape[0], chunk_rows):
+            band_raster[row : row + chunk_rows] = (
+                np.digitize(dtm[row : row + chunk_rows], band_edges) - 1
+            )
+        band_raster.flush()
+        band_raster = None
+        os.replace(tmp_path, band_path)
+
+
+class SnowAccumulator:
+    """Accumulate fractional snow cover over several images pixel by pixel
+    Valid snow cover values (100-200 in the ImageServer encode 0-100 %) are
+    added to preallocated buffers in place, so memory use is about one image
+    plus the accumulators, independent of the number of images added.
+    Optionally, per-pixel minimum, maximum and last valid snow cover are kept
+    as composites.
+    In compact mode, sums are kept as the smallest unsigned integer type that
+    can hold ``max_images`` values of 100 % (uint16 for up to 655 images)
+    instead of float64, and the mean is returned as float32.
+    """
+
+    nodata = 255
+
+    def __init__(self, shape, max_images=255, keep_composites=False, compact=False):
+        """
+        :param shape: shape of the images to accumulate
+        :type shape: tuple
+        :param max_images: maximum number of images to accumulate, used
+                           to choose the data type of the counter
+        :type max_images: int
+        :param keep_composites: whether to keep per-pixel minimum, maximum
+                                and last valid snow cover
+        :type keep_composites: bool
+        :param compact: accumulate in unsigned integers instead of float64
+        :type compact: bool
+        """
+        self.images = 0
+        self.compact = compact
+        self.sum = np.zeros(
+            shape,
+            dtype=np.min_scalar_type(100 * max_images) if compact else np.float64,
+        )
+        self.count = np.zeros(shape, dtype=np.min_scalar_type(max_images))
+        self.keep_composites = keep_composites
+        if keep_composites:
+            self.min = np.full(shape, self.nodata, dtype=np.uint8)
+            self.max = np.zeros(shape, dtype=np.uint8)
+            self.last = np.zeros(shape, dtype=np.uint8)
+        # Buffers reused for every image
+        self._valid = np.empty(shape, dtype=np.bool_)
+        self._buffer = np.empty(shape, dtype=np.bool_)
+        self._value = np.zeros(shape, dtype=np.uint8)
+
+    def _read_values(self, img):
+        """Decode valid snow cover values of an image into the buffers"""
+        np.greater(img, 100, out=self._valid)
+        np.less_equal(img, 200, out=self._buffer)
+        np.logical_and(self._valid, self._buffer, out=self._valid)
+        np.subtract(img, 100, out=self._value, where=self._valid, casting="unsafe")
+
+    def add(self, img):
+        """Add valid snow cover values of an image to the accumulators"""
+        self._read_values(img)
+        np.add(self.sum, self._value, out=self.sum, where=self._valid)
+        np.add(self.count, 1, out=self.count, where=self._valid)
+        if self.keep_composites:
+            np.minimum(self.min, self._value, out=self.min, where=self._valid)
+            np.maximum(self.max, self._value, out=self.max, where=self._valid)
+            np.copyto(self.last, self._value, where=self._valid)
+        self.images += 1
+
+    def remove(self, img):
+        """Remove valid snow cover values of a previously added image
+        Used to move a time window without adding all images again. Composites
+        cannot be reverted, so this is only possible without composites.
+        """
+        if self.keep_composites:
+            raise RuntimeError("Composites cannot be reverted.")
+        self._read_values(img)
+        np.subtract(self.sum, self._value, out=self.sum, where=self._valid)
+        np.subtract(self.count, 1, out=self.count, where=self._valid)
+        self.images -= 1
+
+    def save(self, path, object_ids):
+        """Save the accumulators together with the IDs of the added images"""
+        if self.keep_composites:
+            raise RuntimeError("Composites cannot be saved.")
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            sum=self.sum,
+            count=self.count,
+            object_ids=np.asarray(object_ids, dtype=np.int64),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_images=255, compact=False):
+        """Restore an accumulator saved with ``save``
+        :return: accumulator and list of IDs of the images added to it
+        :rtype: tuple
+        """
+        with np.load(path) as state:
+            object_ids = state["object_ids"].tolist()
+            accumulator = cls(
+                state["sum"].shape,
+                max_images=max(max_images, len(object_ids)),
+                compact=compact,
+            )
+            accumulator.sum[...] = state["sum"]
+            accumulator.count[...] = state["count"]
+        accumulator.images = len(object_ids)
+        return accumulator, object_ids
+
+    def mean(self):
+        """Return per-pixel mean snow cover (0 where no valid value was added)"""
+        mean = np.zeros(
+            self.sum.shape, dtype=np.float32 if self.compact else np.float64
+        )
+        np.divide(self.sum, self.count, out=mean, where=self.count != 0)
+        return mean
+
+    def get_composites(self):
+        """Return per-pixel minimum, maximum and last valid snow cover
+        Pixels without any valid value are set to ``nodata``
+        :return: dict with composite name as key and numpy array as value
+        :rtype: dict
+        """
+        if not self.keep_composites:
+            raise RuntimeError("Composites are not kept by this accumulator.")
+        no_value = self.count == 0
+        composites = {}
+        for name, composite in {
+            "min": self.min,
+            "max": self.max,
+            "last": self.last,
+        }.items():
+            composite = composite.copy()
+            composite[no_value] = self.nodata
+            composites[name] = composite
+        return composites
+
+
+def get_state_path(state_directory, image_service, window, window_days, aoi_key=None):
+    """Get the path to the saved accumulator state of a window
+    The state only depends on the pixels of the window and the length of the
+    time period, so it is shared by all AOIs with the same window, unless
+    only pixels within the AOI are accumulated (``aoi_key`` is given).
+    """
+    state_key = [
+        image_service,
+        window["bbox"],
+        window["pixelSizeX"],
+        window["pixelSizeY"],
+        window_days,
+    ]
+    if aoi_key:
+        state_key.append(aoi_key)
+    digest = hashlib.sha256(json.dumps(state_key).encode("utf-8")).hexdigest()
+    return Path(state_directory) / f"snow_{digest[:16]}.npz"
+
+
+def create_composite_rasters(reference_grid, spatial_ref, output_directory):
+    """Create GeoTIFF files for snow cover composites of the reference grid"""
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    composite_rasters = {}
+    for name in ("min", "max", "last"):
+        target_ds = create_gdal_raster(
+            reference_grid,
+            spatial_ref,
+            gdal.GDT_Byte,
+            ds_name=str(output_directory / f"snow_{name}.tif"),
+            driver_name="GTiff",
+        )
+        target_band = target_ds.GetRasterBand(1)
+        target_band.SetNoDataValue(SnowAccumulator.nodata)
+        target_band.Fill(SnowAccumulator.nodata)
+        composite_rasters[name] = target_ds
+    return composite_rasters
+
+
+def write_composites(accumulator, composite_rasters, tile, pixel_index=None):
+    """Write snow cover composites of an accumulator into the composite rasters
+    at the position of the tile (scattering pixels gathered with pixel_index
+    back onto the tile)"""
+    for name, composite in accumulator.get_composites().items():
+        if pixel_index is not None:
+            tile_composite = np.full(
+                (tile["height"], tile["width"]), accumulator.nodata, dtype=np.uint8
+            )
+            tile_composite.flat[pixel_index] = composite
+            composite = tile_composite
+        composite_rasters[name].GetRasterBand(1).WriteArray(
+            composite, xoff=tile.get("col_offset", 0), yoff=tile.get("row_offset", 0)
+        )
+
+
+def get_band_edges(
+    snow_bands=250, snow_band_edges=None, min_elevation=-500, max_elevation=9000
 ):
-    logger.info("Beregner verdier for klasse {}".format(class_nr))
-    logger.info("Klassens minimumshøyde er {}m".format(snow_min_elevation))
-    logger.info("Klassens maximumshøyde er {}m".format(snow_max_elevation))
+    """Get edges of the elevation bands to compute snow cover for
+    :param snow_bands: Altitude steps (bands) in meter, used for uniform
+                       bands (multiples of snow_bands) from ``min_elevation``
+                       to ``max_elevation``
+    :type snow_bands: int
+    :param snow_band_edges: ascending altitudes in meter of (non-uniform)
+                            band edges, overrides ``snow_bands``
+    :type snow_band_edges: list
+    :return: 1-D numpy array with band edges, band i covers
+             edges[i] <= elevation <= edges[i + 1] (see ``SnowStatistics``)
+    :rtype: numpy.ndarray
+    """
+    if snow_band_edges:
+        band_edges = np.asarray(snow_band_edges, dtype=np.float64)
+        if band_edges.size < 2 or np.any(np.diff(band_edges) <= 0):
+            raise ValueError("Høydegrensene må være minst to stigende verdier.")
+        return band_edges
+    return np.arange(
+        np.floor(min_elevation / snow_bands) * snow_bands,
+        max_elevation + snow_bands,
+        snow_bands,
+        dtype=np.float64,
+    )
+
 
-    np_dtm_class_ma = np.ma.masked_where(
-        (np_dtm < snow_min_elevation) | (np_dtm > snow_max_elevation), np_dtm, copy=True
+class PartialStatistics:
+    """Count, sum, minimum and maximum of values per zone
+    All statistics are numpy arrays with one element per zone. Partial
+    statistics of separate parts of the data can be merged.
+    """
+
+    def __init__(self, n_zones=1):
+        self.count = np.zeros(n_zones, dtype=np.int64)
+        self.sum = np.zeros(n_zones, dtype=np.float64)
+        self.min = np.full(n_zones, np.inf)
+        self.max = np.full(n_zones, -np.inf)
+
+    def update(self, values, zones=None):
+        """Add values to the statistics in one pass over the data
+        :param values: 1-D numpy array of values
+        :type values: numpy.ndarray
+        :param zones: 1-D numpy array with the zone index (0 ... n_zones - 1)
+                      of each value, None if all values belong to the first zone
+        :type zones: numpy.ndarray
+        """
+        if not values.size:
+            return self
+        n_zones = self.count.size
+        if zones is None or n_zones == 1:
+            self.count[0] += values.size
+            self.sum[0] += values.sum(dtype=np.float64)
+            self.min[0] = min(self.min[0], values.min())
+            self.max[0] = max(self.max[0], values.max())
+            return self
+        self.count += np.bincount(zones, minlength=n_zones)
+        self.sum += np.bincount(zones, weights=values, minlength=n_zones)
+        np.minimum.at(self.min, zones, values)
+        np.maximum.at(self.max, zones, values)
+        return self
+
+    def merge(self, other):
+        """Merge partial statistics of another part of the data"""
+        self.count += other.count
+        self.sum += other.sum
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def mean(self):
+        """Return mean of the values per zone (NaN for zones without values)"""
+        mean = np.full(self.sum.shape, np.nan)
+        np.divide(self.sum, self.count, out=mean, where=self.count > 0)
+        return mean
+
+
+class SnowStatistics:
+    """Mergeable statistics of snow cover per zone of an Area of Interest
+    Holds the number of pixels in each zone, statistics and a histogram
+    (1 % bins) of snow cover percentage in pixels with snow, statistics of
+    terrain elevation in pixels with snow, and snow cover statistics per
+    elevation band. Statistics of tiles merged together give the same result
+    as statistics of the whole Area of Interest. Elevation bands include
+    both edges, so pixels on the edge between two bands count in both.
+    """
+
+    band_statistics_dtype = [
+        ("lower", "float64"),
+        ("upper", "float64"),
+        ("count", "int64"),
+        ("mean", "float64"),
+        ("min", "float64"),
+        ("max", "float64"),
+    ]
+
+    def __init__(self, band_edges, n_zones=1):
+        """
+        :param band_edges: edges of the elevation bands to compute snow cover
+                           for (as returned by ``get_band_edges``)
+        :type band_edges: numpy.ndarray
+        :param n_zones: number of zones (features) in the Area of Interest
+        :type n_zones: int
+        """
+        self.band_edges = band_edges
+        self.n_bands = len(band_edges) - 1
+        self.n_zones = n_zones
+        self.area_count = np.zeros(n_zones, dtype=np.int64)
+        self.snow = PartialStatistics(n_zones)
+        self.elevation = PartialStatistics(n_zones)
+        # Statistics per band and zone (index: zone * n_bands + band)
+        self.bands = PartialStatistics(n_zones * self.n_bands)
+        self.histogram = np.zeros((n_zones, 101), dtype=np.int64)
+
+    def update(self, np_snow_ma, zone_raster, np_dtm=None, band_raster=None):
+        """Add statistics of a tile
+        :param np_snow_ma: snow cover percentage, masked where pixels are
+                           outside the Area of Interest or without snow
+        :type np_snow_ma: numpy.ma.MaskedArray
+        :param zone_raster: zone number (1 ... n_zones) of the pixels, 0 (or
+                            False) outside the Area of Interest
+        :type zone_raster: numpy.ndarray
+        :param np_dtm: terrain elevation on the grid of the tile
+        :type np_dtm: numpy.ndarray
+        :param band_raster: precomputed elevation band indices of the tile
+                            (computed from ``np_dtm`` if not given)
+        :type band_raster: numpy.ndarray
+        """
+        self.area_count += np.bincount(
+            zone_raster.ravel().astype(np.intp), minlength=self.n_zones + 1
+        )[1:]
+        snow_mask = ~np.ma.getmaskarray(np_snow_ma)
+        snow_values = np_snow_ma.data[snow_mask]
+        if snow_values.size == 0:
+            return self
+        snow_zones = zone_raster[snow_mask].astype(np.intp) - 1
+        self.snow.update(snow_values, snow_zones)
+        self.histogram += np.bincount(
+            snow_zones * 101 + snow_values.astype(np.intp),
+            minlength=self.n_zones * 101,
+        ).reshape(self.n_zones, 101)
+        if np_dtm is None:
+            return self
+
+        dtm_values = np_dtm[snow_mask]
+        self.elevation.update(dtm_values, snow_zones)
+
+        # Digitize elevation into bands once and reduce per zone and band
+        if band_raster is None:
+            snow_classes = np.digitize(dtm_values, self.band_edges) - 1
+        else:
+            snow_classes = band_raster[snow_mask].astype(np.intp)
+        in_bands = (snow_classes >= 0) & (snow_classes < self.n_bands)
+        # Bands include both edges, so pixels with the elevation of the edge
+        # between two bands count in both bands
+        on_edge = (snow_classes > 0) & (snow_classes <= self.n_bands)
+        on_edge[on_edge] = dtm_values[on_edge] == self.band_edges[snow_classes[on_edge]]
+        self.bands.update(
+            np.concatenate((snow_values[in_bands], snow_values[on_edge])),
+            np.concatenate(
+                (
+                    snow_zones[in_bands] * self.n_bands + snow_classes[in_bands],
+                    snow_zones[on_edge] * self.n_bands + snow_classes[on_edge] - 1,
+                )
+            ),
+        )
+        return self
+
+    def merge(self, other):
+        """Merge statistics of another tile"""
+        self.area_count += other.area_count
+        self.snow.merge(other.snow)
+        self.elevation.merge(other.elevation)
+        self.bands.merge(other.bands)
+        self.histogram += other.histogram
+        return self
+
+    def get_band_statistics(self, zone=0):
+        """Get snow statistics per elevation band of a zone
+        :return: structured numpy array with lower and upper band edge, count,
+                 mean, min and max of snow cover percentage for bands with snow
+        :rtype: numpy.ndarray
+        """
+        zone_bands = slice(zone * self.n_bands, (zone + 1) * self.n_bands)
+        band_statistics = np.zeros(self.n_bands, dtype=self.band_statistics_dtype)
+        band_statistics["lower"] = self.band_edges[:-1]
+        band_statistics["upper"] = self.band_edges[1:]
+        band_statistics["count"] = self.bands.count[zone_bands]
+        band_statistics["mean"] = self.bands.mean()[zone_bands]
+        band_statistics["min"] = self.bands.min[zone_bands]
+        band_statistics["max"] = self.bands.max[zone_bands]
+        return band_statistics[band_statistics["count"] > 0]
+
+
+def estimate_coarse_error(snow_statistics, zone=0, coarse_factor=1, px_area=1.0):
+    """Estimate standard errors of statistics computed on a coarser grid
+    Pixels of a grid coarsened by ``coarse_factor`` are treated as a sample
+    of 1 / coarse_factor**2 of the pixels at full resolution (the ImageServer
+    resamples with nearest neighbour), so standard errors follow from
+    sampling without replacement. Spatially correlated snow cover usually
+    gives smaller errors than estimated.
+    :return: standard errors of snow_mean_percentage (in percentage points)
+             and of snow_area (in km2)
+    :rtype: dict
+    """
+    finite_population = 1 - 1 / coarse_factor**2
+    area_count = int(snow_statistics.area_count[zone])
+    snow_count = int(snow_statistics.snow.count[zone])
+    snow_share = snow_count / area_count
+    # Variance of snow cover from the histogram (1 % bins)
+    histogram = snow_statistics.histogram[zone]
+    bin_centers = np.minimum(np.arange(histogram.size) + 0.5, 100)
+    variance = float(
+        np.sum(histogram * (bin_centers - snow_statistics.snow.mean()[zone]) ** 2)
+        / snow_count
     )
+    share_error = sqrt(snow_share * (1 - snow_share) / area_count * finite_population)
+    return {
+        "snow_mean_percentage": round(
+            sqrt(variance / snow_count * finite_population), 2
+        ),
+        "snow_area": round(share_error * area_count * px_area / 1000000, 4),
+    }
 
-    mask = np.ma.getmask(np_dtm_class_ma)
-    np_snow_ma_ma = np.ma.MaskedArray(np_snow_ma, mask)
 
-    snow_class_mean_percentage = round(np_snow_ma_ma.mean(), 2)
-    snow_class_min_percentage = np_snow_ma_ma.min()
-    snow_class_max_percentage = np_snow_ma_ma.max()
+def get_result_dict(
+    snow_statistics,
+    zone=0,
+    px_area=1.0,
+    min_snow_percent=20.0,
+    include_histogram=False,
+    dtm_failed=False,
+    coarse_factor=1,
+    drop_zero_band=False,
+):
+    """Compile snow statistics of a zone to a dictionary for output
+    Statistics computed on a grid coarsened by ``coarse_factor`` get an
+    estimate of their error against full resolution ("_error_estimate").
+    With ``drop_zero_band``, the elevation band starting at 0 m is not
+    reported (as for uniform bands before tiling).
+    """
+    snow_count = int(snow_statistics.snow.count[zone])
+    if snow_count == 0:
+        raise Exception(
+            "Fant ingen gyldige piksler. Dette er enten fordi det ikke finnes raster for valgt dato eller at angitt polygon ikke overlapper med raster."
+        )
+
+    res_dict = {
+        "snow_area": float(snow_count * px_area / 1000000),
+        "snow_mean_percentage": float(round(snow_statistics.snow.mean()[zone], 2)),
+        "snow_min_percentage": float(round(snow_statistics.snow.min[zone], 2)),
+        "snow_max_percentage": float(round(snow_statistics.snow.max[zone], 2)),
+    }
 
     logger.info(
-        "Klassens gjennomsnittlig snøprosent er {}%".format(snow_class_mean_percentage)
+        "Gjennomsnittlig snøprosent er {}%".format(res_dict["snow_mean_percentage"])
     )
-    logger.info("Klassens minimum snøprosent er {}%".format(snow_class_min_percentage))
-    logger.info("Klassens maximum snøprosent er {}%".format(snow_class_max_percentage))
+    logger.info("Minimum snøprosent er {}%".format(res_dict["snow_min_percentage"]))
+    logger.info("Maximum snøprosent er {}%".format(res_dict["snow_max_percentage"]))
 
-    return (
-        snow_class_mean_percentage,
-        snow_class_min_percentage,
-        snow_class_max_percentage,
+    # The analysis area is the snow covered area as before tiling (so
+    # area_with_snow is 100 %), the pixels of the AOI are in area_count
+    res_dict["area_complete"] = float(snow_count * px_area / 1000000)
+
+    logger.info(
+        "Areal for piklser med minst {min_snow}% snø er {areal}km2".format(
+            min_snow=min_snow_percent, areal=res_dict["snow_area"]
+        )
     )
+    logger.info("Analyseareal er {}km2".format(res_dict["area_complete"]))
+
+    res_dict["area_with_snow"] = float(
+        round(res_dict["snow_area"] / res_dict["area_complete"] * 100, 2)
+    )
+
+    if coarse_factor > 1:
+        res_dict["coarse_factor"] = coarse_factor
+        res_dict["_error_estimate"] = estimate_coarse_error(
+            snow_statistics, zone, coarse_factor, px_area
+        )
+
+    if include_histogram:
+        res_dict["snow_percentage_histogram"] = snow_statistics.histogram[zone].tolist()
+
+    # Find elevation for pixels with snow
+    res_dict["snow_mean_elevation"] = -9999
+    res_dict["snow_min_elevation"] = -9999
+    res_dict["snow_max_elevation"] = -9999
+
+    # TODO: Hva skal man sette her som grense og skal det være en grense i det hele tatt?
+    if dtm_failed or snow_statistics.elevation.count[zone] == 0:
+        logger.warning("Fant ingen terrenghøyde for piksler med snø.")
+    elif (res_dict["snow_min_percentage"]) > 0:
+        res_dict["snow_mean_elevation"] = float(
+            round(snow_statistics.elevation.mean()[zone], 2)
+        )
+        res_dict["snow_min_elevation"] = float(
+            round(snow_statistics.elevation.min[zone], 2)
+        )
+        res_dict["snow_max_elevation"] = float(
+            round(snow_statistics.elevation.max[zone], 2)
+        )
+
+        logger.info(
+            "Gjennomsnittlig terrenghøyde med snø er {} meter".format(
+                res_dict["snow_mean_elevation"]
+            )
+        )
+        logger.info(
+            "Laveste terrenghøyde med snø er {} meter".format(
+                res_dict["snow_min_elevation"]
+            )
+        )
+        logger.info(
+            "Høyeste terrenghøyde med snø er {} meter".format(
+                res_dict["snow_max_elevation"]
+            )
+        )
+
+        band_statistics = snow_statistics.get_band_statistics(zone)
+        if drop_zero_band:
+            band_statistics = band_statistics[band_statistics["lower"] != 0]
+
+        snow_diff_elevation = (
+            res_dict["snow_max_elevation"] - res_dict["snow_min_elevation"]
+        ) / max(len(band_statistics), 1)
+        logger.info("snow_diff_elevation er {} meter".format(snow_diff_elevation))
+
+        for snow_class in band_statistics:
+            snow_class_name = "snow_{:g}m_to_{:g}m".format(
+                snow_class["lower"], snow_class["upper"]
+            )
+            logger.info("Klassens minimumshøyde er {:g}m".format(snow_class["lower"]))
+            logger.info("Klassens maximumshøyde er {:g}m".format(snow_class["upper"]))
+
+            res_dict[f"{snow_class_name}_mean_percentage"] = float(
+                round(snow_class["mean"], 2)
+            )
+            res_dict[f"{snow_class_name}_min_percentage"] = float(snow_class["min"])
+            res_dict[f"{snow_class_name}_max_percentage"] = float(snow_class["max"])
+
+            logger.info(
+                "Klassens gjennomsnittlig snøprosent er {}%".format(
+                    res_dict[f"{snow_class_name}_mean_percentage"]
+                )
+            )
+    else:
+        logger.warning(
+            "Minimum snøprosent er {}. Beregner derfor ikke høyde".format(
+                res_dict["snow_min_percentage"]
+            )
+        )
+
+    return res_dict
 
 
 logger = setup_logging()
 
-DATA_TYPES = {
-    "U1": gdal.GDT_Byte,
-    "U2": gdal.GDT_Byte,
-    "U4": gdal.GDT_Byte,
-    "U8": gdal.GDT_Byte,
-    "U16": gdal.GDT_UInt16,
-    "U32": gdal.GDT_UInt32,
-    "S8": gdal.GDT_Byte,
-    "S16": gdal.GDT_Int16,
-    "S32": gdal.GDT_Int32,
-    "F32": gdal.GDT_Float32,
-    "F64": gdal.GDT_Float64,
-    "C64": gdal.GDT_CFloat64,
-    "C128": gdal.GDT_CFloat64,
-    # gdal.GDT_CFloat32
-    # gdal.GDT_CFloat64
-    # gdal.GDT_CInt16
-    # gdal.GDT_CInt32
-    "UNKNOWN": gdal.GDT_Unknown,
-}
-
-
-def main():
-    """Do the main work"""
-    # User defined variables
-    aoi = "./data/aoi.geojson"  # Path to GeoJSON with AOI could also be a WKT Polygon or shape file....
-    server = (
-        "http://gis3.nve.no/image/rest/services/ImageService/"  # defaults to is3.nve.no
-    )
-    dtm_service = "AuxDEM250"  # url to image service with DTM
-    snow_service = "S3_SLSTR_fsc_sa"
-    date_start = (datetime.now() - timedelta(days=3)).strftime(
-        "%Y-%m-%d"
-    )  # "2022-06-27"  # date in iso-format (without time)
-    date_end = (datetime.now() - timedelta(days=0)).strftime(
-        "%Y-%m-%d"
-    )  # "2022-06-27"  # date in iso-format (without time)
-    min_snow_percent = 20.0
+
+@lru_cache(maxsize=None)
+def get_data_type(pixel_type):
+    """Get the GDAL data type of an ImageServer pixel type (e.g. "U8")"""
+    data_types = {
+        "U1": gdal.GDT_Byte,
+        "U2": gdal.GDT_Byte,
+        "U4": gdal.GDT_Byte,
+        "U8": gdal.GDT_Byte,
+        "U16": gdal.GDT_UInt16,
+        "U32": gdal.GDT_UInt32,
+        "S8": gdal.GDT_Byte,
+        "S16": gdal.GDT_Int16,
+        "S32": gdal.GDT_Int32,
+        "F32": gdal.GDT_Float32,
+        "F64": gdal.GDT_Float64,
+        "C64": gdal.GDT_CFloat64,
+        "C128": gdal.GDT_CFloat64,
+        # gdal.GDT_CFloat32
+        # gdal.GDT_CFloat64
+        # gdal.GDT_CInt16
+        # gdal.GDT_CInt32
+    }
+    return data_types.get(pixel_type, gdal.GDT_Unknown)
+
+
+def write_timeseries(results, output_path):
+    """Write results per acquisition date as a long table for bulk loading
+    Every statistic becomes one row with the columns date, aoi_id, variable
+    and value (histogram bins become one variable each). The format is
+    chosen from the file extension: .csv, .parquet or JSON lines (.jsonl or
+    .json).
+    :param results: list of result dicts with "date" and "aoi_id" keys
+    :type results: list
+    :param output_path: path to the output file
+    :type output_path: str
+    """
+    rows = []
+    for result in results:
+        for variable, value in result.items():
+            if variable in ("date", "aoi_id"):
+                continue
+            if isinstance(value, list):
+                values = {f"{variable}_{idx}": item for idx, item in enumerate(value)}
+            elif isinstance(value, dict):
+                values = {f"{variable}_{key}": item for key, item in value.items()}
+            else:
+                values = {variable: value}
+            rows.extend(
+                {
+                    "date": result["date"],
+                    "aoi_id": result["aoi_id"],
+                    "variable": name,
+                    "value": item,
+                }
+                for name, item in values.items()
+            )
+
+    output_path = Path(output_path)
+    if output_path.suffix == ".csv":
+        with open(output_path, "w", newline="", encoding="utf-8") as output_file:
+            csv_writer = csv.DictWriter(
+                output_file, fieldnames=["date", "aoi_id", "variable", "value"]
+            )
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
+    elif output_path.suffix == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Skriving til Parquet krever pyarrow.")
+        pq.write_table(pa.Table.from_pylist(rows), output_path)
+    elif output_path.suffix in (".jsonl", ".json"):
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            for row in rows:
+                output_file.write(json.dumps(row) + "\n")
+    else:
+        raise ValueError(
+            "Ukjent filformat for tidsserie: {}".format(output_path.suffix)
+        )
+
+
+def main(
+    # Path to GeoJSON with AOI could also be a WKT Polygon or shape file....
+    aoi="./data/aoi.geojson",
+    # defaults to is3.nve.no
+    server="http://gis3.nve.no/image/rest/services/ImageService/",
+    # url to image service with DTM
+    dtm_service="AuxDEM250",
+    snow_service="S3_SLSTR_fsc_sa",
+    # date in iso-format (without time), e.g. "2022-06-27" (None for three days ago)
+    date_start=None,
+    # date in iso-format (without time), e.g. "2022-06-27" (None for today)
+    date_end=None,
+    min_snow_percent=20.0,
     # Probably more userfriendly for generate relatable height intervals dynamically and
     # let user define height intervals here
-    snow_bands = 250
+    snow_bands=250,
+    # Edges of non-uniform altitude bands in meter (overrides snow_bands), e.g.
+    # [0, 300, 600, 1000, 1500, 2500]
+    snow_band_edges=None,
+    # Number of images to download in parallel
+    nprocs=4,
+    # Directory to write per-pixel min, max and last valid snow cover to (None to skip)
+    composite_directory=None,
+    # Size of tiles (in pixels) to process one by one (None to process the whole
+    # Area of Interest at once if it does not exceed the ImageServer export limits)
+    tile_size=None,
+    # Include histogram of snow cover percentage (1 % bins) in output
+    include_histogram=False,
+    # Directory for caching responses from the ImageServer (None to disable caching)
+    cache_directory=None,
+    # Maximum size of the cache in MB
+    cache_size=2048,
+    # Directory to store the DTM resampled to the snow grid in (None to download
+    # the DTM for every request), the DTM is downloaded on first use
+    dtm_directory=None,
+    # Directory to save per-pixel sums and counts in, so the next run with the
+    # same length of time period only reads new and expired images (None to
+    # read all images in every run)
+    state_directory=None,
+    # Directory to store rasterized (bit-packed) AOI masks in (None to rasterize
+    # the AOI in every run)
+    mask_directory=None,
+    # Timeout for requests to the ImageServer in seconds
+    timeout=60,
+    # Number of retries (with exponential backoff) of failed requests to the ImageServer
+    retries=3,
+    # Only process pixels within the AOI (gathered into 1-D arrays), faster for
+    # long, narrow AOIs like river corridors
+    sparse=False,
+    # Keep images as uint8, accumulate in unsigned integers, compute the mean
+    # as float32 and store the DTM as int16 (whole meters) to reduce memory use
+    compact=False,
+    # Compute statistics on a grid coarser by this factor (e.g. 4 for 4 x 4
+    # pixels) for quick estimates, results get an estimated error against full
+    # resolution
+    coarse_factor=1,
+    # Measure time per stage, bytes downloaded, images read, pixels processed and
+    # cache hits (logged and added as "_metrics" to the result)
+    include_metrics=False,
+    # Where to average images: "client" (download every image) or "server" (let
+    # the ImageServer average the images with a mosaic rule, falls back to the
+    # client if the server does not support it)
+    backend="client",
+    # Compute statistics for each feature in the AOI (one result per feature)
+    per_feature=False,
+    # Attribute column with IDs of the features in the AOI (None to use the FID)
+    feature_id_column=None,
+    # Compute statistics for each acquisition date in the time period (time series)
+    timeseries=False,
+    # File to write the time series to as long table (.csv, .parquet or .jsonl)
+    timeseries_output=None,
+):
+    """Do the main work
+    The keyword arguments are the user defined variables, so a worker (see
+    run_worker) can run several jobs with different settings in one process.
+    """
     # Currently not used
     # ws = "in_memory"
+    if date_start is None:
+        date_start = (datetime.now() - timedelta(days=3)).strftime("%Y-%m-%d")
+    if date_end is None:
+        date_end = (datetime.now() - timedelta(days=0)).strftime("%Y-%m-%d")
+
+    metrics.reset(enabled=include_metrics)
 
     if not Path(aoi).exists():
         raise Exception("Finner ikke {}. Sjekk filnavn og sti.".format(aoi))
 
+    if int(coarse_factor) != coarse_factor or coarse_factor < 1:
+        raise Exception("Parameter 'coarse_factor' må være et heltall fra 1.")
+
+    band_edges = get_band_edges(snow_bands, snow_band_edges)
+
     if not date_start:
         raise Exception("Parameter 'start dato' mangler.")
     else:
@@ -409,9 +2231,17 @@ def main():
     image_server = "{server}/{service}/ImageServer/"
 
     snow_image_service = image_server.format(server=server, service=snow_service)
-    snow_service_description = query_image_server(
-        image_service=snow_image_service, print_metadata="service_description"
+    cache = (
+        ImageServerCache(cache_directory, max_size=cache_size * 1024**2)
+        if cache_directory
+        else None
     )
+    client = get_client(timeout=timeout, retries=retries)
+
+    with metrics.stage("metadata"):
+        snow_service_description = get_service_description(
+            snow_image_service, cache=cache, client=client
+        )
 
     # Get spatial reference of ImageServer
     spatial_ref = osr.SpatialReference()
@@ -420,208 +2250,381 @@ def main():
     )
 
     # Get Area of interest
-    aoi_reproj = reproject_geojson(aoi, spatial_ref)
-    aoi_layer = aoi_reproj.GetLayerByIndex(0)
-    aoi_dict = {}
-    (
-        aoi_dict["xmin"],
-        aoi_dict["xmax"],
-        aoi_dict["ymin"],
-        aoi_dict["ymax"],
-        aoi_dict["is_latlong"],
-    ) = (*aoi_layer.GetExtent(), bool(spatial_ref.IsGeographic()))
+    aoi_key = get_aoi_key(aoi)
+    with metrics.stage("aoi"):
+        aoi_reproj = aoi_cache.reproject(aoi, spatial_ref, aoi_key=aoi_key)
+        aoi_layer = aoi_reproj.GetLayerByIndex(0)
+        aoi_dict = {}
+        (
+            aoi_dict["xmin"],
+            aoi_dict["xmax"],
+            aoi_dict["ymin"],
+            aoi_dict["ymax"],
+            aoi_dict["is_latlong"],
+        ) = (*aoi_layer.GetExtent(), bool(spatial_ref.IsGeographic()))
 
     # Create a reference grid to operate on (extent, resolution, rows, cols)
-    ref_grid = snow_service_description["fullExtent"]
+    ref_grid = snow_service_description["fullExtent"].copy()
     ref_grid["is_latlong"] = bool(spatial_ref.IsGeographic())
     ref_grid["pixelSizeX"], ref_grid["pixelSizeY"] = (
-        snow_service_description["pixelSizeX"],
-        snow_service_description["pixelSizeY"],
+        snow_service_description["pixelSizeX"] * coarse_factor,
+        snow_service_description["pixelSizeY"] * coarse_factor,
     )
+    # A coarser grid has the same origin as the grid of the service and the
+    # AOI is aligned to that origin (see align_windows), so its pixels are
+    # nested in the pixels of the service and the ImageServer can read the
+    # images from overviews
 
     # Align Area of Interest to reference grid
     raster_aoi = align_windows(aoi_dict, ref_grid)
 
-    # Rasterize Area of interest on reference grid to be sed as mask
-    raster_mask = rasterize_aoi(raster_aoi, aoi_reproj, spatial_ref)
-
-    # Get a list of images for the requested time period from the server
-    images = query_image_server(
-        image_service=snow_image_service, query_params=query, aoi=raster_aoi
+    # Split Area of Interest into tiles that can be exported from the ImageServer
+    max_tile_size = min(
+        snow_service_description.get("maxImageWidth") or raster_aoi["width"],
+        snow_service_description.get("maxImageHeight") or raster_aoi["height"],
     )
-
-    # Create an empty numpy array
-    np_snow = np.zeros(raster_mask.shape)
-    np_snow_valid_count = np.zeros(raster_mask.shape, dtype=np.byte)
-
-    # Read images to array and compute average value over available images
-    for i in images.values():
-        img_ds = gdal.Open(f"/vsicurl/{i}")
-        img_ds = np.array(img_ds.ReadAsArray())
-        np_snow += np.where((img_ds > 100) & (img_ds <= 200), img_ds - 100, 0)
-        np_snow_valid_count += np.where((img_ds > 100) & (img_ds <= 200), 1, 0).astype(
-            np.bool_
-        )
-        img_ds = None
-    np_snow = np.divide(np_snow, np_snow_valid_count, where=np_snow_valid_count != 0)
-
-    try:
-        # Ekstra test siden extract by mask ikke feiler i Desktop
-        # bare pixler fra og med brukerdefinert grenseverdi skal være med
-        np_snow_ma = np.ma.masked_where(np_snow < min_snow_percent, np_snow, copy=True)
-        if np_snow_ma.count() == 0:
-            raise Exception(
-                "Fant ingen gyldige piksler. Dette er enten fordi det ikke finnes raster for valgt dato eller at angitt polygon ikke overlapper med raster."
+    if max(raster_aoi["width"], raster_aoi["height"]) > max_tile_size:
+        tile_size = min(tile_size or max_tile_size, max_tile_size)
+    tiles = split_window(raster_aoi, tile_size)
+    logger.info("Analyseområdet behandles i {} fliser".format(len(tiles)))
+
+    # Get IDs of images for the requested time period from the server
+    with metrics.stage("id_query"):
+        if timeseries:
+            # Group images by acquisition date to compute statistics per date
+            image_groups = query_acquisition_dates(
+                snow_image_service,
+                query_params=query,
+                object_id_field=snow_service_description.get(
+                    "objectIdField", "OBJECTID"
+                ),
+                cache=cache,
+                client=client,
             )
-
-        px_area = raster_aoi["pixelSizeX"] * raster_aoi["pixelSizeY"]
-
-        res_dict = {
-            "snow_area": float(np_snow_ma.count() * px_area / 1000000),
-            "snow_mean_percentage": float(round(np_snow_ma.mean(), 2)),
-            "snow_min_percentage": float(round(np_snow_ma.min(), 2)),
-            "snow_max_percentage": float(round(np_snow_ma.max(), 2)),
-        }
-
-        logger.info(
-            "Gjennomsnittlig snøprosent er {}%".format(res_dict["snow_mean_percentage"])
-        )
-        logger.info("Minimum snøprosent er {}%".format(res_dict["snow_min_percentage"]))
-        logger.info("Maximum snøprosent er {}%".format(res_dict["snow_max_percentage"]))
-
-        # np_snow_ma_non_zero = np.ma.masked_where(np_snow > 254, np_snow, copy=True)
-        res_dict["area_complete"] = float(np_snow_ma.count() * px_area / 1000000)
-
-        logger.info(
-            "Areal for piklser med minst {min_snow}% snø er {areal}km2".format(
-                min_snow=min_snow_percent, areal=res_dict["snow_area"]
+            object_ids = [i for group_ids in image_groups.values() for i in group_ids]
+            logger.info("Tidsserie med {} opptaksdatoer".format(len(image_groups)))
+        else:
+            object_ids = query_image_server(
+                image_service=snow_image_service,
+                query_params=query,
+                print_metadata="object_ids",
+                service_description=snow_service_description,
+                cache=cache,
+                client=client,
             )
-        )
-        logger.info("Analyseareal er {}km2".format(res_dict["area_complete"]))
+            image_groups = {None: object_ids}
 
-        res_dict["area_with_snow"] = float(
-            round(res_dict["snow_area"] / res_dict["area_complete"] * 100, 2)
+    if composite_directory:
+        composite_rasters = create_composite_rasters(
+            raster_aoi, spatial_ref, composite_directory
         )
 
-        # Find elevation for pixels with snow
-        res_dict["snow_mean_elevation"] = -9999
-        res_dict["snow_min_elevation"] = -9999
-        res_dict["snow_max_elevation"] = -9999
-
-        # TODO: Hva skal man sette her som grense og skal det være en grense i det hele tatt?
-        try:
-            if (res_dict["snow_min_percentage"]) > 0:
+    dtm_image_service = image_server.format(server=server, service=dtm_service)
+    dtm_service_description = None
+    dtm_store = (
+        DTMStore(dtm_directory, ref_grid, dtm_image_service, compact=compact)
+        if dtm_directory
+        else None
+    )
+    dtm_failed = False
 
-                dtm_image_service = image_server.format(
-                    server=server, service=dtm_service
-                )
-                dtm_service_description = query_image_server(
-                    image_service=dtm_image_service,
-                    print_metadata="service_description",
-                )
-                dtm_ref_grid = dtm_service_description["fullExtent"]
-                dtm_ref_grid["is_latlong"] = bool(spatial_ref.IsGeographic())
-                dtm_ref_grid["pixelSizeX"], dtm_ref_grid["pixelSizeY"] = (
-                    dtm_service_description["pixelSizeX"],
-                    dtm_service_description["pixelSizeY"],
-                )
-                dtm_aoi = align_windows(aoi_dict.copy(), dtm_ref_grid)
-
-                dtm = query_image_server(image_service=dtm_image_service, aoi=dtm_aoi)
-                np_dtm = aggregate_raster(
-                    gdal.Open(f"/vsicurl/{list(dtm.values())[0]}"),
-                    raster_aoi,
-                    spatial_ref,
-                    agg_alg=gdal.GRA_Average,
-                )
+    # Number features in the Area of Interest if statistics are computed per feature
+    if per_feature:
+        zone_source, feature_ids = create_zone_layer(aoi_reproj, feature_id_column)
+        zone_attribute = "zone"
+    else:
+        zone_source, feature_ids, zone_attribute = aoi_reproj, [None], None
 
-                # Create snow mask
-                mask = np.ma.getmask(np_snow_ma)
-                # Mask DTM
-                np_dtm_ma = np.ma.MaskedArray(np_dtm, mask)
+    snow_statistics = {
+        group: SnowStatistics(band_edges, n_zones=len(feature_ids))
+        for group in image_groups
+    }
 
-                res_dict["snow_mean_elevation"] = float(round(np_dtm_ma.mean(), 2))
-                res_dict["snow_min_elevation"] = float(round(np_dtm_ma.min(), 2))
-                res_dict["snow_max_elevation"] = float(round(np_dtm_ma.max(), 2))
+    # Continue from the accumulator state of the previous run for the same
+    # length of time period, so only images that entered or left the period
+    # have to be read
+    incremental = bool(state_directory) and not timeseries and not composite_directory
+    if state_directory:
+        if incremental:
+            Path(state_directory).mkdir(parents=True, exist_ok=True)
+            window_days = (
+                datetime.fromisoformat(date_end) - datetime.fromisoformat(date_start)
+            ).days + 1
+        else:
+            logger.warning(
+                "Lagret tilstand kan ikke brukes for tidsserier eller kompositter."
+            )
 
-                logger.info(
-                    "Gjennomsnittlig terrenghøyde med snø er {} meter".format(
-                        res_dict["snow_mean_elevation"]
-                    )
-                )
-                logger.info(
-                    "Laveste terrenghøyde med snø er {} meter".format(
-                        res_dict["snow_min_elevation"]
-                    )
+    # Let the server aggregate the images if it supports mosaic rules, images
+    # are needed on the client for composites and saved accumulator state
+    server_side = backend == "server"
+    if server_side and (composite_directory or incremental):
+        logger.warning(
+            "Aggregering på serveren kan ikke brukes med kompositter eller lagret tilstand."
+        )
+        server_side = False
+    if server_side and not supports_server_mean(snow_service_description):
+        logger.warning("ImageServeren støtter ikke aggregering, bruker klienten.")
+        server_side = False
+
+    for tile in tiles:
+        # Rasterize Area of interest on tile to be used as mask (or zones),
+        # only pixels inside the AOI polygon (not its bounding box) are used
+        with metrics.stage("rasterize"):
+            packed_zones = aoi_cache.rasterize(
+                tile,
+                zone_source,
+                spatial_ref,
+                aoi_key,
+                attribute=zone_attribute,
+                mask_directory=mask_directory,
+            )
+            if not packed_zones.any():
+                continue
+            zone_raster = packed_zones.unpack()
+
+        # In sparse mode, only pixels within the AOI are gathered (as 1-D
+        # arrays) and processed
+        pixel_index = np.flatnonzero(zone_raster) if sparse else None
+        zones = gather_pixels(zone_raster, pixel_index)
+
+        accumulator_state, previous_ids, removed_ids = None, [], []
+        if incremental:
+            state_path = get_state_path(
+                state_directory,
+                snow_image_service,
+                tile,
+                window_days,
+                aoi_key=aoi_key if sparse else None,
+            )
+            if state_path.exists():
+                accumulator_state, previous_ids = SnowAccumulator.load(
+                    state_path, max_images=len(object_ids), compact=compact
                 )
+                removed_ids = [i for i in previous_ids if i not in object_ids]
                 logger.info(
-                    "Høyeste terrenghøyde med snø er {} meter".format(
-                        res_dict["snow_max_elevation"]
+                    "{} bilder fra forrige kjøring, {} fjernes".format(
+                        len(previous_ids), len(removed_ids)
                     )
                 )
 
-                snow_classes = [
-                    snow_class
-                    for snow_class in np.unique(
-                        np.floor(np_dtm_ma / snow_bands).astype(np.int8)
+        # Composites cover all images of the time period
+        composite_accumulator = (
+            SnowAccumulator(
+                zones.shape,
+                max_images=len(object_ids),
+                keep_composites=True,
+                compact=compact,
+            )
+            if composite_directory and timeseries
+            else None
+        )
+        images = None
+        np_dtm = band_raster = None
+        dtm_read = False
+        for group, group_ids in image_groups.items():
+            np_snow = None
+            if server_side and group_ids:
+                # Let the server compute the average over available images
+                try:
+                    with metrics.stage("server_mean"):
+                        np_snow = gather_pixels(
+                            compute_mean_on_server(
+                                snow_image_service,
+                                group_ids,
+                                tile,
+                                cache=cache,
+                                client=client,
+                                compact=compact,
+                            ),
+                            pixel_index,
+                        )
+                except Exception as err:
+                    logger.warning(
+                        "Aggregering på serveren feilet, bruker klienten: {}".format(
+                            err
+                        )
                     )
-                    if snow_class
-                ]
-
-                snow_diff_elevation = (
-                    res_dict["snow_max_elevation"] - res_dict["snow_min_elevation"]
-                ) / len(snow_classes)
-                logger.info(
-                    "snow_diff_elevation er {} meter".format(snow_diff_elevation)
-                )
-
-                for i in snow_classes:
-                    snow_class_min = i * snow_bands
-                    snow_class_max = snow_class_min + snow_bands
-                    (
-                        snow_class_mean_percentage,
-                        snow_class_min_percentage,
-                        snow_class_max_percentage,
-                    ) = get_snow_statistics_for_height_interval(
-                        snow_class_min, snow_class_max, np_dtm, np_snow_ma, i
+                    server_side = False
+
+            if np_snow is None:
+                if images is None:
+                    # Get a list of images for the tile from the server
+                    with metrics.stage("image_links"):
+                        images = query_image_server(
+                            image_service=snow_image_service,
+                            aoi=tile,
+                            nprocs=nprocs,
+                            object_ids=[i for i in object_ids if i not in previous_ids]
+                            + removed_ids,
+                            service_description=snow_service_description,
+                            cache=cache,
+                            client=client,
+                        )
+
+                # Read images to array and compute average value over available images
+                with metrics.stage("accumulation"):
+                    if accumulator_state is not None:
+                        accumulator = accumulator_state
+                    else:
+                        accumulator = SnowAccumulator(
+                            zones.shape,
+                            max_images=len(group_ids),
+                            keep_composites=bool(composite_directory)
+                            and not timeseries,
+                            compact=compact,
+                        )
+                    for img_ds in fetch_images(
+                        [images[i] for i in group_ids if i not in previous_ids],
+                        nprocs=nprocs,
+                        client=client,
+                    ):
+                        img_ds = gather_pixels(img_ds, pixel_index)
+                        accumulator.add(img_ds)
+                        if composite_accumulator is not None:
+                            composite_accumulator.add(img_ds)
+                        img_ds = None
+                    for img_ds in fetch_images(
+                        [images[i] for i in removed_ids], nprocs=nprocs, client=client
+                    ):
+                        accumulator.remove(gather_pixels(img_ds, pixel_index))
+                        img_ds = None
+                    if incremental:
+                        accumulator.save(state_path, group_ids)
+                    np_snow = accumulator.mean()
+
+                if composite_directory and not timeseries:
+                    write_composites(
+                        accumulator, composite_rasters, tile, pixel_index=pixel_index
                     )
 
-                    # res_dict[f"snow_{snow_class_min}m_to_{snow_class_max}m"] = snow_class_min
+            metrics.add("pixels_processed", zones.size)
 
-                    try:
-                        res_dict[
-                            f"snow_{snow_class_min}m_to_{snow_class_max}m_mean_percentage"
-                        ] = float(snow_class_mean_percentage)
-                    except Exception:
-                        res_dict[
-                            f"snow_{snow_class_min}m_to_{snow_class_max}m_mean_percentage"
-                        ] = -9999
+            # Ekstra test siden extract by mask ikke feiler i Desktop
+            # bare pixler innenfor AOI og fra og med brukerdefinert grenseverdi skal være med
+            np_snow_ma = np.ma.masked_where(
+                (zones == 0) | (np_snow < min_snow_percent), np_snow, copy=True
+            )
 
+            # Get DTM once per tile (for the first date with snow)
+            if np_snow_ma.count() > 0 and not dtm_read and not dtm_failed:
+                dtm_read = True
+                with metrics.stage("dtm"):
                     try:
-                        res_dict[
-                            f"snow_{snow_class_min}m_to_{snow_class_max}m_min_percentage"
-                        ] = float(snow_class_min_percentage)
-                    except Exception:
-                        res_dict[
-                            f"snow_{snow_class_min}m_to_{snow_class_max}m_min_percentage"
-                        ] = -9999
+                        if dtm_store and dtm_store.contains(tile):
+                            if not dtm_store.exists():
+                                logger.info("Lagrer DTM i {}".format(dtm_directory))
+                                dtm_store.build(spatial_ref, cache=cache, client=client)
+                            np_dtm = dtm_store.get_dtm(tile)
+                            band_raster = dtm_store.get_band_raster(tile, band_edges)
+                        else:
+                            if not dtm_service_description:
+                                dtm_service_description = get_service_description(
+                                    dtm_image_service, cache=cache, client=client
+                                )
+                            # DTM windows are kept in memory for repeated AOIs
+                            np_dtm = memory_cache.get_or_create(
+                                (
+                                    "dtm",
+                                    dtm_image_service,
+                                    tile["bbox"],
+                                    tile["pixelSizeX"],
+                                    tile["pixelSizeY"],
+                                    compact,
+                                ),
+                                lambda: read_dtm(
+                                    tile,
+                                    dtm_image_service,
+                                    dtm_service_description,
+                                    spatial_ref,
+                                    cache=cache,
+                                    client=client,
+                                    data_type=(
+                                        gdal.GDT_Int16 if compact else gdal.GDT_Float32
+                                    ),
+                                ),
+                            )
+                    except Exception as err:
+                        logger.error("Feilet ved DTM-analyse: {}".format(err))
+                        dtm_failed = True
+                    np_dtm = gather_pixels(np_dtm, pixel_index)
+                    band_raster = gather_pixels(band_raster, pixel_index)
+
+            with metrics.stage("statistics"):
+                snow_statistics[group].merge(
+                    SnowStatistics(band_edges, n_zones=len(feature_ids)).update(
+                        np_snow_ma, zones, np_dtm=np_dtm, band_raster=band_raster
+                    )
+                )
+            accumulator = np_snow = np_snow_ma = None
 
+        if composite_accumulator is not None:
+            write_composites(
+                composite_accumulator, composite_rasters, tile, pixel_index=pixel_index
+            )
+        composite_accumulator = images = np_dtm = band_raster = None
+        zone_raster = zones = None
+
+    if composite_directory:
+        composite_rasters = None
+
+    if cache:
+        logger.info("Hurtigbuffer: {} treff og {} bom".format(cache.hits, cache.misses))
+        metrics.add("cache_hits", cache.hits)
+        metrics.add("cache_misses", cache.misses)
+    if metrics.enabled:
+        metrics.add("tiles", len(tiles))
+        logger.info("Metrikker: {}".format(json.dumps(metrics.as_dict())))
+
+    px_area = raster_aoi["pixelSizeX"] * raster_aoi["pixelSizeY"]
+    result_kwargs = {
+        "px_area": px_area,
+        "min_snow_percent": min_snow_percent,
+        "include_histogram": include_histogram,
+        "coarse_factor": coarse_factor,
+        "drop_zero_band": not snow_band_edges,
+        "dtm_failed": dtm_failed,
+    }
+
+    try:
+        if timeseries:
+            # One result record per acquisition date (and feature)
+            results = []
+            for group in image_groups:
+                for zone, feature_id in enumerate(feature_ids):
                     try:
-                        res_dict[
-                            f"snow_{snow_class_min}m_to_{snow_class_max}m_max_percentage"
-                        ] = float(snow_class_max_percentage)
-                    except Exception:
-                        res_dict[
-                            f"snow_{snow_class_min}m_to_{snow_class_max}m_max_percentage"
-                        ] = -9999
-            else:
-                logger.warning(
-                    "Minimum snøprosent er {}. Beregner derfor ikke høyde".format(
-                        res_dict["snow_min_percentage"]
+                        res_dict = get_result_dict(
+                            snow_statistics[group], zone, **result_kwargs
+                        )
+                    except Exception as err:
+                        logger.info("{} {}: {}".format(group, feature_id, err))
+                        continue
+                    results.append({"date": group, "aoi_id": feature_id, **res_dict})
+            if timeseries_output:
+                write_timeseries(results, timeseries_output)
+            add_metrics(results)
+            print(json.dumps(results))
+            return json.dumps(results)
+
+        if per_feature:
+            # One result record per feature
+            results = []
+            for zone, feature_id in enumerate(feature_ids):
+                logger.info("Beregner verdier for {}".format(feature_id))
+                try:
+                    res_dict = get_result_dict(
+                        snow_statistics[None], zone, **result_kwargs
                     )
-                )
-        except Exception as err:
-            logger.error("Feilet ved DTM-analyse: {}".format(err))
+                except Exception as err:
+                    logger.warning("{}: {}".format(feature_id, err))
+                    res_dict = {"error": str(err)}
+                results.append({"aoi_id": feature_id, **res_dict})
+            add_metrics(results)
+            print(json.dumps(results))
+            return json.dumps(results)
+
+        res_dict = get_result_dict(snow_statistics[None], **result_kwargs)
+        add_metrics([res_dict])
 
         print(json.dumps(res_dict))
         return json.dumps(res_dict)
@@ -630,6 +2633,105 @@ def main():
         logger.error("Feilet: {}".format(err))
 
 
+def refine_statistics(coarse_factors=(8, 4, 2, 1), **settings):
+    """Compute statistics progressively from coarse to full resolution
+    Yields the coarse factor and the result of ``main`` for every factor, so
+    a quick estimate is available after the first (coarsest) run and is
+    refined by the following runs.
+    """
+    for coarse_factor in coarse_factors:
+        with redirect_stdout(sys.stderr):
+            result = main(coarse_factor=coarse_factor, **settings)
+        if result is None:
+            raise RuntimeError("Beregningen feilet, se loggen.")
+        yield coarse_factor, json.loads(result)
+
+
+def run_job(line):
+    """Run one job of a worker given as line with a JSON object
+    The JSON object holds keyword arguments for ``main`` and optionally an
+    "id" that is returned with the result. Output of ``main`` on stdout is
+    redirected to stderr, so stdout only carries the results of the jobs.
+    :return: dict with "id" and "result" or "error"
+    :rtype: dict
+    """
+    job_id = None
+    try:
+        job = json.loads(line)
+        job_id = job.pop("id", None)
+        with redirect_stdout(sys.stderr):
+            result = main(**job)
+    except Exception as err:
+        logger.error("Jobb {} feilet: {}".format(job_id, err))
+        return {"id": job_id, "error": str(err)}
+    if result is None:
+        return {"id": job_id, "error": "Beregningen feilet, se loggen."}
+    return {"id": job_id, "result": json.loads(result)}
+
+
+def run_worker(input_stream=sys.stdin, output_stream=sys.stdout):
+    """Run jobs (one JSON object per line) until the input stream is closed
+    The interpreter, GDAL, connections to the ImageServer and the AOI cache
+    are initialized once and reused for all jobs. One JSON result is written
+    per job in the order of the jobs.
+    """
+    for line in input_stream:
+        if not line.strip():
+            continue
+        output_stream.write(json.dumps(run_job(line)) + "\n")
+        output_stream.flush()
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """Run jobs sent as JSON lines over a socket connection"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = run_job(line.decode("utf-8"))
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def serve_worker(port, host="127.0.0.1"):
+    """Run jobs from connections to a local socket until interrupted
+    Jobs are run one at a time, also with several connections.
+    """
+    with socketserver.TCPServer((host, port), WorkerHandler) as server:
+        logger.info("Venter på jobber på {}:{}".format(host, port))
+        server.serve_forever()
+
+
 if __name__ == "__main__":
     # atexit.register(cleanup)
-    sys.exit(main())
+    parser = argparse.ArgumentParser(
+        description="Compute snow cover statistics over an area of interest"
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="read jobs (JSON objects with settings, one per line) from stdin "
+        "and write one JSON result per line to stdout",
+    )
+    parser.add_argument(
+        "--port", type=int, help="read jobs from connections to this local port"
+    )
+    parser.add_argument(
+        "--refine",
+        type=int,
+        nargs="+",
+        metavar="FACTOR",
+        help="compute statistics progressively on grids coarser by these factors "
+        "(e.g. 8 4 2 1) and write one JSON result per line",
+    )
+    args = parser.parse_args()
+    if args.port:
+        serve_worker(args.port)
+    elif args.worker:
+        run_worker()
+    elif args.refine:
+        for _, result in refine_statistics(args.refine):
+            print(json.dumps(result), flush=True)
+    else:
+        sys.exit(main())
@@ -84,6 +84,14 @@ This program is free software under the GNU General Public License
 #% guisection: Settings
 #%end
 
+#%option
+#% key: snow_band_edges
+#% type: double
+#% multiple: yes
+#% description: Altitudes in meter of the edges of (non-uniform) bands to compute snow cover for (overrides snow_bands)
+#% guisection: Settings
+#%end
+
 #%option
 #% key: min_snow_percent
 #% type: integer
@@ -92,6 +100,147 @@ This program is free software under the GNU General Public License
 #% guisection: Settings
 #%end
 
+#%option G_OPT_M_NPROCS
+#% description: Number of images to download in parallel
+#% guisection: Settings
+#%end
+
+#%option G_OPT_M_DIR
+#% key: composite_directory
+#% description: Directory to write per-pixel minimum, maximum and last valid snow cover to (as GeoTIFF)
+#% required: no
+#% guisection: Output
+#%end
+
+#%option
+#% key: tile_size
+#% type: integer
+#% description: Size of tiles (in pixels) to process one by one (default is to tile only areas exceeding the export limits of the ImageServer)
+#% required: no
+#% guisection: Settings
+#%end
+
+#%option G_OPT_M_DIR
+#% key: cache_directory
+#% description: Directory for caching responses from the ImageServer (default is no caching)
+#% required: no
+#% guisection: Settings
+#%end
+
+#%option G_OPT_M_DIR
+#% key: dtm_directory
+#% description: Directory to store the DTM resampled to the grid of the snow service in (default is to download the DTM for every request)
+#% required: no
+#% guisection: Settings
+#%end
+
+#%option G_OPT_M_DIR
+#% key: state_directory
+#% description: Directory to save per-pixel sums and counts in, to only read new and expired images in the next run (default is to read all images)
+#% required: no
+#% guisection: Settings
+#%end
+
+#%option G_OPT_M_DIR
+#% key: mask_directory
+#% description: Directory to store rasterized AOI masks in (default is to rasterize the AOI in every run)
+#% required: no
+#% guisection: Settings
+#%end
+
+#%option
+#% key: backend
+#% type: string
+#% description: Where to average images (server falls back to client if the ImageServer does not support it)
+#% options: client,server
+#% answer: client
+#% guisection: Settings
+#%end
+
+#%option
+#% key: timeout
+#% type: double
+#% description: Timeout for requests to the ImageServer in seconds
+#% answer: 60
+#% guisection: Settings
+#%end
+
+#%option
+#% key: retries
+#% type: integer
+#% description: Number of retries of failed requests to the ImageServer
+#% answer: 3
+#% guisection: Settings
+#%end
+
+#%option
+#% key: coarse_factor
+#% type: integer
+#% description: Compute statistics on a grid coarser by this factor for quick estimates (with error estimate)
+#% answer: 1
+#% options: 1-
+#% guisection: Settings
+#%end
+
+#%option
+#% key: cache_size
+#% type: integer
+#% description: Maximum size of the cache in MB
+#% answer: 2048
+#% guisection: Settings
+#%end
+
+#%option
+#% key: feature_id_column
+#% type: string
+#% description: Attribute column with IDs of the features in the AOI (default is the feature ID)
+#% required: no
+#% guisection: Input
+#%end
+
+#%flag
+#% key: f
+#% description: Compute statistics for each feature in the AOI (one result per feature)
+#% guisection: Input
+#%end
+
+#%flag
+#% key: t
+#% description: Compute statistics for each acquisition date in the time period (time series)
+#% guisection: Output
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: timeseries_output
+#% description: File to write the time series to (.csv, .parquet or .jsonl, default is JSON on stdout)
+#% required: no
+#% guisection: Output
+#%end
+
+#%flag
+#% key: i
+#% description: Include histogram of snow cover percentage (1 % bins) in output
+#% guisection: Output
+#%end
+
+#%flag
+#% key: s
+#% description: Only process pixels within the AOI (faster for long, narrow AOIs like river corridors)
+#% guisection: Settings
+#%end
+
+#%flag
+#% key: c
+#% description: Use compact data types (integer sums, float32 mean and int16 DTM) to reduce memory use
+#% guisection: Settings
+#%end
+
+#%flag
+#% key: m
+#% description: Measure time per stage, bytes downloaded, images read, pixels processed and cache hits (printed as message and added as _metrics to the result)
+#% guisection: Output
+#%end
+
 # Currently not implemented
 #%flag
 #% key: d
@@ -107,14 +256,23 @@ This program is free software under the GNU General Public License
 # Imports from builtin libs
 # import atexit
 import os
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+import csv
+import hashlib
+import http.client
+from itertools import islice
 import json
 import logging
-from math import ceil, floor
+from math import ceil, floor, isclose, sqrt
 from pathlib import Path
-from urllib import request, parse
+from urllib import parse
 import sys
-import tempfile
+import threading
+import time
+from uuid import uuid4
 
 # sys.path.insert(1, os.path.join(os.path.dirname(sys.path[0]), 'etc', 'r.in.wms'))
 
@@ -125,7 +283,7 @@ import grass.script as gscript
 # nedenfor defineres omgivelsesvariablene for CONDA
 
 try:
-    from osgeo import osr, gdal  # , ogr
+    from osgeo import ogr, osr, gdal
 except ImportError:
     gscript.error(
         _(
@@ -144,6 +302,20 @@ except ImportError:
     )
 
 
+def get_grid_size(window):
+    """Get the number of columns and rows of a window
+    Extent divided by pixel size is rounded (not truncated), so floating
+    point errors in the extent do not drop a row or column. All grids
+    (windows, tiles, GDAL rasters, exported images) are sized with this.
+    :return: width and height in pixels
+    :rtype: tuple
+    """
+    return (
+        round((window["xmax"] - window["xmin"]) / window["pixelSizeX"]),
+        round((window["ymax"] - window["ymin"]) / window["pixelSizeY"]),
+    )
+
+
 def align_windows(window, ref):
     """Align two regions
     Python version of:
@@ -158,6 +330,10 @@ def align_windows(window, ref):
     taken into consideration to make sure that the ymax doesn't go
     above 90 degrees (for lat/lon) or that the xmax does "wrap" past
     the xmin, etc.
+    Unlike align_window.c, ymin and xmax are snapped to the grid starting at
+    the origin (xmin, ymax) of ``ref``, not to the ymin and xmax of ``ref``,
+    so the window is a whole number of pixels also when the extent of
+    ``ref`` is not (e.g. for grids coarser than the grid of the service).
     :param window: dict of window to align, with keys ymax, ymin, xmax,
                    xmin, pixelSizeY, pixelSizeX, is_latlong
     :type window: dict
@@ -183,8 +359,9 @@ def align_windows(window, ref):
         - floor((ref["ymax"] - window["ymax"]) / ref["pixelSizeY"]) * ref["pixelSizeY"]
     )
     window["ymin"] = (
-        ref["ymin"]
-        - ceil((ref["ymin"] - window["ymin"]) / ref["pixelSizeY"]) * ref["pixelSizeY"]
+        window["ymax"]
+        - ceil((window["ymax"] - window["ymin"]) / ref["pixelSizeY"])
+        * ref["pixelSizeY"]
     )
     # Rast_easting_to_col() wraps easting:
     # xmax can become < xmin, or both xmin and xmax are shifted */
@@ -193,8 +370,9 @@ def align_windows(window, ref):
         + floor((window["xmin"] - ref["xmin"]) / ref["pixelSizeX"]) * ref["pixelSizeX"]
     )
     window["xmax"] = (
-        ref["xmax"]
-        + ceil((window["xmax"] - ref["xmax"]) / ref["pixelSizeX"]) * ref["pixelSizeX"]
+        window["xmin"]
+        + ceil((window["xmax"] - window["xmin"]) / ref["pixelSizeX"])
+        * ref["pixelSizeX"]
     )
 
     if window["is_latlong"]:
@@ -203,8 +381,14 @@ def align_windows(window, ref):
         while window["ymin"] < -90.0 - window["pixelSizeY"] / 2.0:
             window["ymin"] += window["pixelSizeY"]
 
-    window["width"] = int((window["xmax"] - window["xmin"]) / window["pixelSizeX"])
-    window["height"] = int((window["ymax"] - window["ymin"]) / window["pixelSizeY"])
+    window["width"], window["height"] = get_grid_size(window)
+    if not (
+        isclose(window["width"] * window["pixelSizeX"], window["xmax"] - window["xmin"])
+        and isclose(
+            window["height"] * window["pixelSizeY"], window["ymax"] - window["ymin"]
+        )
+    ):
+        raise ValueError("Vinduet er ikke et helt antall piksler.")
     window[
         "bbox"
     ] = f"{window['xmin']}, {window['ymin']}, {window['xmax']}, {window['ymax']}"
@@ -218,6 +402,39 @@ def align_windows(window, ref):
     return window
 
 
+def split_window(window, tile_size=None):
+    """Split an aligned window into tiles aligned to the same grid
+    Tiles are ``tile_size`` x ``tile_size`` pixels large, except for the
+    last row and column of tiles, which hold the remaining pixels.
+    :param window: dict of aligned window (as returned by ``align_windows``)
+    :type window: dict
+    :param tile_size: number of rows and columns per tile, ``None`` or 0
+                      returns the window as a single tile
+    :type tile_size: int
+    :return: list of windows with additional keys row_offset and col_offset
+             (position of the tile within ``window`` in pixels)
+    :rtype: list
+    """
+    if not tile_size:
+        tile_size = max(window["width"], window["height"])
+    tiles = []
+    for row_offset in range(0, window["height"], tile_size):
+        for col_offset in range(0, window["width"], tile_size):
+            tile = window.copy()
+            tile["row_offset"], tile["col_offset"] = row_offset, col_offset
+            tile["height"] = min(tile_size, window["height"] - row_offset)
+            tile["width"] = min(tile_size, window["width"] - col_offset)
+            tile["ymax"] = window["ymax"] - row_offset * window["pixelSizeY"]
+            tile["ymin"] = tile["ymax"] - tile["height"] * window["pixelSizeY"]
+            tile["xmin"] = window["xmin"] + col_offset * window["pixelSizeX"]
+            tile["xmax"] = tile["xmin"] + tile["width"] * window["pixelSizeX"]
+            tile[
+                "bbox"
+            ] = f"{tile['xmin']}, {tile['ymin']}, {tile['xmax']}, {tile['ymax']}"
+            tiles.append(tile)
+    return tiles
+
+
 def create_gdal_raster(
     reference_grid, srs, data_type, ds_name="dtm_raster", driver_name="MEM"
 ):
@@ -225,18 +442,13 @@ def create_gdal_raster(
     driver = gdal.GetDriverByName(driver_name)
     target_ds = driver.Create(
         ds_name,
-        int(
-            (reference_grid["xmax"] - reference_grid["xmin"])
-            / reference_grid["pixelSizeX"]
-        ),
-        int(
-            (reference_grid["ymax"] - reference_grid["ymin"])
-            / reference_grid["pixelSizeY"]
-        ),
+        *get_grid_size(reference_grid),
         1,
         data_type,
     )
-    target_ds.GetRasterBand(1).Fill(0)
+    if driver_name != "MEM":
+        # MEM rasters are initialized with 0 already
+        target_ds.GetRasterBand(1).Fill(0)
     target_ds.SetGeoTransform(
         (
             (reference_grid["xmin"]),
@@ -282,34 +494,573 @@ def reproject_geojson(geo_json, spatial_ref):
     s_srs = osr.SpatialReference()
     s_srs.ImportFromEPSG(4326)
 
-    # Create temporary (shape) file
-    tmp_shp = tempfile.NamedTemporaryFile().name + ".shp"
-
-    # Reproject AOI layer
-    gdal.VectorTranslate(
-        tmp_shp, geo_json, dstSRS=spatial_ref, srcSRS=s_srs, reproject=True
+    # Reproject AOI layer into an in-memory dataset
+    return gdal.VectorTranslate(
+        "",
+        geo_json,
+        format="Memory",
+        dstSRS=spatial_ref,
+        srcSRS=s_srs,
+        reproject=True,
     )
 
-    return gdal.OpenEx(tmp_shp)
 
+def create_zone_layer(aoi, id_column=None):
+    """Copy features of the AOI to an in-memory layer with a zone number
+    Zones are numbered 1 ... number of features in the order of the features.
+    :param aoi: GDAL vector dataset with Area(s) of Interest
+    :type aoi: gdal.Dataset
+    :param id_column: attribute column with feature IDs (default is the FID)
+    :type id_column: str
+    :return: tuple with GDAL vector dataset and a list of feature IDs
+    :rtype: tuple
+    """
+    aoi_layer = aoi.GetLayerByIndex(0)
+    zone_ds = gdal.GetDriverByName("Memory").Create("zones", 0, 0, 0, gdal.GDT_Unknown)
+    zone_layer = zone_ds.CreateLayer(
+        "zones", srs=aoi_layer.GetSpatialRef(), geom_type=aoi_layer.GetGeomType()
+    )
+    zone_layer.CreateField(ogr.FieldDefn("zone", ogr.OFTInteger))
+
+    feature_ids = []
+    aoi_layer.ResetReading()
+    for zone, feature in enumerate(aoi_layer, start=1):
+        zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+        zone_feature.SetGeometry(feature.GetGeometryRef())
+        zone_feature.SetField("zone", zone)
+        zone_layer.CreateFeature(zone_feature)
+        feature_ids.append(
+            feature.GetField(id_column) if id_column else feature.GetFID()
+        )
+    return zone_ds, feature_ids
 
-def rasterize_aoi(reference_grid, aoi, spatial_ref):
-    """Rasterize AOI on reference grid"""
+
+def rasterize_aoi(reference_grid, aoi, spatial_ref, attribute=None):
+    """Rasterize AOI on reference grid
+    Returns a boolean mask, or a zone raster with the values of ``attribute``
+    (0 outside all features) if an attribute is given. Where features overlap,
+    the last feature wins.
+    """
 
     # Create target raster map from reference grid
     target_ds = create_gdal_raster(
         reference_grid,
         spatial_ref,
-        gdal.GDT_Byte,
+        gdal.GDT_Int32 if attribute else gdal.GDT_Byte,
         ds_name="mask_raster",
         driver_name="MEM",
     )
 
     # Rasterize AOI on target raster map
     gdal.Rasterize(
-        target_ds, aoi, allTouched=True, layers=[aoi.GetLayerByIndex(0).GetName()]
+        target_ds,
+        aoi,
+        allTouched=True,
+        layers=[aoi.GetLayerByIndex(0).GetName()],
+        attribute=attribute,
     )
-    return np.array(target_ds.ReadAsArray(), dtype=np.bool_)
+    return target_ds.ReadAsArray().astype(
+        np.int32 if attribute else np.bool_, copy=False
+    )
+
+
+def get_aoi_key(aoi):
+    """Get a hash of the content of an AOI file (or of the AOI string itself)"""
+    aoi_content = Path(aoi).read_bytes() if Path(aoi).is_file() else aoi.encode()
+    return hashlib.sha256(aoi_content).hexdigest()
+
+
+class PackedMask:
+    """AOI mask or zone raster of a window in compact form
+    The mask is cropped to the bounding box of the pixels within the AOI.
+    Boolean masks are bit-packed row by row (one bit per pixel), zone rasters
+    are stored with the smallest integer type for the number of zones. The
+    full array is only unpacked when needed.
+    """
+
+    def __init__(self, data, shape, row_offset, col_offset, width, is_packed):
+        """
+        :param data: cropped (and bit-packed) mask
+        :type data: numpy.ndarray
+        :param shape: shape of the unpacked mask
+        :type shape: tuple
+        :param row_offset: first row of the crop in the unpacked mask
+        :type row_offset: int
+        :param col_offset: first column of the crop in the unpacked mask
+        :type col_offset: int
+        :param width: number of columns of the crop
+        :type width: int
+        :param is_packed: whether data is a bit-packed boolean mask
+        :type is_packed: bool
+        """
+        self.data = data
+        self.shape = tuple(shape)
+        self.row_offset = row_offset
+        self.col_offset = col_offset
+        self.width = width
+        self.is_packed = is_packed
+
+    @classmethod
+    def from_array(cls, mask):
+        """Pack a boolean mask or an integer zone raster"""
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size:
+            row_offset, col_offset = int(rows[0]), int(cols[0])
+            cropped = mask[row_offset : rows[-1] + 1, col_offset : cols[-1] + 1]
+        else:
+            row_offset, col_offset = 0, 0
+            cropped = mask[:0, :0]
+        if mask.dtype == np.bool_:
+            data = np.packbits(cropped, axis=1)
+        else:
+            data = cropped.astype(np.min_scalar_type(cropped.max(initial=0)))
+        return cls(
+            data,
+            mask.shape,
+            row_offset,
+            col_offset,
+            cropped.shape[1],
+            mask.dtype == np.bool_,
+        )
+
+    def any(self):
+        """Check if any pixel is within the AOI without unpacking"""
+        return bool(self.data.any())
+
+    def unpack(self):
+        """Unpack into a boolean mask or an int32 zone raster"""
+        mask = np.zeros(self.shape, dtype=np.bool_ if self.is_packed else np.int32)
+        if self.is_packed:
+            cropped = np.unpackbits(self.data, axis=1, count=self.width).view(np.bool_)
+        else:
+            cropped = self.data
+        mask[
+            self.row_offset : self.row_offset + cropped.shape[0],
+            self.col_offset : self.col_offset + self.width,
+        ] = cropped
+        return mask
+
+    def save(self, path):
+        """Save the packed mask to a numpy (.npz) file"""
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            data=self.data,
+            meta=np.array(
+                [*self.shape, self.row_offset, self.col_offset, self.width],
+                dtype=np.int64,
+            ),
+            is_packed=np.array(self.is_packed),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a packed mask saved with ``save``"""
+        with np.load(path) as packed_mask:
+            height, width, row_offset, col_offset, crop_width = packed_mask[
+                "meta"
+            ].tolist()
+            return cls(
+                packed_mask["data"],
+                (height, width),
+                row_offset,
+                col_offset,
+                crop_width,
+                bool(packed_mask["is_packed"]),
+            )
+
+
+class AOICache:
+    """In-memory cache of reprojected AOIs and their rasterized masks
+    Entries are keyed by a hash of the AOI content, the target spatial
+    reference and (for masks) the grid, so repeated requests for the same
+    AOI in a long-running process skip reprojection and rasterization.
+    Cached datasets are shared and must not be modified. Masks are kept as
+    PackedMask and, if ``mask_directory`` is set, also stored on disk, so
+    they can be reused by other processes.
+    """
+
+    def __init__(self, max_entries=64, mask_directory=None):
+        """
+        :param max_entries: number of entries to keep, least recently used
+                            entries are dropped first
+        :type max_entries: int
+        :param mask_directory: directory to store packed masks in
+        :type mask_directory: str
+        """
+        self.max_entries = max_entries
+        self.mask_directory = mask_directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, key, create):
+        """Get an entry from the cache or create and add it"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = create()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def reproject(self, aoi, spatial_ref, aoi_key=None):
+        """Get the AOI reprojected to spatial_ref (see ``reproject_geojson``)"""
+        key = ("aoi", aoi_key or get_aoi_key(aoi), spatial_ref.ExportToWkt())
+        return self._get_or_create(key, lambda: reproject_geojson(aoi, spatial_ref))
+
+    def rasterize(
+        self,
+        reference_grid,
+        aoi,
+        spatial_ref,
+        aoi_key,
+        attribute=None,
+        mask_directory=None,
+    ):
+        """Get the AOI rasterized on reference_grid (see ``rasterize_aoi``)
+        The returned PackedMask is shared and must not be modified.
+        :param aoi_key: hash of the AOI the (reprojected) dataset aoi is made from
+        :type aoi_key: str
+        :param mask_directory: directory to store packed masks in for this
+                               call (None to use ``mask_directory`` of the cache)
+        :type mask_directory: str
+        """
+        mask_directory = mask_directory or self.mask_directory
+        key = (
+            "mask",
+            aoi_key,
+            spatial_ref.ExportToWkt(),
+            reference_grid["bbox"],
+            reference_grid["pixelSizeX"],
+            reference_grid["pixelSizeY"],
+            attribute,
+        )
+
+        def create():
+            if mask_directory:
+                mask_digest = hashlib.sha256(
+                    json.dumps(key).encode("utf-8")
+                ).hexdigest()
+                mask_path = Path(mask_directory) / f"mask_{mask_digest[:16]}.npz"
+                if mask_path.exists():
+                    return PackedMask.load(mask_path)
+            packed_mask = PackedMask.from_array(
+                rasterize_aoi(reference_grid, aoi, spatial_ref, attribute=attribute)
+            )
+            if mask_directory:
+                Path(mask_directory).mkdir(parents=True, exist_ok=True)
+                packed_mask.save(mask_path)
+            return packed_mask
+
+        return self._get_or_create(key, create)
+
+
+aoi_cache = AOICache()
+
+
+class ImageServerCache:
+    """Size bounded on-disk cache of ImageServer responses
+    Every entry is a file in ``cache_directory`` named by a hash of its key.
+    The time of last use is stored as access time of the file, so the least
+    recently used entries can be removed when the cache grows beyond
+    ``max_size`` bytes. The size of the cache is counted when it is opened
+    and kept up to date on every put, so the directory is only scanned when
+    entries have to be evicted, and then entries are evicted down to
+    ``low_water`` times ``max_size``. Entries used within the last ``min_age`` seconds are
+    kept, so images downloaded in the current run are not evicted before
+    they are read. Service descriptions and queries are volatile and only
+    served from the cache within ``ttl`` seconds after they were written.
+    """
+
+    def __init__(
+        self,
+        cache_directory,
+        max_size=2 * 1024**3,
+        ttl=300,
+        min_age=600,
+        low_water=0.9,
+    ):
+        """
+        :param cache_directory: directory to store cached responses in
+        :type cache_directory: str
+        :param max_size: maximum size of the cache in bytes
+        :type max_size: int
+        :param ttl: time to live in seconds for volatile entries
+        :type ttl: int
+        :param min_age: minimum time in seconds since last use before an
+                        entry can be evicted
+        :type min_age: int
+        :param low_water: fraction of max_size to evict down to
+        :type low_water: float
+        """
+        self.cache_directory = Path(cache_directory)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_age = min_age
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(stat.st_size for stat, _ in self._entries())
+
+    def _path(self, key):
+        """Get path of the file for a cache key (tuple of strings and numbers)"""
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return self.cache_directory / digest
+
+    def _entries(self):
+        """Get stat and path of all entries in the cache directory"""
+        entries = []
+        for path in self.cache_directory.iterdir():
+            if path.suffix == ".tmp":
+                continue
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_path(self, key, ttl=None):
+        """Return path to the cached entry for key or None if it is not cached
+        :param key: key of the entry, e.g. (service URL, object id, bbox, pixel size)
+        :type key: tuple
+        :param ttl: time to live in seconds, None if the entry does not expire
+        :type ttl: int
+        """
+        path = self._path(key)
+        now = time.time()
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            self._count(False)
+            return None
+        if ttl is not None and now - mtime > ttl:
+            self._count(False)
+            return None
+        # Mark entry as recently used
+        os.utime(path, (now, mtime))
+        self._count(True)
+        return str(path)
+
+    def get(self, key, ttl=None):
+        """Return content of the cached entry for key or None if it is not cached"""
+        path = self.get_path(key, ttl=ttl)
+        if path is None:
+            return None
+        return Path(path).read_bytes()
+
+    def put(self, key, content):
+        """Store content for key in the cache and return the path to the entry"""
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        try:
+            replaced_size = path.stat().st_size
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += len(content) - replaced_size
+            evict = self._size > self.max_size
+        if evict:
+            self.evict()
+        return str(path)
+
+    def evict(self):
+        """Remove least recently used entries if the cache exceeds max_size
+        Entries are removed until the cache fits into low_water times max_size.
+        The directory is scanned again, so the size also counts entries
+        written by other processes using the same directory.
+        """
+        with self._lock:
+            entries = self._entries()
+            self._size = sum(stat.st_size for stat, _ in entries)
+            if self._size <= self.max_size:
+                return
+            target_size = self.max_size * self.low_water
+            now = time.time()
+            for stat, path in sorted(entries, key=lambda entry: entry[0].st_atime):
+                if self._size <= target_size or now - stat.st_atime < self.min_age:
+                    break
+                path.unlink(missing_ok=True)
+                self._size -= stat.st_size
+
+
+class Metrics:
+    """Timing of the stages of a run and counters (bytes, images, pixels, ...)
+    Disabled metrics cost next to nothing: ``stage`` returns a shared no-op
+    context manager and ``add`` returns immediately. Stages run in worker
+    threads (like image downloads) are summed over the threads.
+    """
+
+    _disabled_stage = nullcontext()
+
+    def __init__(self, enabled=False):
+        self.reset(enabled)
+
+    def reset(self, enabled=False):
+        """Clear all timings and counters and enable or disable metrics"""
+        self.enabled = enabled
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Context manager adding the time spent in it to the stage name"""
+        if not self.enabled:
+            return self._disabled_stage
+        return self._time_stage(name)
+
+    @contextmanager
+    def _time_stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def add(self, counter, value=1):
+        """Add value to a counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self):
+        """Get timings (in seconds) and counters as a JSON serializable dict"""
+        return {
+            "seconds": {name: round(value, 6) for name, value in self.timings.items()},
+            **self.counters,
+        }
+
+
+metrics = Metrics()
+
+
+def add_metrics(results):
+    """Add the metrics of the run as "_metrics" to every result record
+    Records of time series and per-feature results all get the metrics of
+    the whole run. Nothing is added if metrics are not enabled.
+    :param results: list of result dicts
+    :type results: list
+    """
+    if metrics.enabled:
+        run_metrics = metrics.as_dict()
+        for result in results:
+            result["_metrics"] = run_metrics
+
+
+class ImageServerClient:
+    """HTTP client for ArcGIS ImageServer services
+    Connections are kept alive and reused (one connection per host and
+    thread), so TCP/TLS connections are not set up for every request.
+    Requests time out after ``timeout`` seconds and failed requests are
+    retried with exponential backoff (all requests to the ImageServer are
+    idempotent GET requests).
+    """
+
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout=60, retries=3, backoff_factor=0.5):
+        """
+        :param timeout: timeout for connecting and reading in seconds
+        :type timeout: float
+        :param retries: number of retries of failed requests
+        :type retries: int
+        :param backoff_factor: wait backoff_factor * 2 ** retry seconds before a retry
+        :type backoff_factor: float
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._local = threading.local()
+
+    def _get_connection(self, scheme, netloc):
+        """Get the keep-alive connection to a host for the current thread"""
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        connection = self._local.connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = (
+                http.client.HTTPSConnection
+                if scheme == "https"
+                else http.client.HTTPConnection
+            )
+            connection = connection_class(netloc, timeout=self.timeout)
+            self._local.connections[(scheme, netloc)] = connection
+        return connection
+
+    def get(self, url, max_redirects=5):
+        """Send a GET request and return the content of the response
+        Connection errors, timeouts and responses with a status code in
+        ``retry_status`` are retried, other HTTP errors raise a RuntimeError.
+        """
+        url_parts = parse.urlsplit(url)
+        path = url_parts.path or "/"
+        if url_parts.query:
+            path += "?" + url_parts.query
+        for retry in range(self.retries + 1):
+            if retry:
+                gscript.verbose(
+                    "Forsøker på nytt ({}/{}): {}".format(retry, self.retries, error)
+                )
+                time.sleep(self.backoff_factor * 2 ** (retry - 1))
+            connection = self._get_connection(url_parts.scheme, url_parts.netloc)
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                # Drop the broken connection, it is re-opened on the next request
+                connection.close()
+                error = err
+                continue
+            if response.status in (301, 302, 303, 307, 308) and max_redirects:
+                return self.get(
+                    parse.urljoin(url, response.getheader("Location")),
+                    max_redirects=max_redirects - 1,
+                )
+            if response.status < 300:
+                metrics.add("requests")
+                metrics.add("bytes_downloaded", len(content))
+                return content
+            error = RuntimeError(
+                "ImageServeren svarte med {} på {}: {}".format(
+                    response.status, url, content[:200]
+                )
+            )
+            if response.status not in self.retry_status:
+                raise error
+        raise error
+
+    def get_json(self, url):
+        """Send a GET request and return the decoded JSON response
+        Errors reported by the ImageServer in the JSON response raise a RuntimeError.
+        """
+        response_json = json.loads(self.get(url).decode("utf-8"))
+        if isinstance(response_json, dict) and "error" in response_json:
+            raise RuntimeError(
+                "Feil med spørring til ImageServeren: {}".format(response_json["error"])
+            )
+        return response_json
+
+
+default_client = ImageServerClient()
 
 
 def query_image_server(
@@ -317,42 +1068,55 @@ def query_image_server(
     query_params=None,
     print_metadata=None,
     aoi=None,
+    nprocs=1,
+    object_ids=None,
+    service_description=None,
+    cache=None,
+    client=None,
 ):
     """Query an ImageServer instance for data in space and time"""
     # ToDo: Probably more elegantly implemented as a class
     # (checking server, listing services, ...)
+    client = client or default_client
     # Get Service metadata
-    url = image_service + "?f=pjson"
-    with request.urlopen(url) as response:
-        if not response.getcode() != "200":
-            gscript.error(response.read())
-            sys.exit("Kan ikke lese fra ImageServeren.")
-        response_text = response.read()
-    service_description = json.loads(response_text.decode("utf-8"))
+    if not service_description:
+        url = image_service + "?f=pjson"
+        response_text = cache.get((url,), ttl=cache.ttl) if cache else None
+        if response_text is None:
+            response_text = client.get(url)
+            if cache:
+                cache.put((url,), response_text)
+        service_description = json.loads(response_text.decode("utf-8"))
     if print_metadata and print_metadata == "service_description":
         return service_description
 
-    # Get IDs of image(s) for selected day(s)
-    params = {
-        "returnGeometry": "false",
-        "returnIdsOnly": "true",
-        "f": "json",
-    }
-    if query_params:
-        params.update(query_params)
+    if object_ids is None:
+        # Get IDs of image(s) for selected day(s)
+        params = {
+            "returnGeometry": "false",
+            "returnIdsOnly": "true",
+            "f": "json",
+        }
+        if query_params:
+            params.update(query_params)
 
-    query_string = parse.urlencode(params)
+        query_string = parse.urlencode(params)
 
-    url = image_service + "query?" + query_string
+        url = image_service + "query?" + query_string
 
-    with request.urlopen(url) as response:
-        response_text = response.read()
-    j = json.loads(response_text.decode("utf-8"))
-    if "objectIds" not in j:
-        logging.error("Feil med spørring til ImageServeren.")
-    images = j["objectIds"]
-    if not images:
-        gscript.warning("Ingen bilder på ImageServeren for valgt tidsrom.")
+        response_text = cache.get((url,), ttl=cache.ttl) if cache else None
+        if response_text is None:
+            response_text = client.get(url)
+            if cache:
+                cache.put((url,), response_text)
+        j = json.loads(response_text.decode("utf-8"))
+        if "objectIds" not in j:
+            raise RuntimeError("Feil med spørring til ImageServeren: {}".format(j))
+        object_ids = j["objectIds"]
+        if not object_ids:
+            gscript.warning("Ingen bilder på ImageServeren for valgt tidsrom.")
+    if print_metadata and print_metadata == "object_ids":
+        return object_ids
 
     # Get url of image(s) for selected day
     if not aoi:
@@ -360,10 +1124,7 @@ def query_image_server(
         aoi["pixelSizeX"] = service_description["pixelSizeX"]
         aoi["pixelSizeY"] = service_description["pixelSizeY"]
 
-    width, height = (
-        int((aoi["xmax"] - aoi["xmin"]) / aoi["pixelSizeX"]),
-        int((aoi["ymax"] - aoi["ymin"]) / aoi["pixelSizeY"]),
-    )
+    width, height = get_grid_size(aoi)
     bbox = ",".join(map(str, [aoi["xmin"], aoi["ymin"], aoi["xmax"], aoi["ymax"]]))
     image_params = {
         "bbox": bbox,
@@ -376,52 +1137,1015 @@ def query_image_server(
     }
     query_string = parse.urlencode(image_params)
 
-    image_links = {}
-    for i in images:
-        url = image_service + str(i) + "/image?" + query_string
-        with request.urlopen(url) as response:
-            response_text = response.read()
-        j = json.loads(response_text.decode("utf-8"))
-        image_links[i] = j["href"]
+    image_urls = {
+        i: image_service + str(i) + "/image?" + query_string for i in object_ids
+    }
+
+    if not cache:
+        # Resolve links to exported images in parallel
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            image_links = dict(
+                zip(
+                    image_urls,
+                    executor.map(
+                        resolve_image_link,
+                        image_urls.values(),
+                        [client] * len(image_urls),
+                    ),
+                )
+            )
+        return image_links
+
+    # Link to cached images and download missing images to the cache in parallel
+    cache_keys = {
+        i: (image_service, i, bbox, aoi["pixelSizeX"], aoi["pixelSizeY"])
+        for i in object_ids
+    }
+    image_links = {i: cache.get_path(cache_keys[i]) for i in object_ids}
+    missing = [i for i, image_link in image_links.items() if not image_link]
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        image_links.update(
+            zip(
+                missing,
+                executor.map(
+                    download_image,
+                    [image_urls[i] for i in missing],
+                    [cache] * len(missing),
+                    [cache_keys[i] for i in missing],
+                    [client] * len(missing),
+                ),
+            )
+        )
 
     return image_links
 
 
-def get_snow_statistics_for_height_interval(
-    snow_min_elevation, snow_max_elevation, np_dtm, np_snow_ma, class_nr
+def query_acquisition_dates(
+    image_service,
+    query_params=None,
+    date_field="opptakstidspunkt",
+    object_id_field="OBJECTID",
+    cache=None,
+    client=None,
+):
+    """Get IDs of images on an ImageServer grouped by acquisition date
+    Only the ID and date fields are requested. The server returns at most
+    maxRecordCount features per response (and sets exceededTransferLimit),
+    so the query is paged with resultOffset until all features are read.
+    :param date_field: attribute with the acquisition time of the images
+    :type date_field: str
+    :param object_id_field: attribute with the image ID (objectIdField of
+                            the service description)
+    :type object_id_field: str
+    :return: dict with acquisition date (YYYY-MM-DD, UTC) as key and list of
+             image IDs as value, sorted by date
+    :rtype: dict
+    """
+    client = client or default_client
+    params = {
+        "returnGeometry": "false",
+        "outFields": f"{object_id_field},{date_field}",
+        "orderByFields": object_id_field,
+        "f": "json",
+    }
+    if query_params:
+        params.update(query_params)
+
+    acquisition_dates = {}
+    result_offset = 0
+    while True:
+        params["resultOffset"] = result_offset
+        url = image_service + "query?" + parse.urlencode(params)
+        response_text = cache.get((url,), ttl=cache.ttl) if cache else None
+        if response_text is None:
+            response_text = client.get(url)
+            if cache:
+                cache.put((url,), response_text)
+        j = json.loads(response_text.decode("utf-8"))
+        if "features" not in j:
+            raise RuntimeError("Feil med spørring til ImageServeren: {}".format(j))
+
+        for feature in j["features"]:
+            attributes = feature["attributes"]
+            acquisition_date = datetime.fromtimestamp(
+                attributes[date_field] / 1000, tz=timezone.utc
+            ).strftime("%Y-%m-%d")
+            acquisition_dates.setdefault(acquisition_date, []).append(
+                attributes[object_id_field]
+            )
+        result_offset += len(j["features"])
+        if not j.get("exceededTransferLimit") or not j["features"]:
+            break
+    return dict(sorted(acquisition_dates.items()))
+
+
+def resolve_image_link(url, client=None):
+    """Get the link to an image exported by the ImageServer"""
+    return (client or default_client).get_json(url)["href"]
+
+
+def download_image(url, cache, cache_key, client=None):
+    """Export an image from the ImageServer into the cache
+    :return: path to the cached image
+    :rtype: str
+    """
+    client = client or default_client
+    return cache.put(cache_key, client.get(resolve_image_link(url, client)))
+
+
+@contextmanager
+def open_image(image_link, client=None):
+    """Open an image from a URL or a local (cached) file with GDAL
+    Images from URLs are downloaded over the keep-alive connection of the
+    client into GDAL's in-memory file system, which is cleaned up when
+    leaving the context.
+    """
+    if image_link.startswith("http"):
+        image_path = f"/vsimem/{uuid4().hex}.tif"
+        gdal.FileFromMemBuffer(image_path, (client or default_client).get(image_link))
+    else:
+        image_path = image_link
+    img_ds = gdal.Open(image_path)
+    try:
+        yield img_ds
+    finally:
+        img_ds = None
+        if image_path != image_link:
+            gdal.Unlink(image_path)
+
+
+def read_image(image_link, client=None):
+    """Read an image exported by the ImageServer into a numpy array"""
+    with metrics.stage("image_read"), open_image(image_link, client=client) as img_ds:
+        if not img_ds:
+            raise RuntimeError(f"Kan ikke lese bilde fra {image_link}.")
+        metrics.add("images_read")
+        return np.array(img_ds.ReadAsArray())
+
+
+def supports_server_mean(service_description):
+    """Check if an ImageServer can average images with a mosaic rule
+    Requires locking rasters (LockRaster in allowedMosaicMethods) and mosaic
+    operators (mosaicOperator), which only mosaic datasets have.
+    :param service_description: service description of the ImageServer
+    :type service_description: dict
+    :rtype: bool
+    """
+    mosaic_methods = service_description.get("allowedMosaicMethods", "").split(",")
+    return "LockRaster" in mosaic_methods and bool(
+        service_description.get("mosaicOperator")
+    )
+
+
+def compute_mean_on_server(
+    image_service, object_ids, aoi, cache=None, client=None, compact=False
 ):
-    """Compute snow statistics for altitude range"""
-    gscript.verbose("Beregner verdier for klasse {}".format(class_nr))
-    gscript.verbose("Klassens minimumshøyde er {}m".format(snow_min_elevation))
-    gscript.verbose("Klassens maximumshøyde er {}m".format(snow_max_elevation))
+    """Let the ImageServer compute the per-pixel mean snow cover of several images
+    Invalid values (outside 101-200) of every image are set to NoData with a
+    Remap raster function applied per item (itemRenderingRule of the mosaic
+    rule), before the valid values of the images are averaged (MT_MEAN), so
+    only one aggregated image is downloaded instead of every image.
+    :param object_ids: IDs of the images to average
+    :type object_ids: list
+    :param aoi: aligned window to export
+    :type aoi: dict
+    :param compact: return the mean as float32 instead of float64
+    :type compact: bool
+    :return: mean snow cover percentage (0 where no image has a valid value)
+    :rtype: numpy.ndarray
+    """
+    client = client or default_client
+    width, height = get_grid_size(aoi)
+    bbox = ",".join(map(str, [aoi["xmin"], aoi["ymin"], aoi["xmax"], aoi["ymax"]]))
+    # A renderingRule would be applied to the mean, so invalid values have to
+    # be masked per item
+    mosaic_rule = {
+        "mosaicMethod": "esriMosaicLockRaster",
+        "lockRasterIds": list(object_ids),
+        "mosaicOperation": "MT_MEAN",
+        "itemRenderingRule": {
+            "rasterFunction": "Remap",
+            "rasterFunctionArguments": {
+                "NoDataRanges": [0, 101, 201, 256],
+                "AllowUnmatched": True,
+            },
+        },
+    }
+    export_params = {
+        "bbox": bbox,
+        "size": f"{width},{height}",
+        "format": "tiff",
+        "pixelType": "F32",
+        "noData": -1,
+        "interpolation": "RSP_NearestNeighbor",
+        "mosaicRule": json.dumps(mosaic_rule),
+        "f": "json",
+    }
+    url = image_service + "exportImage?" + parse.urlencode(export_params)
+
+    cache_key = (
+        image_service,
+        "MT_MEAN_ITEM_REMAP",
+        sorted(object_ids),
+        bbox,
+        width,
+        height,
+    )
+    image_link = cache.get_path(cache_key) if cache else None
+    if not image_link:
+        if cache:
+            image_link = download_image(url, cache, cache_key, client)
+        else:
+            image_link = resolve_image_link(url, client)
+    img = read_image(image_link, client)
+
+    mean_snow = np.zeros(img.shape, dtype=np.float32 if compact else np.float64)
+    np.subtract(img, 100, out=mean_snow, where=img >= 100)
+    return mean_snow
+
+
+def gather_pixels(array, pixel_index=None):
+    """Gather pixels at flat indices of an array into a 1-D array
+    Returns the array unchanged if pixel_index (or array) is None.
+    """
+    if array is None or pixel_index is None:
+        return array
+    return np.take(array, pixel_index)
+
+
+def fetch_images(image_links, nprocs=1, client=None):
+    """Read images concurrently and yield them as they arrive
+    Not more than ``nprocs`` images are downloaded at the same time, so
+    memory use is bound by the number of workers, not by the number of images.
+    Images are yielded in order of arrival, not in the order of ``image_links``.
+    :param image_links: iterable with links to images exported by the ImageServer
+    :type image_links: iterable
+    :param nprocs: number of images to download in parallel
+    :type nprocs: int
+    :param client: client for downloading images from the ImageServer
+    :type client: ImageServerClient
+    :return: generator of numpy arrays
+    """
+    image_links = iter(image_links)
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        pending = {
+            executor.submit(read_image, image_link, client)
+            for image_link in islice(image_links, nprocs)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                image_link = next(image_links, None)
+                if image_link is not None:
+                    pending.add(executor.submit(read_image, image_link, client))
+                yield future.result()
+
 
-    np_dtm_class_ma = np.ma.masked_where(
-        (np_dtm < snow_min_elevation) | (np_dtm > snow_max_elevation), np_dtm, copy=True
+def read_dtm(
+    reference_grid,
+    dtm_image_service,
+    dtm_service_description,
+    spatial_ref,
+    cache=None,
+    client=None,
+    data_type=gdal.GDT_Float32,
+):
+    """Read DTM from the ImageServer and aggregate it to the reference grid
+    With data_type gdal.GDT_Int16, the aggregated elevation is rounded to
+    whole meters, which halves the memory used for the DTM.
+    """
+    dtm_ref_grid = dtm_service_description["fullExtent"].copy()
+    dtm_ref_grid["is_latlong"] = bool(spatial_ref.IsGeographic())
+    dtm_ref_grid["pixelSizeX"], dtm_ref_grid["pixelSizeY"] = (
+        dtm_service_description["pixelSizeX"],
+        dtm_service_description["pixelSizeY"],
+    )
+    dtm_aoi = align_windows(
+        {key: reference_grid[key] for key in ("xmin", "xmax", "ymin", "ymax")},
+        dtm_ref_grid,
+    )
+
+    dtm = query_image_server(
+        image_service=dtm_image_service,
+        aoi=dtm_aoi,
+        service_description=dtm_service_description,
+        cache=cache,
+        client=client,
     )
+    with open_image(list(dtm.values())[0], client=client) as dtm_ds:
+        return aggregate_raster(
+            dtm_ds,
+            reference_grid,
+            spatial_ref,
+            data_type=data_type,
+            agg_alg=gdal.GRA_Average,
+        )
 
-    mask = np.ma.getmask(np_dtm_class_ma)
-    np_snow_ma_ma = np.ma.MaskedArray(np_snow_ma, mask)
 
-    snow_class_mean_percentage = round(np_snow_ma_ma.mean(), 2) or -9999
-    snow_class_min_percentage = round(np_snow_ma_ma.min(), 2) or -9999
-    snow_class_max_percentage = round(np_snow_ma_ma.max(), 2) or -9999
+class DTMStore:
+    """Persistent store of the DTM resampled to the grid of the snow service
+    The DTM is downloaded and aggregated to the full extent of the snow
+    service once and saved as a numpy file, together with rasters of
+    elevation band indices for the band edges in use. Both are memory-mapped,
+    so the DTM of a window is a slice of the stored array without network
+    access or copying.
+    In compact mode, the DTM is stored as int16 (whole meters) instead of
+    float32.
+    """
 
-    gscript.verbose(
-        "Klassens gjennomsnittlig snøprosent er {}%".format(snow_class_mean_percentage)
+    def __init__(self, store_directory, ref_grid, dtm_image_service, compact=False):
+        """
+        :param store_directory: directory to store the DTM in
+        :type store_directory: str
+        :param ref_grid: dict with full extent and pixel size of the snow service
+        :type ref_grid: dict
+        :param dtm_image_service: URL of the image service with the DTM
+        :type dtm_image_service: str
+        :param compact: store the DTM as int16 instead of float32
+        :type compact: bool
+        """
+        self.store_directory = Path(store_directory)
+        self.store_directory.mkdir(parents=True, exist_ok=True)
+        self.ref_grid = ref_grid
+        self.dtm_image_service = dtm_image_service
+        self.dtype = np.dtype(np.int16 if compact else np.float32)
+        self.shape = get_grid_size(ref_grid)[::-1]
+        grid_key = [dtm_image_service] + [
+            ref_grid[key]
+            for key in ("xmin", "ymin", "xmax", "ymax", "pixelSizeX", "pixelSizeY")
+        ]
+        self._key = hashlib.sha256(json.dumps(grid_key).encode("utf-8")).hexdigest()
+        self.dtm_path = (
+            self.store_directory / f"dtm_{self._key[:16]}_{self.dtype.name}.npy"
+        )
+        self._dtm = None
+        self._band_rasters = {}
+
+    def exists(self):
+        """Check if the DTM has been stored already"""
+        return self.dtm_path.exists()
+
+    def build(self, spatial_ref, cache=None, client=None):
+        """Download the DTM for the full extent and store it on the reference grid
+        The DTM is downloaded in tiles that do not exceed the export limits
+        of the image service.
+        """
+        dtm_service_description = query_image_server(
+            image_service=self.dtm_image_service,
+            print_metadata="service_description",
+            cache=cache,
+            client=client,
+        )
+        max_export = min(
+            dtm_service_description.get("maxImageWidth") or 4000,
+            dtm_service_description.get("maxImageHeight") or 4000,
+        )
+        tile_size = max(
+            1,
+            int(
+                max_export
+                * min(
+                    dtm_service_description["pixelSizeX"] / self.ref_grid["pixelSizeX"],
+                    dtm_service_description["pixelSizeY"] / self.ref_grid["pixelSizeY"],
+                )
+            )
+            - 1,
+        )
+        grid = dict(self.ref_grid, height=self.shape[0], width=self.shape[1])
+
+        tmp_path = self.dtm_path.with_suffix(".tmp.npy")
+        dtm = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=self.dtype, shape=self.shape
+        )
+        data_type = gdal.GDT_Int16 if self.dtype == np.int16 else gdal.GDT_Float32
+        for tile in split_window(grid, tile_size):
+            dtm[
+                tile["row_offset"] : tile["row_offset"] + tile["height"],
+                tile["col_offset"] : tile["col_offset"] + tile["width"],
+            ] = read_dtm(
+                tile,
+                self.dtm_image_service,
+                dtm_service_description,
+                spatial_ref,
+                cache=cache,
+                client=client,
+                data_type=data_type,
+            )
+        dtm.flush()
+        dtm = None
+        os.replace(tmp_path, self.dtm_path)
+
+    def _get_slice(self, window):
+        """Get the position of a window (aligned to the reference grid) in the store"""
+        row_offset = round(
+            (self.ref_grid["ymax"] - window["ymax"]) / self.ref_grid["pixelSizeY"]
+        )
+        col_offset = round(
+            (window["xmin"] - self.ref_grid["xmin"]) / self.ref_grid["pixelSizeX"]
+        )
+        height = round((window["ymax"] - window["ymin"]) / self.ref_grid["pixelSizeY"])
+        width = round((window["xmax"] - window["xmin"]) / self.ref_grid["pixelSizeX"])
+        return (
+            slice(row_offset, row_offset + height),
+            slice(col_offset, col_offset + width),
+        )
+
+    def contains(self, window):
+        """Check if a window lies within the extent of the store"""
+        rows, cols = self._get_slice(window)
+        return (
+            rows.start >= 0
+            and cols.start >= 0
+            and rows.stop <= self.shape[0]
+            and cols.stop <= self.shape[1]
+        )
+
+    def get_dtm(self, window):
+        """Get the DTM of a window as a (read-only) view of the memory-mapped store"""
+        if self._dtm is None:
+            self._dtm = np.load(self.dtm_path, mmap_mode="r")
+        return self._dtm[self._get_slice(window)]
+
+    def get_band_raster(self, window, band_edges):
+        """Get elevation band indices of a window for the given band edges
+        The band raster is computed from the stored DTM on first use and
+        stored next to it. Pixels below the lowest edge get index -1.
+        """
+        edges_key = hashlib.sha256(band_edges.tobytes()).hexdigest()[:16]
+        if edges_key not in self._band_rasters:
+            band_path = self.store_directory / f"bands_{self._key[:16]}_{edges_key}.npy"
+            if not band_path.exists():
+                self._build_band_raster(band_path, band_edges)
+            self._band_rasters[edges_key] = np.load(band_path, mmap_mode="r")
+        return self._band_rasters[edges_key][self._get_slice(window)]
+
+    def _build_band_raster(self, band_path, band_edges, chunk_rows=1024):
+        """Digitize the stored DTM into band indices chunk by chunk"""
+        dtm = np.load(self.dtm_path, mmap_mode="r")
+        tmp_path = band_path.with_suffix(".tmp.npy")
+        band_raster = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.int16, shape=self.shape
+        )
+        for row in range(0, self.shape[0], chunk_rows):
+            band_raster[row : row + chunk_rows] = (
+                np.digitize(dtm[row : row + chunk_rows], band_edges) - 1
+            )
+        band_raster.flush()
+        band_raster = None
+        os.replace(tmp_path, band_path)
+
+
+class SnowAccumulator:
+    """Accumulate fractional snow cover over several images pixel by pixel
+    Valid snow cover values (100-200 in the ImageServer encode 0-100 %) are
+    added to preallocated buffers in place, so memory use is about one image
+    plus the accumulators, independent of the number of images added.
+    Optionally, per-pixel minimum, maximum and last valid snow cover are kept
+    as composites.
+    In compact mode, sums are kept as the smallest unsigned integer type that
+    can hold ``max_images`` values of 100 % (uint16 for up to 655 images)
+    instead of float64, and the mean is returned as float32.
+    """
+
+    nodata = 255
+
+    def __init__(self, shape, max_images=255, keep_composites=False, compact=False):
+        """
+        :param shape: shape of the images to accumulate
+        :type shape: tuple
+        :param max_images: maximum number of images to accumulate, used
+                           to choose the data type of the counter
+        :type max_images: int
+        :param keep_composites: whether to keep per-pixel minimum, maximum
+                                and last valid snow cover
+        :type keep_composites: bool
+        :param compact: accumulate in unsigned integers instead of float64
+        :type compact: bool
+        """
+        self.images = 0
+        self.compact = compact
+        self.sum = np.zeros(
+            shape,
+            dtype=np.min_scalar_type(100 * max_images) if compact else np.float64,
+        )
+        self.count = np.zeros(shape, dtype=np.min_scalar_type(max_images))
+        self.keep_composites = keep_composites
+        if keep_composites:
+            self.min = np.full(shape, self.nodata, dtype=np.uint8)
+            self.max = np.zeros(shape, dtype=np.uint8)
+            self.last = np.zeros(shape, dtype=np.uint8)
+        # Buffers reused for every image
+        self._valid = np.empty(shape, dtype=np.bool_)
+        self._buffer = np.empty(shape, dtype=np.bool_)
+        self._value = np.zeros(shape, dtype=np.uint8)
+
+    def _read_values(self, img):
+        """Decode valid snow cover values of an image into the buffers"""
+        np.greater(img, 100, out=self._valid)
+        np.less_equal(img, 200, out=self._buffer)
+        np.logical_and(self._valid, self._buffer, out=self._valid)
+        np.subtract(img, 100, out=self._value, where=self._valid, casting="unsafe")
+
+    def add(self, img):
+        """Add valid snow cover values of an image to the accumulators"""
+        self._read_values(img)
+        np.add(self.sum, self._value, out=self.sum, where=self._valid)
+        np.add(self.count, 1, out=self.count, where=self._valid)
+        if self.keep_composites:
+            np.minimum(self.min, self._value, out=self.min, where=self._valid)
+            np.maximum(self.max, self._value, out=self.max, where=self._valid)
+            np.copyto(self.last, self._value, where=self._valid)
+        self.images += 1
+
+    def remove(self, img):
+        """Remove valid snow cover values of a previously added image
+        Used to move a time window without adding all images again. Composites
+        cannot be reverted, so this is only possible without composites.
+        """
+        if self.keep_composites:
+            raise RuntimeError("Composites cannot be reverted.")
+        self._read_values(img)
+        np.subtract(self.sum, self._value, out=self.sum, where=self._valid)
+        np.subtract(self.count, 1, out=self.count, where=self._valid)
+        self.images -= 1
+
+    def save(self, path, object_ids):
+        """Save the accumulators together with the IDs of the added images"""
+        if self.keep_composites:
+            raise RuntimeError("Composites cannot be saved.")
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            sum=self.sum,
+            count=self.count,
+            object_ids=np.asarray(object_ids, dtype=np.int64),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_images=255, compact=False):
+        """Restore an accumulator saved with ``save``
+        :return: accumulator and list of IDs of the images added to it
+        :rtype: tuple
+        """
+        with np.load(path) as state:
+            object_ids = state["object_ids"].tolist()
+            accumulator = cls(
+                state["sum"].shape,
+                max_images=max(max_images, len(object_ids)),
+                compact=compact,
+            )
+            accumulator.sum[...] = state["sum"]
+            accumulator.count[...] = state["count"]
+        accumulator.images = len(object_ids)
+        return accumulator, object_ids
+
+    def mean(self):
+        """Return per-pixel mean snow cover (0 where no valid value was added)"""
+        mean = np.zeros(
+            self.sum.shape, dtype=np.float32 if self.compact else np.float64
+        )
+        np.divide(self.sum, self.count, out=mean, where=self.count != 0)
+        return mean
+
+    def get_composites(self):
+        """Return per-pixel minimum, maximum and last valid snow cover
+        Pixels without any valid value are set to ``nodata``
+        :return: dict with composite name as key and numpy array as value
+        :rtype: dict
+        """
+        if not self.keep_composites:
+            raise RuntimeError("Composites are not kept by this accumulator.")
+        no_value = self.count == 0
+        composites = {}
+        for name, composite in {
+            "min": self.min,
+            "max": self.max,
+            "last": self.last,
+        }.items():
+            composite = composite.copy()
+            composite[no_value] = self.nodata
+            composites[name] = composite
+        return composites
+
+
+def get_state_path(state_directory, image_service, window, window_days, aoi_key=None):
+    """Get the path to the saved accumulator state of a window
+    The state only depends on the pixels of the window and the length of the
+    time period, so it is shared by all AOIs with the same window, unless
+    only pixels within the AOI are accumulated (``aoi_key`` is given).
+    """
+    state_key = [
+        image_service,
+        window["bbox"],
+        window["pixelSizeX"],
+        window["pixelSizeY"],
+        window_days,
+    ]
+    if aoi_key:
+        state_key.append(aoi_key)
+    digest = hashlib.sha256(json.dumps(state_key).encode("utf-8")).hexdigest()
+    return Path(state_directory) / f"snow_{digest[:16]}.npz"
+
+
+def create_composite_rasters(reference_grid, spatial_ref, output_directory):
+    """Create GeoTIFF files for snow cover composites of the reference grid"""
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    composite_rasters = {}
+    for name in ("min", "max", "last"):
+        target_ds = create_gdal_raster(
+            reference_grid,
+            spatial_ref,
+            gdal.GDT_Byte,
+            ds_name=str(output_directory / f"snow_{name}.tif"),
+            driver_name="GTiff",
+        )
+        target_band = target_ds.GetRasterBand(1)
+        target_band.SetNoDataValue(SnowAccumulator.nodata)
+        target_band.Fill(SnowAccumulator.nodata)
+        composite_rasters[name] = target_ds
+    return composite_rasters
+
+
+def write_composites(accumulator, composite_rasters, tile, pixel_index=None):
+    """Write snow cover composites of an accumulator into the composite rasters
+    at the position of the tile (scattering pixels gathered with pixel_index
+    back onto the tile)"""
+    for name, composite in accumulator.get_composites().items():
+        if pixel_index is not None:
+            tile_composite = np.full(
+                (tile["height"], tile["width"]), accumulator.nodata, dtype=np.uint8
+            )
+            tile_composite.flat[pixel_index] = composite
+            composite = tile_composite
+        composite_rasters[name].GetRasterBand(1).WriteArray(
+            composite, xoff=tile.get("col_offset", 0), yoff=tile.get("row_offset", 0)
+        )
+
+
+def get_band_edges(
+    snow_bands=250, snow_band_edges=None, min_elevation=-500, max_elevation=9000
+):
+    """Get edges of the elevation bands to compute snow cover for
+    :param snow_bands: Altitude steps (bands) in meter, used for uniform
+                       bands (multiples of snow_bands) from ``min_elevation``
+                       to ``max_elevation``
+    :type snow_bands: int
+    :param snow_band_edges: ascending altitudes in meter of (non-uniform)
+                            band edges, overrides ``snow_bands``
+    :type snow_band_edges: list
+    :return: 1-D numpy array with band edges, band i covers
+             edges[i] <= elevation <= edges[i + 1] (see ``SnowStatistics``)
+    :rtype: numpy.ndarray
+    """
+    if snow_band_edges:
+        band_edges = np.asarray(snow_band_edges, dtype=np.float64)
+        if band_edges.size < 2 or np.any(np.diff(band_edges) <= 0):
+            raise ValueError("Høydegrensene må være minst to stigende verdier.")
+        return band_edges
+    return np.arange(
+        np.floor(min_elevation / snow_bands) * snow_bands,
+        max_elevation + snow_bands,
+        snow_bands,
+        dtype=np.float64,
+    )
+
+
+class PartialStatistics:
+    """Count, sum, minimum and maximum of values per zone
+    All statistics are numpy arrays with one element per zone. Partial
+    statistics of separate parts of the data can be merged.
+    """
+
+    def __init__(self, n_zones=1):
+        self.count = np.zeros(n_zones, dtype=np.int64)
+        self.sum = np.zeros(n_zones, dtype=np.float64)
+        self.min = np.full(n_zones, np.inf)
+        self.max = np.full(n_zones, -np.inf)
+
+    def update(self, values, zones=None):
+        """Add values to the statistics in one pass over the data
+        :param values: 1-D numpy array of values
+        :type values: numpy.ndarray
+        :param zones: 1-D numpy array with the zone index (0 ... n_zones - 1)
+                      of each value, None if all values belong to the first zone
+        :type zones: numpy.ndarray
+        """
+        if not values.size:
+            return self
+        n_zones = self.count.size
+        if zones is None or n_zones == 1:
+            self.count[0] += values.size
+            self.sum[0] += values.sum(dtype=np.float64)
+            self.min[0] = min(self.min[0], values.min())
+            self.max[0] = max(self.max[0], values.max())
+            return self
+        self.count += np.bincount(zones, minlength=n_zones)
+        self.sum += np.bincount(zones, weights=values, minlength=n_zones)
+        np.minimum.at(self.min, zones, values)
+        np.maximum.at(self.max, zones, values)
+        return self
+
+    def merge(self, other):
+        """Merge partial statistics of another part of the data"""
+        self.count += other.count
+        self.sum += other.sum
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def mean(self):
+        """Return mean of the values per zone (NaN for zones without values)"""
+        mean = np.full(self.sum.shape, np.nan)
+        np.divide(self.sum, self.count, out=mean, where=self.count > 0)
+        return mean
+
+
+class SnowStatistics:
+    """Mergeable statistics of snow cover per zone of an Area of Interest
+    Holds the number of pixels in each zone, statistics and a histogram
+    (1 % bins) of snow cover percentage in pixels with snow, statistics of
+    terrain elevation in pixels with snow, and snow cover statistics per
+    elevation band. Statistics of tiles merged together give the same result
+    as statistics of the whole Area of Interest. Elevation bands include
+    both edges, so pixels on the edge between two bands count in both.
+    """
+
+    band_statistics_dtype = np.dtype(
+        [
+            ("lower", np.float64),
+            ("upper", np.float64),
+            ("count", np.int64),
+            ("mean", np.float64),
+            ("min", np.float64),
+            ("max", np.float64),
+        ]
     )
+
+    def __init__(self, band_edges, n_zones=1):
+        """
+        :param band_edges: edges of the elevation bands to compute snow cover
+                           for (as returned by ``get_band_edges``)
+        :type band_edges: numpy.ndarray
+        :param n_zones: number of zones (features) in the Area of Interest
+        :type n_zones: int
+        """
+        self.band_edges = band_edges
+        self.n_bands = len(band_edges) - 1
+        self.n_zones = n_zones
+        self.area_count = np.zeros(n_zones, dtype=np.int64)
+        self.snow = PartialStatistics(n_zones)
+        self.elevation = PartialStatistics(n_zones)
+        # Statistics per band and zone (index: zone * n_bands + band)
+        self.bands = PartialStatistics(n_zones * self.n_bands)
+        self.histogram = np.zeros((n_zones, 101), dtype=np.int64)
+
+    def update(self, np_snow_ma, zone_raster, np_dtm=None, band_raster=None):
+        """Add statistics of a tile
+        :param np_snow_ma: snow cover percentage, masked where pixels are
+                           outside the Area of Interest or without snow
+        :type np_snow_ma: numpy.ma.MaskedArray
+        :param zone_raster: zone number (1 ... n_zones) of the pixels, 0 (or
+                            False) outside the Area of Interest
+        :type zone_raster: numpy.ndarray
+        :param np_dtm: terrain elevation on the grid of the tile
+        :type np_dtm: numpy.ndarray
+        :param band_raster: precomputed elevation band indices of the tile
+                            (computed from ``np_dtm`` if not given)
+        :type band_raster: numpy.ndarray
+        """
+        self.area_count += np.bincount(
+            zone_raster.ravel().astype(np.intp), minlength=self.n_zones + 1
+        )[1:]
+        snow_mask = ~np.ma.getmaskarray(np_snow_ma)
+        snow_values = np_snow_ma.data[snow_mask]
+        if snow_values.size == 0:
+            return self
+        snow_zones = zone_raster[snow_mask].astype(np.intp) - 1
+        self.snow.update(snow_values, snow_zones)
+        self.histogram += np.bincount(
+            snow_zones * 101 + snow_values.astype(np.intp),
+            minlength=self.n_zones * 101,
+        ).reshape(self.n_zones, 101)
+        if np_dtm is None:
+            return self
+
+        dtm_values = np_dtm[snow_mask]
+        self.elevation.update(dtm_values, snow_zones)
+
+        # Digitize elevation into bands once and reduce per zone and band
+        if band_raster is None:
+            snow_classes = np.digitize(dtm_values, self.band_edges) - 1
+        else:
+            snow_classes = band_raster[snow_mask].astype(np.intp)
+        in_bands = (snow_classes >= 0) & (snow_classes < self.n_bands)
+        # Bands include both edges, so pixels with the elevation of the edge
+        # between two bands count in both bands
+        on_edge = (snow_classes > 0) & (snow_classes <= self.n_bands)
+        on_edge[on_edge] = dtm_values[on_edge] == self.band_edges[snow_classes[on_edge]]
+        self.bands.update(
+            np.concatenate((snow_values[in_bands], snow_values[on_edge])),
+            np.concatenate(
+                (
+                    snow_zones[in_bands] * self.n_bands + snow_classes[in_bands],
+                    snow_zones[on_edge] * self.n_bands + snow_classes[on_edge] - 1,
+                )
+            ),
+        )
+        return self
+
+    def merge(self, other):
+        """Merge statistics of another tile"""
+        self.area_count += other.area_count
+        self.snow.merge(other.snow)
+        self.elevation.merge(other.elevation)
+        self.bands.merge(other.bands)
+        self.histogram += other.histogram
+        return self
+
+    def get_band_statistics(self, zone=0):
+        """Get snow statistics per elevation band of a zone
+        :return: structured numpy array with lower and upper band edge, count,
+                 mean, min and max of snow cover percentage for bands with snow
+        :rtype: numpy.ndarray
+        """
+        zone_bands = slice(zone * self.n_bands, (zone + 1) * self.n_bands)
+        band_statistics = np.zeros(self.n_bands, dtype=self.band_statistics_dtype)
+        band_statistics["lower"] = self.band_edges[:-1]
+        band_statistics["upper"] = self.band_edges[1:]
+        band_statistics["count"] = self.bands.count[zone_bands]
+        band_statistics["mean"] = self.bands.mean()[zone_bands]
+        band_statistics["min"] = self.bands.min[zone_bands]
+        band_statistics["max"] = self.bands.max[zone_bands]
+        return band_statistics[band_statistics["count"] > 0]
+
+
+def estimate_coarse_error(snow_statistics, zone=0, coarse_factor=1, px_area=1.0):
+    """Estimate standard errors of statistics computed on a coarser grid
+    Pixels of a grid coarsened by ``coarse_factor`` are treated as a sample
+    of 1 / coarse_factor**2 of the pixels at full resolution (the ImageServer
+    resamples with nearest neighbour), so standard errors follow from
+    sampling without replacement. Spatially correlated snow cover usually
+    gives smaller errors than estimated.
+    :return: standard errors of snow_mean_percentage (in percentage points)
+             and of snow_area (in km2)
+    :rtype: dict
+    """
+    finite_population = 1 - 1 / coarse_factor**2
+    area_count = int(snow_statistics.area_count[zone])
+    snow_count = int(snow_statistics.snow.count[zone])
+    snow_share = snow_count / area_count
+    # Variance of snow cover from the histogram (1 % bins)
+    histogram = snow_statistics.histogram[zone]
+    bin_centers = np.minimum(np.arange(histogram.size) + 0.5, 100)
+    variance = float(
+        np.sum(histogram * (bin_centers - snow_statistics.snow.mean()[zone]) ** 2)
+        / snow_count
+    )
+    share_error = sqrt(snow_share * (1 - snow_share) / area_count * finite_population)
+    return {
+        "snow_mean_percentage": round(
+            sqrt(variance / snow_count * finite_population), 2
+        ),
+        "snow_area": round(share_error * area_count * px_area / 1000000, 4),
+    }
+
+
+def get_result_dict(
+    snow_statistics,
+    zone=0,
+    px_area=1.0,
+    min_snow_percent=20.0,
+    include_histogram=False,
+    dtm_failed=False,
+    coarse_factor=1,
+    drop_zero_band=False,
+):
+    """Compile snow statistics of a zone to a dictionary for output
+    Statistics computed on a grid coarsened by ``coarse_factor`` get an
+    estimate of their error against full resolution ("_error_estimate").
+    With ``drop_zero_band``, the elevation band starting at 0 m is not
+    reported (as for uniform bands before tiling).
+    """
+    snow_count = int(snow_statistics.snow.count[zone])
+    if snow_count == 0:
+        raise Exception(
+            "Fant ingen gyldige piksler. Dette er enten fordi det ikke finnes raster for valgt dato eller at angitt polygon ikke overlapper med raster."
+        )
+
+    res_dict = {
+        "snow_area": float(snow_count * px_area / 1000000),
+        "snow_mean_percentage": float(round(snow_statistics.snow.mean()[zone], 2)),
+        "snow_min_percentage": float(round(snow_statistics.snow.min[zone], 2)),
+        "snow_max_percentage": float(round(snow_statistics.snow.max[zone], 2)),
+    }
+
     gscript.verbose(
-        "Klassens minimum snøprosent er {}%".format(snow_class_min_percentage)
+        "Gjennomsnittlig snøprosent er {}%".format(res_dict["snow_mean_percentage"])
     )
+    gscript.verbose("Minimum snøprosent er {}%".format(res_dict["snow_min_percentage"]))
+    gscript.verbose("Maximum snøprosent er {}%".format(res_dict["snow_max_percentage"]))
+
+    # The analysis area is the snow covered area as before tiling (so
+    # area_with_snow is 100 %), the pixels of the AOI are in area_count
+    res_dict["area_complete"] = float(snow_count * px_area / 1000000)
+
     gscript.verbose(
-        "Klassens maximum snøprosent er {}%".format(snow_class_max_percentage)
+        "Areal for piklser med minst {min_snow}% snø er {areal}km2".format(
+            min_snow=min_snow_percent, areal=res_dict["snow_area"]
+        )
     )
+    gscript.verbose("Analyseareal er {}km2".format(res_dict["area_complete"]))
 
-    return (
-        snow_class_mean_percentage,
-        snow_class_min_percentage,
-        snow_class_max_percentage,
+    res_dict["area_with_snow"] = float(
+        round(res_dict["snow_area"] / res_dict["area_complete"] * 100, 2)
     )
 
+    if coarse_factor > 1:
+        res_dict["coarse_factor"] = coarse_factor
+        res_dict["_error_estimate"] = estimate_coarse_error(
+            snow_statistics, zone, coarse_factor, px_area
+        )
+
+    if include_histogram:
+        res_dict["snow_percentage_histogram"] = snow_statistics.histogram[zone].tolist()
+
+    # Find elevation for pixels with snow
+    res_dict["snow_mean_elevation"] = -9999
+    res_dict["snow_min_elevation"] = -9999
+    res_dict["snow_max_elevation"] = -9999
+
+    # Compute on altitude bands
+    if dtm_failed or snow_statistics.elevation.count[zone] == 0:
+        gscript.warning("Fant ingen terrenghøyde for piksler med snø.")
+    elif (res_dict["snow_min_percentage"]) > 0:
+        res_dict["snow_mean_elevation"] = float(
+            round(snow_statistics.elevation.mean()[zone], 2)
+        )
+        res_dict["snow_min_elevation"] = float(
+            round(snow_statistics.elevation.min[zone], 2)
+        )
+        res_dict["snow_max_elevation"] = float(
+            round(snow_statistics.elevation.max[zone], 2)
+        )
+
+        gscript.verbose(
+            "Gjennomsnittlig terrenghøyde med snø er {} meter".format(
+                res_dict["snow_mean_elevation"]
+            )
+        )
+        gscript.verbose(
+            "Laveste terrenghøyde med snø er {} meter".format(
+                res_dict["snow_min_elevation"]
+            )
+        )
+        gscript.verbose(
+            "Høyeste terrenghøyde med snø er {} meter".format(
+                res_dict["snow_max_elevation"]
+            )
+        )
+
+        band_statistics = snow_statistics.get_band_statistics(zone)
+        if drop_zero_band:
+            band_statistics = band_statistics[band_statistics["lower"] != 0]
+
+        snow_diff_elevation = (
+            res_dict["snow_max_elevation"] - res_dict["snow_min_elevation"]
+        ) / max(len(band_statistics), 1)
+        gscript.verbose("snow_diff_elevation er {} meter".format(snow_diff_elevation))
+
+        for snow_class in band_statistics:
+            snow_class_name = "snow_{:g}m_to_{:g}m".format(
+                snow_class["lower"], snow_class["upper"]
+            )
+            gscript.verbose(
+                "Klassens minimumshøyde er {:g}m".format(snow_class["lower"])
+            )
+            gscript.verbose(
+                "Klassens maximumshøyde er {:g}m".format(snow_class["upper"])
+            )
+
+            res_dict[f"{snow_class_name}_mean_percentage"] = float(
+                round(snow_class["mean"], 2)
+            )
+            res_dict[f"{snow_class_name}_min_percentage"] = float(snow_class["min"])
+            res_dict[f"{snow_class_name}_max_percentage"] = float(snow_class["max"])
+
+            gscript.verbose(
+                "Klassens gjennomsnittlig snøprosent er {}%".format(
+                    res_dict[f"{snow_class_name}_mean_percentage"]
+                )
+            )
+    else:
+        gscript.warning(
+            "Minimum snøprosent er {}. Beregner derfor ikke høyde".format(
+                res_dict["snow_min_percentage"]
+            )
+        )
+
+    return res_dict
+
 
 DATA_TYPES = {
     "U1": gdal.GDT_Byte,
@@ -445,6 +2169,63 @@ DATA_TYPES = {
 }
 
 
+def write_timeseries(results, output_path):
+    """Write results per acquisition date as a long table for bulk loading
+    Every statistic becomes one row with the columns date, aoi_id, variable
+    and value (histogram bins become one variable each). The format is
+    chosen from the file extension: .csv, .parquet or JSON lines (.jsonl or
+    .json).
+    :param results: list of result dicts with "date" and "aoi_id" keys
+    :type results: list
+    :param output_path: path to the output file
+    :type output_path: str
+    """
+    rows = []
+    for result in results:
+        for variable, value in result.items():
+            if variable in ("date", "aoi_id"):
+                continue
+            if isinstance(value, list):
+                values = {f"{variable}_{idx}": item for idx, item in enumerate(value)}
+            elif isinstance(value, dict):
+                values = {f"{variable}_{key}": item for key, item in value.items()}
+            else:
+                values = {variable: value}
+            rows.extend(
+                {
+                    "date": result["date"],
+                    "aoi_id": result["aoi_id"],
+                    "variable": name,
+                    "value": item,
+                }
+                for name, item in values.items()
+            )
+
+    output_path = Path(output_path)
+    if output_path.suffix == ".csv":
+        with open(output_path, "w", newline="", encoding="utf-8") as output_file:
+            csv_writer = csv.DictWriter(
+                output_file, fieldnames=["date", "aoi_id", "variable", "value"]
+            )
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
+    elif output_path.suffix == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Skriving til Parquet krever pyarrow.")
+        pq.write_table(pa.Table.from_pylist(rows), output_path)
+    elif output_path.suffix in (".jsonl", ".json"):
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            for row in rows:
+                output_file.write(json.dumps(row) + "\n")
+    else:
+        raise ValueError(
+            "Ukjent filformat for tidsserie: {}".format(output_path.suffix)
+        )
+
+
 def main():
     """Do the main work"""
     # User defined variables
@@ -453,7 +2234,7 @@ def main():
     dtm_service = options["dtm_service"]
     snow_service = options["snow_service"]
     date_start = options["date_start"]
-    date_end = options["date_start"]
+    date_end = options["date_end"]
 
     if not date_start:
         date_start = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
@@ -462,6 +2243,34 @@ def main():
     # Probably more userfriendly for generate relatable height intervals dynamically and
     # let user define height intervals here
     snow_bands = int(options["snow_bands"])
+    snow_band_edges = (
+        [float(edge) for edge in options["snow_band_edges"].split(",")]
+        if options["snow_band_edges"]
+        else None
+    )
+    # 0 or negative numbers of processes mean all or all but N CPUs (GRASS >= 8.3)
+    nprocs = int(options["nprocs"])
+    if nprocs <= 0:
+        nprocs = max(os.cpu_count() + nprocs, 1)
+    composite_directory = options["composite_directory"]
+    tile_size = int(options["tile_size"]) if options["tile_size"] else None
+    include_histogram = flags["i"]
+    cache_directory = options["cache_directory"]
+    cache_size = int(options["cache_size"])
+    dtm_directory = options["dtm_directory"]
+    state_directory = options["state_directory"]
+    mask_directory = options["mask_directory"]
+    timeout = float(options["timeout"])
+    retries = int(options["retries"])
+    coarse_factor = int(options["coarse_factor"])
+    per_feature = flags["f"]
+    sparse = flags["s"]
+    compact = flags["c"]
+    metrics.reset(enabled=flags["m"])
+    backend = options["backend"]
+    timeseries = flags["t"]
+    timeseries_output = options["timeseries_output"]
+    feature_id_column = options["feature_id_column"]
 
     # Currently not used
     # not_in_memory = flags["d"]
@@ -469,6 +2278,11 @@ def main():
     if not Path(aoi).exists():
         gscript.fatal(_("Finner ikke {}. Sjekk filnavn og sti.".format(aoi)))
 
+    try:
+        band_edges = get_band_edges(snow_bands, snow_band_edges)
+    except ValueError as err:
+        gscript.fatal(_("Parameter 'snow_band_edges' er ugyldig: {}".format(err)))
+
     try:
         dt_date_start = datetime.fromisoformat(date_start)
     except ValueError:
@@ -498,9 +2312,20 @@ def main():
     image_server = "{server}/{service}/ImageServer/"
 
     snow_image_service = image_server.format(server=server, service=snow_service)
-    snow_service_description = query_image_server(
-        image_service=snow_image_service, print_metadata="service_description"
+    cache = (
+        ImageServerCache(cache_directory, max_size=cache_size * 1024**2)
+        if cache_directory
+        else None
     )
+    client = ImageServerClient(timeout=timeout, retries=retries)
+
+    with metrics.stage("metadata"):
+        snow_service_description = query_image_server(
+            image_service=snow_image_service,
+            print_metadata="service_description",
+            cache=cache,
+            client=client,
+        )
 
     # Get spatial reference of ImageServer
     spatial_ref = osr.SpatialReference()
@@ -509,201 +2334,373 @@ def main():
     )
 
     # Get Area of interest
-    aoi_reproj = reproject_geojson(aoi, spatial_ref)
-    aoi_layer = aoi_reproj.GetLayerByIndex(0)
-    aoi_dict = {}
-    (
-        aoi_dict["xmin"],
-        aoi_dict["xmax"],
-        aoi_dict["ymin"],
-        aoi_dict["ymax"],
-        aoi_dict["is_latlong"],
-    ) = (*aoi_layer.GetExtent(), bool(spatial_ref.IsGeographic()))
+    aoi_key = get_aoi_key(aoi)
+    with metrics.stage("aoi"):
+        aoi_reproj = aoi_cache.reproject(aoi, spatial_ref, aoi_key=aoi_key)
+        aoi_layer = aoi_reproj.GetLayerByIndex(0)
+        aoi_dict = {}
+        (
+            aoi_dict["xmin"],
+            aoi_dict["xmax"],
+            aoi_dict["ymin"],
+            aoi_dict["ymax"],
+            aoi_dict["is_latlong"],
+        ) = (*aoi_layer.GetExtent(), bool(spatial_ref.IsGeographic()))
 
     # Create a reference grid to operate on (extent, resolution, rows, cols)
     ref_grid = snow_service_description["fullExtent"]
     ref_grid["is_latlong"] = bool(spatial_ref.IsGeographic())
     ref_grid["pixelSizeX"], ref_grid["pixelSizeY"] = (
-        snow_service_description["pixelSizeX"],
-        snow_service_description["pixelSizeY"],
+        snow_service_description["pixelSizeX"] * coarse_factor,
+        snow_service_description["pixelSizeY"] * coarse_factor,
     )
+    # A coarser grid has the same origin as the grid of the service and the
+    # AOI is aligned to that origin (see align_windows), so its pixels are
+    # nested in the pixels of the service and the ImageServer can read the
+    # images from overviews
 
     # Align Area of Interest to reference grid
     raster_aoi = align_windows(aoi_dict, ref_grid)
 
-    # Rasterize Area of interest on reference grid to be sed as mask
-    raster_mask = rasterize_aoi(raster_aoi, aoi_reproj, spatial_ref)
-
-    # Get a list of images for the requested time period from the server
-    images = query_image_server(
-        image_service=snow_image_service, query_params=query, aoi=raster_aoi
+    # Split Area of Interest into tiles that can be exported from the ImageServer
+    max_tile_size = min(
+        snow_service_description.get("maxImageWidth") or raster_aoi["width"],
+        snow_service_description.get("maxImageHeight") or raster_aoi["height"],
     )
-
-    # Create an empty numpy array
-    np_snow = np.zeros(raster_mask.shape)
-    np_snow_valid_count = np.zeros(raster_mask.shape, dtype=np.byte)
-
-    # Read images to array and compute average value over available images
-    for i in images.values():
-        img_ds = gdal.Open(f"/vsicurl/{i}")
-        img_ds = np.array(img_ds.ReadAsArray())
-        np_snow += np.where((img_ds > 100) & (img_ds <= 200), img_ds - 100, 0)
-        np_snow_valid_count += np.where((img_ds > 100) & (img_ds <= 200), 1, 0).astype(
-            np.bool_
-        )
-        img_ds = None
-    np_snow = np.divide(np_snow, np_snow_valid_count, where=np_snow_valid_count != 0)
-
-    try:
-        # Ekstra test siden extract by mask ikke feiler i Desktop
-        # bare pixler fra og med brukerdefinert grenseverdi skal være med
-        np_snow_ma = np.ma.masked_where(np_snow < min_snow_percent, np_snow, copy=True)
-        if np_snow_ma.count() == 0:
-            gscript.fatal(
-                _(
-                    "Fant ingen gyldige piksler. Dette er enten fordi det ikke finnes raster for valgt dato eller at angitt"
-                    "polygon ikke overlapper med raster."
-                )
+    if max(raster_aoi["width"], raster_aoi["height"]) > max_tile_size:
+        tile_size = min(tile_size or max_tile_size, max_tile_size)
+    tiles = split_window(raster_aoi, tile_size)
+    gscript.verbose("Analyseområdet behandles i {} fliser".format(len(tiles)))
+
+    # Get IDs of images for the requested time period from the server
+    with metrics.stage("id_query"):
+        if timeseries:
+            # Group images by acquisition date to compute statistics per date
+            image_groups = query_acquisition_dates(
+                snow_image_service,
+                query_params=query,
+                object_id_field=snow_service_description.get(
+                    "objectIdField", "OBJECTID"
+                ),
+                cache=cache,
+                client=client,
+            )
+            object_ids = [i for group_ids in image_groups.values() for i in group_ids]
+            gscript.verbose("Tidsserie med {} opptaksdatoer".format(len(image_groups)))
+        else:
+            object_ids = query_image_server(
+                image_service=snow_image_service,
+                query_params=query,
+                print_metadata="object_ids",
+                service_description=snow_service_description,
+                cache=cache,
+                client=client,
             )
+            image_groups = {None: object_ids}
 
-        px_area = raster_aoi["pixelSizeX"] * raster_aoi["pixelSizeY"]
+    if composite_directory:
+        composite_rasters = create_composite_rasters(
+            raster_aoi, spatial_ref, composite_directory
+        )
 
-        res_dict = {
-            "snow_area": float(np_snow_ma.count() * px_area / 1000000),
-            "snow_mean_percentage": float(round(np_snow_ma.mean(), 2)),
-            "snow_min_percentage": float(round(np_snow_ma.min(), 2)),
-            "snow_max_percentage": float(round(np_snow_ma.max(), 2)),
-        }
+    dtm_image_service = image_server.format(server=server, service=dtm_service)
+    dtm_service_description = None
+    dtm_store = (
+        DTMStore(dtm_directory, ref_grid, dtm_image_service, compact=compact)
+        if dtm_directory
+        else None
+    )
 
-        gscript.verbose(
-            "Gjennomsnittlig snøprosent er {}%".format(res_dict["snow_mean_percentage"])
-        )
-        gscript.verbose(
-            "Minimum snøprosent er {}%".format(res_dict["snow_min_percentage"])
-        )
-        gscript.verbose(
-            "Maximum snøprosent er {}%".format(res_dict["snow_max_percentage"])
-        )
+    # Number features in the Area of Interest if statistics are computed per feature
+    if per_feature:
+        zone_source, feature_ids = create_zone_layer(aoi_reproj, feature_id_column)
+        zone_attribute = "zone"
+    else:
+        zone_source, feature_ids, zone_attribute = aoi_reproj, [None], None
 
-        # np_snow_ma_non_zero = np.ma.masked_where(np_snow > 254, np_snow, copy=True)
-        res_dict["area_complete"] = float(np_snow_ma.count() * px_area / 1000000)
+    snow_statistics = {
+        group: SnowStatistics(band_edges, n_zones=len(feature_ids))
+        for group in image_groups
+    }
 
-        gscript.verbose(
-            "Areal for piklser med minst {min_snow}% snø er {areal}km2".format(
-                min_snow=min_snow_percent, areal=res_dict["snow_area"]
+    # Continue from the accumulator state of the previous run for the same
+    # length of time period, so only images that entered or left the period
+    # have to be read
+    incremental = bool(state_directory) and not timeseries and not composite_directory
+    if state_directory:
+        if incremental:
+            Path(state_directory).mkdir(parents=True, exist_ok=True)
+            window_days = (
+                datetime.fromisoformat(date_end) - datetime.fromisoformat(date_start)
+            ).days + 1
+        else:
+            gscript.warning(
+                "Lagret tilstand kan ikke brukes for tidsserier eller kompositter."
             )
-        )
-        gscript.verbose("Analyseareal er {}km2".format(res_dict["area_complete"]))
 
-        res_dict["area_with_snow"] = float(
-            round(res_dict["snow_area"] / res_dict["area_complete"] * 100, 2)
+    # Let the server aggregate the images if it supports mosaic rules, images
+    # are needed on the client for composites and saved accumulator state
+    server_side = backend == "server"
+    if server_side and (composite_directory or incremental):
+        gscript.warning(
+            "Aggregering på serveren kan ikke brukes med kompositter eller lagret tilstand."
         )
-
-        # Find elevation for pixels with snow
-        res_dict["snow_mean_elevation"] = -9999
-        res_dict["snow_min_elevation"] = -9999
-        res_dict["snow_max_elevation"] = -9999
-
-        # Compute on altitude bands
-        try:
-            if (res_dict["snow_min_percentage"]) > 0:
-
-                dtm_image_service = image_server.format(
-                    server=server, service=dtm_service
-                )
-                dtm_service_description = query_image_server(
-                    image_service=dtm_image_service,
-                    print_metadata="service_description",
-                )
-                dtm_ref_grid = dtm_service_description["fullExtent"]
-                dtm_ref_grid["is_latlong"] = bool(spatial_ref.IsGeographic())
-                dtm_ref_grid["pixelSizeX"], dtm_ref_grid["pixelSizeY"] = (
-                    dtm_service_description["pixelSizeX"],
-                    dtm_service_description["pixelSizeY"],
-                )
-                dtm_aoi = align_windows(aoi_dict.copy(), dtm_ref_grid)
-
-                dtm = query_image_server(image_service=dtm_image_service, aoi=dtm_aoi)
-                np_dtm = aggregate_raster(
-                    gdal.Open(f"/vsicurl/{list(dtm.values())[0]}"),
-                    raster_aoi,
-                    spatial_ref,
-                    agg_alg=gdal.GRA_Average,
+        server_side = False
+    if server_side and not supports_server_mean(snow_service_description):
+        gscript.warning("ImageServeren støtter ikke aggregering, bruker klienten.")
+        server_side = False
+
+    for tile in tiles:
+        # Rasterize Area of interest on tile to be used as mask (or zones),
+        # only pixels inside the AOI polygon (not its bounding box) are used
+        with metrics.stage("rasterize"):
+            packed_zones = aoi_cache.rasterize(
+                tile,
+                zone_source,
+                spatial_ref,
+                aoi_key,
+                attribute=zone_attribute,
+                mask_directory=mask_directory,
+            )
+            if not packed_zones.any():
+                continue
+            zone_raster = packed_zones.unpack()
+
+        # In sparse mode, only pixels within the AOI are gathered (as 1-D
+        # arrays) and processed
+        pixel_index = np.flatnonzero(zone_raster) if sparse else None
+        zones = gather_pixels(zone_raster, pixel_index)
+
+        accumulator_state, previous_ids, removed_ids = None, [], []
+        if incremental:
+            state_path = get_state_path(
+                state_directory,
+                snow_image_service,
+                tile,
+                window_days,
+                aoi_key=aoi_key if sparse else None,
+            )
+            if state_path.exists():
+                accumulator_state, previous_ids = SnowAccumulator.load(
+                    state_path, max_images=len(object_ids), compact=compact
                 )
-
-                # Create snow mask
-                mask = np.ma.getmask(np_snow_ma)
-                # Mask DTM
-                np_dtm_ma = np.ma.MaskedArray(np_dtm, mask)
-
-                res_dict["snow_mean_elevation"] = float(round(np_dtm_ma.mean(), 2))
-                res_dict["snow_min_elevation"] = float(round(np_dtm_ma.min(), 2))
-                res_dict["snow_max_elevation"] = float(round(np_dtm_ma.max(), 2))
-
+                removed_ids = [i for i in previous_ids if i not in object_ids]
                 gscript.verbose(
-                    "Gjennomsnittlig terrenghøyde med snø er {} meter".format(
-                        res_dict["snow_mean_elevation"]
+                    "{} bilder fra forrige kjøring, {} fjernes".format(
+                        len(previous_ids), len(removed_ids)
                     )
                 )
-                gscript.verbose(
-                    "Laveste terrenghøyde med snø er {} meter".format(
-                        res_dict["snow_min_elevation"]
+
+        # Composites cover all images of the time period
+        composite_accumulator = (
+            SnowAccumulator(
+                zones.shape,
+                max_images=len(object_ids),
+                keep_composites=True,
+                compact=compact,
+            )
+            if composite_directory and timeseries
+            else None
+        )
+        images = None
+        np_dtm = band_raster = None
+        dtm_read = False
+        for group, group_ids in image_groups.items():
+            np_snow = None
+            if server_side and group_ids:
+                # Let the server compute the average over available images
+                try:
+                    with metrics.stage("server_mean"):
+                        np_snow = gather_pixels(
+                            compute_mean_on_server(
+                                snow_image_service,
+                                group_ids,
+                                tile,
+                                cache=cache,
+                                client=client,
+                                compact=compact,
+                            ),
+                            pixel_index,
+                        )
+                except Exception as err:
+                    gscript.warning(
+                        "Aggregering på serveren feilet, bruker klienten: {}".format(
+                            err
+                        )
                     )
-                )
-                gscript.verbose(
-                    "Høyeste terrenghøyde med snø er {} meter".format(
-                        res_dict["snow_max_elevation"]
+                    server_side = False
+
+            if np_snow is None:
+                if images is None:
+                    # Get a list of images for the tile from the server
+                    with metrics.stage("image_links"):
+                        images = query_image_server(
+                            image_service=snow_image_service,
+                            aoi=tile,
+                            nprocs=nprocs,
+                            object_ids=[i for i in object_ids if i not in previous_ids]
+                            + removed_ids,
+                            service_description=snow_service_description,
+                            cache=cache,
+                            client=client,
+                        )
+
+                # Read images to array and compute average value over available images
+                with metrics.stage("accumulation"):
+                    if accumulator_state is not None:
+                        accumulator = accumulator_state
+                    else:
+                        accumulator = SnowAccumulator(
+                            zones.shape,
+                            max_images=len(group_ids),
+                            keep_composites=bool(composite_directory)
+                            and not timeseries,
+                            compact=compact,
+                        )
+                    for img_ds in fetch_images(
+                        [images[i] for i in group_ids if i not in previous_ids],
+                        nprocs=nprocs,
+                        client=client,
+                    ):
+                        img_ds = gather_pixels(img_ds, pixel_index)
+                        accumulator.add(img_ds)
+                        if composite_accumulator is not None:
+                            composite_accumulator.add(img_ds)
+                        img_ds = None
+                    for img_ds in fetch_images(
+                        [images[i] for i in removed_ids], nprocs=nprocs, client=client
+                    ):
+                        accumulator.remove(gather_pixels(img_ds, pixel_index))
+                        img_ds = None
+                    if incremental:
+                        accumulator.save(state_path, group_ids)
+                    np_snow = accumulator.mean()
+
+                if composite_directory and not timeseries:
+                    write_composites(
+                        accumulator, composite_rasters, tile, pixel_index=pixel_index
                     )
-                )
 
-                snow_classes = [
-                    snow_class
-                    for snow_class in np.unique(
-                        np.floor(np_dtm_ma / snow_bands).astype(np.int8)
-                    )
-                    if snow_class
-                ]
+            metrics.add("pixels_processed", zones.size)
 
-                snow_diff_elevation = (
-                    res_dict["snow_max_elevation"] - res_dict["snow_min_elevation"]
-                ) / len(snow_classes)
-                gscript.verbose(
-                    "snow_diff_elevation er {} meter".format(snow_diff_elevation)
-                )
+            # Ekstra test siden extract by mask ikke feiler i Desktop
+            # bare pixler innenfor AOI og fra og med brukerdefinert grenseverdi skal være med
+            np_snow_ma = np.ma.masked_where(
+                (zones == 0) | (np_snow < min_snow_percent), np_snow, copy=True
+            )
 
-                for i in snow_classes:
-                    snow_class_min = i * snow_bands
-                    snow_class_max = snow_class_min + snow_bands
-                    (
-                        snow_class_mean_percentage,
-                        snow_class_min_percentage,
-                        snow_class_max_percentage,
-                    ) = get_snow_statistics_for_height_interval(
-                        snow_class_min, snow_class_max, np_dtm, np_snow_ma, i
+            # Get DTM once per tile (for the first date with snow)
+            if np_snow_ma.count() > 0 and not dtm_read:
+                dtm_read = True
+                with metrics.stage("dtm"):
+                    try:
+                        if dtm_store and dtm_store.contains(tile):
+                            if not dtm_store.exists():
+                                gscript.verbose("Lagrer DTM i {}".format(dtm_directory))
+                                dtm_store.build(spatial_ref, cache=cache, client=client)
+                            np_dtm = dtm_store.get_dtm(tile)
+                            band_raster = dtm_store.get_band_raster(tile, band_edges)
+                        else:
+                            if not dtm_service_description:
+                                dtm_service_description = query_image_server(
+                                    image_service=dtm_image_service,
+                                    print_metadata="service_description",
+                                    cache=cache,
+                                    client=client,
+                                )
+                            np_dtm = read_dtm(
+                                tile,
+                                dtm_image_service,
+                                dtm_service_description,
+                                spatial_ref,
+                                cache=cache,
+                                client=client,
+                                data_type=(
+                                    gdal.GDT_Int16 if compact else gdal.GDT_Float32
+                                ),
+                            )
+                    except Exception as err:
+                        gscript.fatal("Feilet ved DTM-analyse: {}".format(err))
+                    np_dtm = gather_pixels(np_dtm, pixel_index)
+                    band_raster = gather_pixels(band_raster, pixel_index)
+
+            with metrics.stage("statistics"):
+                snow_statistics[group].merge(
+                    SnowStatistics(band_edges, n_zones=len(feature_ids)).update(
+                        np_snow_ma, zones, np_dtm=np_dtm, band_raster=band_raster
                     )
+                )
+            accumulator = np_snow = np_snow_ma = None
+
+        if composite_accumulator is not None:
+            write_composites(
+                composite_accumulator, composite_rasters, tile, pixel_index=pixel_index
+            )
+        composite_accumulator = images = np_dtm = band_raster = None
+        zone_raster = zones = None
 
-                    res_dict[
-                        f"snow_{snow_class_min}m_to_{snow_class_max}m_mean_percentage"
-                    ] = float(snow_class_mean_percentage)
+    if composite_directory:
+        composite_rasters = None
 
-                    res_dict[
-                        f"snow_{snow_class_min}m_to_{snow_class_max}m_min_percentage"
-                    ] = float(snow_class_min_percentage)
+    if cache:
+        gscript.verbose(
+            "Hurtigbuffer: {} treff og {} bom".format(cache.hits, cache.misses)
+        )
+        metrics.add("cache_hits", cache.hits)
+        metrics.add("cache_misses", cache.misses)
+    if metrics.enabled:
+        metrics.add("tiles", len(tiles))
+        gscript.message("Metrikker: {}".format(json.dumps(metrics.as_dict())))
+
+    px_area = raster_aoi["pixelSizeX"] * raster_aoi["pixelSizeY"]
+    result_kwargs = {
+        "px_area": px_area,
+        "min_snow_percent": min_snow_percent,
+        "include_histogram": include_histogram,
+        "coarse_factor": coarse_factor,
+        "drop_zero_band": not snow_band_edges,
+    }
 
-                    res_dict[
-                        f"snow_{snow_class_min}m_to_{snow_class_max}m_max_percentage"
-                    ] = float(snow_class_max_percentage)
+    try:
+        if timeseries:
+            # One result record per acquisition date (and feature)
+            results = []
+            for group in image_groups:
+                for zone, feature_id in enumerate(feature_ids):
+                    try:
+                        res_dict = get_result_dict(
+                            snow_statistics[group], zone, **result_kwargs
+                        )
+                    except Exception as err:
+                        gscript.verbose("{} {}: {}".format(group, feature_id, err))
+                        continue
+                    results.append({"date": group, "aoi_id": feature_id, **res_dict})
+            if timeseries_output:
+                write_timeseries(results, timeseries_output)
             else:
-                gscript.warning(
-                    "Minimum snøprosent er {}. Beregner derfor ikke høyde".format(
-                        res_dict["snow_min_percentage"]
+                add_metrics(results)
+                print(json.dumps(results))
+        elif per_feature:
+            # One result record per feature
+            results = []
+            for zone, feature_id in enumerate(feature_ids):
+                gscript.verbose("Beregner verdier for {}".format(feature_id))
+                try:
+                    res_dict = get_result_dict(
+                        snow_statistics[None], zone, **result_kwargs
                     )
-                )
-        except Exception as err:
-            gscript.fatal("Feilet ved DTM-analyse: {}".format(err))
-
-        print(json.dumps(res_dict))
-        # return json.dumps(res_dict)
+                except Exception as err:
+                    gscript.warning("{}: {}".format(feature_id, err))
+                    res_dict = {"error": str(err)}
+                results.append({"aoi_id": feature_id, **res_dict})
+            add_metrics(results)
+            print(json.dumps(results))
+        else:
+            res_dict = get_result_dict(snow_statistics[None], **result_kwargs)
+            add_metrics([res_dict])
+
+            print(json.dumps(res_dict))
+            # return json.dumps(res_dict)
 
     except Exception as err:
         gscript.fatal("Feilet: {}".format(err))
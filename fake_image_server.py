@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the ArcGIS ImageServer at gis3.nve.no
+
+Serves a snow cover service (S3_SLSTR_fsc_sa) with synthetic daily images
+derived from data/snow_raster_gdal.tif and a DTM service (AuxDEM250) with a
+synthetic terrain model. The parts of the REST API used by
+calculate_snow_coverage_numpy.py are implemented:
+
+- service description (?f=pjson)
+- catalog query (query, with a date filter on opptakstidspunkt)
+- export of single images ({id}/image)
+- export of images aggregated with a mosaic rule (exportImage with
+  lockRasterIds and MT_MEAN, a Remap raster function with NoDataRanges is
+  applied to every image as itemRenderingRule and to the mean as
+  renderingRule)
+- download of exported images (returned as href)
+
+Intended for testing and benchmarking without access to the real server.
+
+Usage:
+    python fake_image_server.py --port 8080 --days 30
+    # and set server = "http://localhost:8080/" in calculate_snow_coverage_numpy.py
+"""
+
+import argparse
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import re
+import threading
+from time import monotonic
+from urllib import parse
+from uuid import uuid4
+
+from osgeo import gdal, osr
+import numpy as np
+
+gdal.UseExceptions()
+
+TEMPLATE = Path(__file__).parent / "data" / "snow_raster_gdal.tif"
+
+SNOW_SERVICE = "S3_SLSTR_fsc_sa"
+DTM_SERVICE = "AuxDEM250"
+
+GDAL_TYPES = {"U8": gdal.GDT_Byte, "F32": gdal.GDT_Float32}
+
+# Seconds an export is kept for download (like ImageServer output files)
+EXPORT_TTL = 600
+
+
+class FakeService:
+    """Raster catalog of one image service"""
+
+    def __init__(
+        self, name, geo_transform, shape, wkid, pixel_type, acquisition_times, create
+    ):
+        """
+        :param geo_transform: GDAL geo transform of the rasters
+        :type geo_transform: tuple
+        :param shape: rows and columns of the rasters
+        :type shape: tuple
+        :param wkid: EPSG code of the spatial reference of the rasters
+        :type wkid: int
+        :param pixel_type: ImageServer pixel type (U8 or F32)
+        :type pixel_type: str
+        :param acquisition_times: acquisition time of the rasters (object ID
+                                  is the position in the list + 1)
+        :type acquisition_times: list
+        :param create: function returning the array of a raster for an object ID
+        :type create: callable
+        """
+        self.name = name
+        self.geo_transform = geo_transform
+        self.shape = shape
+        self.wkid = wkid
+        self.pixel_type = pixel_type
+        self.acquisition_times = acquisition_times
+        self.get_array = lru_cache(maxsize=64)(create)
+
+    @property
+    def extent(self):
+        xmin, pixel_size_x, _, ymax, _, pixel_size_y = self.geo_transform
+        return {
+            "xmin": xmin,
+            "ymin": ymax + pixel_size_y * self.shape[0],
+            "xmax": xmin + pixel_size_x * self.shape[1],
+            "ymax": ymax,
+            "spatialReference": {"wkid": self.wkid},
+        }
+
+    def describe(self, mosaic=True, max_image_size=4000):
+        """Get the service description (as returned for ?f=pjson)
+        Mosaic datasets list LockRaster in allowedMosaicMethods and have a
+        mosaicOperator, services of a single raster have neither.
+        """
+        mosaic_methods = (
+            {
+                "allowedMosaicMethods": "NorthWest,Center,LockRaster,ByAttribute,Nadir,Viewpoint,Seamline,None",
+                "defaultMosaicMethod": "NorthWest",
+                "mosaicOperator": "First",
+            }
+            if mosaic
+            else {}
+        )
+        return {
+            "name": self.name,
+            "serviceDataType": "esriImageServiceDataTypeGeneric",
+            "extent": self.extent,
+            "fullExtent": self.extent,
+            "pixelSizeX": self.geo_transform[1],
+            "pixelSizeY": -self.geo_transform[5],
+            "bandCount": 1,
+            "pixelType": self.pixel_type,
+            "maxImageWidth": max_image_size,
+            "maxImageHeight": max_image_size,
+            "objectIdField": "OBJECTID",
+            "capabilities": "Image,Metadata,Catalog",
+            **mosaic_methods,
+        }
+
+    def query(self, where=None):
+        """Get object IDs and acquisition times (in ms) of rasters matching where
+        Only the date range filter on opptakstidspunkt used by the snow
+        coverage scripts is understood, other conditions are ignored.
+        """
+        dates = re.findall(r"date '([0-9-]+ [0-9:]+)'", where or "")
+        start, end = (
+            [
+                datetime.fromisoformat(date).replace(tzinfo=timezone.utc)
+                for date in dates
+            ]
+            if len(dates) == 2
+            else (None, None)
+        )
+        return [
+            (object_id, int(acquisition_time.timestamp() * 1000))
+            for object_id, acquisition_time in enumerate(self.acquisition_times, 1)
+            if start is None or start <= acquisition_time <= end
+        ]
+
+    def to_dataset(self, array):
+        """Create an in-memory GDAL dataset of a raster of the service"""
+        dataset = gdal.GetDriverByName("MEM").Create(
+            "", self.shape[1], self.shape[0], 1, GDAL_TYPES[self.pixel_type]
+        )
+        dataset.SetGeoTransform(self.geo_transform)
+        spatial_ref = osr.SpatialReference()
+        spatial_ref.ImportFromEPSG(self.wkid)
+        dataset.SetProjection(spatial_ref.ExportToWkt())
+        dataset.GetRasterBand(1).WriteArray(array)
+        return dataset
+
+    def create_target(self, bbox, size, pixel_type, no_data=0):
+        """Create an empty in-memory GDAL dataset on the grid given by bbox and size"""
+        xmin, ymin, xmax, ymax = bbox
+        width, height = size
+        target = gdal.GetDriverByName("MEM").Create(
+            "", width, height, 1, GDAL_TYPES[pixel_type]
+        )
+        target.SetGeoTransform(
+            (xmin, (xmax - xmin) / width, 0, ymax, 0, -(ymax - ymin) / height)
+        )
+        spatial_ref = osr.SpatialReference()
+        spatial_ref.ImportFromEPSG(self.wkid)
+        target.SetProjection(spatial_ref.ExportToWkt())
+        target.GetRasterBand(1).Fill(no_data)
+        return target
+
+    def export(self, object_id, bbox, size, pixel_type, no_data=0):
+        """Export a raster on the grid given by bbox and size"""
+        target = self.create_target(bbox, size, pixel_type, no_data)
+        gdal.Warp(
+            target,
+            self.to_dataset(self.get_array(object_id)),
+            resampleAlg=gdal.GRA_NearestNeighbour,
+        )
+        return target
+
+
+def create_snow_service(days=30, images_per_day=1, cloud_fraction=0.2, seed=42):
+    """Create a snow cover service with synthetic images for the last days
+    Every image is the template with valid snow cover values (101-200)
+    shifted randomly and a random fraction of the pixels set to an invalid
+    value (like clouds).
+    """
+    template_ds = gdal.Open(str(TEMPLATE))
+    template = template_ds.ReadAsArray().astype(np.uint8)
+    spatial_ref = osr.SpatialReference(wkt=template_ds.GetProjection())
+    spatial_ref.AutoIdentifyEPSG()
+    wkid = int(spatial_ref.GetAuthorityCode(None) or 25833)
+
+    today = datetime.combine(datetime.now(timezone.utc).date(), time(11), timezone.utc)
+    acquisition_times = [
+        today - timedelta(days=day, minutes=100 * image)
+        for day in range(days - 1, -1, -1)
+        for image in range(images_per_day)
+    ]
+
+    def create(object_id):
+        rng = np.random.default_rng(seed + object_id)
+        valid = (template > 100) & (template <= 200)
+        image = template.astype(np.int16)
+        image[valid] += rng.integers(-20, 21, dtype=np.int16)
+        image[valid] = np.clip(image[valid], 101, 200)
+        image[rng.random(template.shape) < cloud_fraction] = 205
+        return image.astype(np.uint8)
+
+    return FakeService(
+        SNOW_SERVICE,
+        template_ds.GetGeoTransform(),
+        template.shape,
+        wkid,
+        "U8",
+        acquisition_times,
+        create,
+    )
+
+
+def create_dtm_service(snow_service, pixel_size=250):
+    """Create a DTM service with synthetic terrain covering the snow service"""
+    extent = snow_service.extent
+    shape = (
+        round((extent["ymax"] - extent["ymin"]) / pixel_size),
+        round((extent["xmax"] - extent["xmin"]) / pixel_size),
+    )
+    geo_transform = (extent["xmin"], pixel_size, 0, extent["ymax"], 0, -pixel_size)
+
+    def create(object_id):
+        rows, cols = np.mgrid[0 : shape[0], 0 : shape[1]]
+        return (
+            1000
+            + 800
+            * np.sin(cols * pixel_size / 50000)
+            * np.cos(rows * pixel_size / 70000)
+        ).astype(np.float32)
+
+    return FakeService(
+        DTM_SERVICE,
+        geo_transform,
+        shape,
+        snow_service.wkid,
+        "F32",
+        [datetime(2020, 1, 1, tzinfo=timezone.utc)],
+        create,
+    )
+
+
+def remap_no_data(array, no_data_ranges):
+    """Set values in [min, max) ranges to NaN (like the Remap raster function)"""
+    array = array.astype(np.float32)
+    for range_min, range_max in zip(no_data_ranges[::2], no_data_ranges[1::2]):
+        array[(array >= range_min) & (array < range_max)] = np.nan
+    return array
+
+
+def to_geotiff(dataset):
+    """Encode a GDAL dataset as GeoTIFF bytes"""
+    path = f"/vsimem/{uuid4().hex}.tif"
+    gdal.GetDriverByName("GTiff").CreateCopy(path, dataset)
+    vsi_file = gdal.VSIFOpenL(path, "rb")
+    try:
+        gdal.VSIFSeekL(vsi_file, 0, 2)
+        size = gdal.VSIFTellL(vsi_file)
+        gdal.VSIFSeekL(vsi_file, 0, 0)
+        return bytes(gdal.VSIFReadL(1, size, vsi_file))
+    finally:
+        gdal.VSIFCloseL(vsi_file)
+        gdal.Unlink(path)
+
+
+class FakeImageServer(ThreadingHTTPServer):
+    """HTTP server with the fake image services
+    ``requests`` counts requests per endpoint and ``bytes_sent`` the size of
+    all responses, so clients can be checked and benchmarked.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, services, mosaic=True, max_image_size=4000):
+        super().__init__(address, FakeImageServerHandler)
+        self.services = {service.name: service for service in services}
+        self.mosaic = mosaic
+        self.max_image_size = max_image_size
+        self.exports = {}
+        self.requests = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address[:2])
+
+
+class FakeImageServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_content(self, content, content_type="application/json", status=200):
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        with self.server.lock:
+            self.server.bytes_sent += len(content)
+
+    def send_error_json(self, code, message):
+        # ArcGIS reports most errors as JSON with status 200
+        self.send_content({"error": {"code": code, "message": message}})
+
+    def count(self, endpoint):
+        with self.server.lock:
+            self.server.requests[endpoint] = self.server.requests.get(endpoint, 0) + 1
+
+    def do_GET(self):
+        url = parse.urlsplit(self.path)
+        params = dict(parse.parse_qsl(url.query))
+        parts = [part for part in url.path.split("/") if part]
+
+        if len(parts) == 2 and parts[0] == "output":
+            self.count("output")
+            return self.send_output(parts[1].split(".")[0])
+        if "ImageServer" not in parts:
+            return self.send_content(b"Not found", "text/plain", 404)
+        service_index = parts.index("ImageServer") - 1
+        service = self.server.services.get(parts[service_index])
+        if service is None:
+            return self.send_error_json(404, "Service not found")
+        operation = parts[service_index + 2 :]
+
+        if not operation:
+            self.count("pjson")
+            return self.send_content(
+                service.describe(self.server.mosaic, self.server.max_image_size)
+            )
+        if operation == ["query"]:
+            self.count("query")
+            matches = service.query(params.get("where"))
+            if params.get("returnIdsOnly") == "true":
+                return self.send_content(
+                    {
+                        "objectIdFieldName": "OBJECTID",
+                        "objectIds": [object_id for object_id, _ in matches],
+                    }
+                )
+            return self.send_content(
+                {
+                    "objectIdFieldName": "OBJECTID",
+                    "features": [
+                        {
+                            "attributes": {
+                                "OBJECTID": object_id,
+                                "opptakstidspunkt": acquisition_time,
+                            }
+                        }
+                        for object_id, acquisition_time in matches
+                    ],
+                }
+            )
+        if len(operation) == 2 and operation[1] == "image":
+            self.count("image")
+            return self.register_export(service, params, object_ids=[int(operation[0])])
+        if operation == ["exportImage"]:
+            self.count("exportImage")
+            if not self.server.mosaic:
+                return self.send_error_json(400, "Mosaic rules are not supported")
+            mosaic_rule = json.loads(params.get("mosaicRule", "{}"))
+            if mosaic_rule.get("mosaicOperation") != "MT_MEAN":
+                return self.send_error_json(400, "Unsupported mosaic operation")
+            item_rendering_rule = mosaic_rule.get("itemRenderingRule") or {}
+            rendering_rule = json.loads(params.get("renderingRule", "{}"))
+            return self.register_export(
+                service,
+                params,
+                object_ids=mosaic_rule.get("lockRasterIds") or [],
+                item_no_data_ranges=item_rendering_rule.get(
+                    "rasterFunctionArguments", {}
+                ).get("NoDataRanges", []),
+                no_data_ranges=rendering_rule.get("rasterFunctionArguments", {}).get(
+                    "NoDataRanges", []
+                ),
+            )
+        return self.send_error_json(400, "Unsupported operation")
+
+    def register_export(
+        self, service, params, object_ids, item_no_data_ranges=None, no_data_ranges=None
+    ):
+        """Remember an export and return its href, the image is created on download
+        Exports that are not downloaded within EXPORT_TTL seconds are dropped
+        (like the output directory of the ImageServer is cleaned up).
+        """
+        bbox = [float(value) for value in params["bbox"].split(",")]
+        size = [int(value) for value in params["size"].split(",")]
+        if max(size) > self.server.max_image_size:
+            return self.send_error_json(400, "Requested image exceeds the size limit")
+        token = uuid4().hex
+        now = monotonic()
+        with self.server.lock:
+            for expired_token in [
+                export_token
+                for export_token, export in self.server.exports.items()
+                if now - export["created"] > EXPORT_TTL
+            ]:
+                del self.server.exports[expired_token]
+            self.server.exports[token] = {
+                "created": now,
+                "service": service,
+                "object_ids": object_ids,
+                "bbox": bbox,
+                "size": size,
+                "pixel_type": params.get("pixelType") or service.pixel_type,
+                "no_data": float(params["noData"]) if params.get("noData") else 0,
+                "item_no_data_ranges": item_no_data_ranges,
+                "no_data_ranges": no_data_ranges,
+            }
+        self.send_content(
+            {
+                "href": "http://{}/output/{}.tif".format(self.headers["Host"], token),
+                "width": size[0],
+                "height": size[1],
+                "extent": dict(zip(("xmin", "ymin", "xmax", "ymax"), bbox)),
+            }
+        )
+
+    def send_output(self, token):
+        with self.server.lock:
+            export = self.server.exports.pop(token, None)
+        if export is None:
+            return self.send_content(b"Not found", "text/plain", 404)
+        service = export["service"]
+        if export["item_no_data_ranges"] is None:
+            dataset = service.export(
+                export["object_ids"][0],
+                export["bbox"],
+                export["size"],
+                export["pixel_type"],
+                export["no_data"],
+            )
+            return self.send_content(to_geotiff(dataset), "image/tiff")
+
+        # Mean over the valid values of all images (MT_MEAN), the item
+        # rendering rule is applied to every image and the rendering rule to
+        # the mean
+        value_sum = np.zeros(export["size"][::-1], dtype=np.float64)
+        value_count = np.zeros(export["size"][::-1], dtype=np.int64)
+        for object_id in export["object_ids"]:
+            values = remap_no_data(
+                service.export(
+                    object_id, export["bbox"], export["size"], service.pixel_type
+                ).ReadAsArray(),
+                export["item_no_data_ranges"],
+            )
+            valid = ~np.isnan(values)
+            value_sum[valid] += values[valid]
+            value_count += valid
+        mean = np.full(value_sum.shape, export["no_data"], dtype=np.float32)
+        np.divide(
+            value_sum, value_count, out=mean, where=value_count > 0, casting="unsafe"
+        )
+        mean[np.isnan(remap_no_data(mean, export["no_data_ranges"]))] = export[
+            "no_data"
+        ]
+        dataset = service.create_target(export["bbox"], export["size"], "F32")
+        dataset.GetRasterBand(1).WriteArray(mean)
+        return self.send_content(to_geotiff(dataset), "image/tiff")
+
+
+def start_fake_image_server(
+    port=0, days=30, images_per_day=1, mosaic=True, max_image_size=4000
+):
+    """Start the fake ImageServer in a background thread
+    :param port: port to listen on (0 for any free port)
+    :type port: int
+    :return: running server, its URL is available as ``url``
+    :rtype: FakeImageServer
+    """
+    snow_service = create_snow_service(days=days, images_per_day=images_per_day)
+    server = FakeImageServer(
+        ("127.0.0.1", port),
+        [snow_service, create_dtm_service(snow_service)],
+        mosaic=mosaic,
+        max_image_size=max_image_size,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--images-per-day", type=int, default=1)
+    parser.add_argument("--max-image-size", type=int, default=4000)
+    parser.add_argument(
+        "--no-mosaic",
+        action="store_true",
+        help="do not support mosaic rules (to test the fallback to the client)",
+    )
+    args = parser.parse_args()
+
+    server = start_fake_image_server(
+        port=args.port,
+        days=args.days,
+        images_per_day=args.images_per_day,
+        mosaic=not args.no_mosaic,
+        max_image_size=args.max_image_size,
+    )
+    print("Fake ImageServer kjører på {}".format(server.url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
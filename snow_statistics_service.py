@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""Local HTTP/JSON service for snow statistics
+
+Runs the snow statistics of calculate_snow_coverage_numpy.py in a pool of
+long-running worker processes, so GDAL and connections to the ImageServer
+stay warm between requests. Every worker process has its own in-memory
+caches (service descriptions, DTM windows and AOI masks), so they only help
+requests that end up in the same worker; use the cache directories
+(cache_directory, dtm_directory, mask_directory) to share them between
+workers.
+
+Identical requests (same settings, same AOI file content and same time
+period after filling in the default dates) that arrive while a computation
+is running are coalesced (single-flight): the statistics are computed once
+and every request gets the same result. Results can also be kept for a short
+time (--result-ttl), so requests within that time get the result directly.
+
+Endpoints:
+
+- POST /statistics with a JSON object of keyword arguments of ``main`` in
+  calculate_snow_coverage_numpy.py (e.g. {"aoi": "data/aoi.geojson",
+  "date_start": "2023-04-01", "date_end": "2023-04-07"}), returns the same
+  JSON as the script prints
+- GET /health with the number of workers and requests
+
+Usage:
+    python snow_statistics_service.py --port 8081 --workers 4
+    curl -d '{"aoi": "data/aoi.geojson"}' http://localhost:8081/statistics
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import calculate_snow_coverage_numpy as snow
+
+
+class SingleFlight:
+    """Run identical calls only once at a time and share their result
+    Calls are identified by a key. A call with the key of a running call
+    gets the future of the running call instead of starting a new one.
+    Successful results are kept for ``result_ttl`` seconds.
+    """
+
+    def __init__(self, executor, result_ttl=0):
+        """
+        :param executor: executor to run calls in
+        :type executor: concurrent.futures.Executor
+        :param result_ttl: time in seconds to keep successful results
+        :type result_ttl: float
+        """
+        self.executor = executor
+        self.result_ttl = result_ttl
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        """Submit a call unless an identical call is running or finished recently
+        :return: future of the call and whether it is shared with another call
+        :rtype: tuple
+        """
+        with self._lock:
+            now = time.monotonic()
+            for expired_key in [
+                call_key
+                for call_key, (_, finished) in self._calls.items()
+                if finished is not None and now - finished >= self.result_ttl
+            ]:
+                del self._calls[expired_key]
+            if key in self._calls:
+                return self._calls[key][0], True
+            future = self.executor.submit(function, *args)
+            self._calls[key] = (future, None)
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future, False
+
+    def _finish(self, key, future):
+        """Keep the result of a successful call or forget the call"""
+        with self._lock:
+            if (
+                self.result_ttl > 0
+                and future.exception() is None
+                and "error" not in future.result()
+            ):
+                self._calls[key] = (future, time.monotonic())
+            else:
+                self._calls.pop(key, None)
+
+
+def get_request_key(settings):
+    """Get the single-flight key of the settings of a request
+    The default dates are filled in (as in ``main``), so requests without
+    dates on different days do not share a result, and the hash of the
+    content of the AOI file is added, so a changed AOI file is computed anew.
+    :param settings: keyword arguments of ``main``, updated with the dates
+    :type settings: dict
+    :rtype: str
+    """
+    if settings.get("date_start") is None:
+        settings["date_start"] = (datetime.now() - timedelta(days=3)).strftime(
+            "%Y-%m-%d"
+        )
+    if settings.get("date_end") is None:
+        settings["date_end"] = datetime.now().strftime("%Y-%m-%d")
+    aoi_key = None
+    try:
+        aoi_key = snow.get_aoi_key(settings.get("aoi", "./data/aoi.geojson"))
+    except (AttributeError, OSError):
+        # Invalid AOI, main reports the error
+        pass
+    return json.dumps({**settings, "aoi_key": aoi_key}, sort_keys=True)
+
+
+class SnowStatisticsServer(ThreadingHTTPServer):
+    """HTTP server computing snow statistics in a pool of worker processes"""
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=4, result_ttl=0):
+        super().__init__(address, SnowStatisticsHandler)
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.single_flight = SingleFlight(self.executor, result_ttl=result_ttl)
+        self.requests = {"computed": 0, "coalesced": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address[:2])
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class SnowStatisticsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        snow.logger.debug(format % args)
+
+    def send_content(self, content, status=200):
+        content = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            return self.send_content({"error": "Finner ikke {}".format(self.path)}, 404)
+        with self.server.lock:
+            requests = dict(self.server.requests)
+        self.send_content({"workers": self.server.workers, "requests": requests})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/statistics":
+            return self.send_content({"error": "Finner ikke {}".format(self.path)}, 404)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            settings = json.loads(body or b"{}")
+            if not isinstance(settings, dict):
+                raise ValueError("Forventer et JSON-objekt med innstillinger.")
+        except ValueError as err:
+            return self.send_content({"error": str(err)}, 400)
+        settings.pop("id", None)
+
+        # Identical settings give identical results, so they share one computation
+        key = get_request_key(settings)
+        future, coalesced = self.server.single_flight.submit(
+            key, snow.run_job, json.dumps(settings)
+        )
+        with self.server.lock:
+            self.server.requests["coalesced" if coalesced else "computed"] += 1
+        try:
+            response = future.result()
+        except Exception as err:
+            return self.send_content({"error": str(err)}, 500)
+        if "error" in response:
+            return self.send_content({"error": response["error"]}, 500)
+        self.send_content(response["result"])
+
+
+def start_snow_statistics_server(port=0, workers=4, result_ttl=0):
+    """Start the service in a background thread
+    :param port: port to listen on (0 for any free port)
+    :type port: int
+    :return: running server, its URL is available as ``url``
+    :rtype: SnowStatisticsServer
+    """
+    server = SnowStatisticsServer(
+        ("127.0.0.1", port), workers=workers, result_ttl=result_ttl
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--workers", type=int, default=4, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--result-ttl",
+        type=float,
+        default=0,
+        help="time in seconds to keep results for identical requests",
+    )
+    args = parser.parse_args()
+
+    server = start_snow_statistics_server(
+        port=args.port, workers=args.workers, result_ttl=args.result_ttl
+    )
+    snow.logger.info("Snøstatistikk kjører på {}".format(server.url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
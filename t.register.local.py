@@ -1,21 +1,21 @@
 #!/usr/bin/env python3
 
 """
- MODULE:       t.register.local
- AUTHOR(S):    Stefan Blumentrath
- PURPOSE:      Register raster data files from the local file system in a
-               Space Time Raster Dataset (STRDS)
- COPYRIGHT:    (C) 2022 by Stefan Blumentrath
-
-  This program is free software; you can redistribute it and/or modify
-  it under the terms of the GNU General Public License as published by
-  the Free Software Foundation; either version 2 of the License, or
-  (at your option) any later version.
-
-  This program is distributed in the hope that it will be useful,
-  but WITHOUT ANY WARRANTY; without even the implied warranty of
-  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-  GNU General Public License for more details.
+MODULE:       t.register.local
+AUTHOR(S):    Stefan Blumentrath
+PURPOSE:      Register raster data files from the local file system in a
+              Space Time Raster Dataset (STRDS)
+COPYRIGHT:    (C) 2022 by Stefan Blumentrath
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
 
 """
 
@@ -55,6 +55,11 @@
 # % description: Create fast link without data range
 # %end
 
+# %flag
+# % key: i
+# % description: Register incrementally (only new or changed files, unregister maps of removed files)
+# %end
+
 # %option G_OPT_M_DIR
 # % required: yes
 # % multiple: no
@@ -149,6 +154,16 @@
 # % description: Units of the values in the input raster maps
 # %end
 
+# %option
+# % key: chunk_size
+# % type: integer
+# % required: no
+# % multiple: no
+# % answer: 1000
+# % description: Number of maps to register in the STRDS between checkpoints (for resuming interrupted runs)
+# % guisection: Settings
+# %end
+
 # %option G_OPT_M_NPROCS
 # % required: no
 # % multiple: no
@@ -163,6 +178,8 @@
 # ToDo:
 # - add rules to secure consistent user input
 
+import hashlib
+import json
 import os
 import re
 import subprocess
@@ -171,7 +188,6 @@ import sys
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
-from itertools import chain
 from multiprocessing import Pool
 from pathlib import Path
 
@@ -197,7 +213,7 @@ import grass.script as gscript
 import grass.temporal as tgis
 
 from grass.pygrass.gis import Mapset
-from grass.pygrass.modules.interface import Module, MultiModule
+from grass.pygrass.modules.interface import Module
 from grass.temporal.register import register_maps_in_space_time_dataset
 
 
@@ -298,35 +314,94 @@ def parse_semantic_label_conf(conf_file, grass_major_version):
     return semantic_label
 
 
+def scan_dataset(raster_dataset, cache_entry=None, nodata=None):
+    """
+    Get subdatasets and band count of a raster data file
+    Uses the entry of the metadata cache if size and modification time of the
+    file (and the nodata value for VRTs) are unchanged, so the file is not
+    opened with GDAL. Otherwise the file is scanned and a new entry without
+    VRTs is returned (so VRTs of a changed file are recreated).
+    :param raster_dataset: Path to the raster data file
+    :param cache_entry: Entry of the metadata cache for the file
+    :param nodata: NoData value for VRTs
+    :return: Cache entry with size, mtime, nodata, subdatasets, band_count and
+             paths of VRTs by subdataset, or None if the file cannot be opened
+    :rtype: dict
+    """
+    file_stat = Path(raster_dataset).stat()
+    if (
+        cache_entry
+        and cache_entry["size"] == file_stat.st_size
+        and cache_entry["mtime"] == file_stat.st_mtime
+        and cache_entry["nodata"] == nodata
+    ):
+        return cache_entry
+    ds = gdal.Open(str(raster_dataset))
+    if not ds:
+        return None
+    cache_entry = {
+        "size": file_stat.st_size,
+        "mtime": file_stat.st_mtime,
+        "nodata": nodata,
+        "subdatasets": [list(subdataset) for subdataset in ds.GetSubDatasets()],
+        "band_count": ds.RasterCount,
+        "vrts": {},
+    }
+    ds = None
+    return cache_entry
+
+
+def get_vrt(subdataset, cache_entry, input_option_dict):
+    """
+    Get the VRT of a subdataset from the cache entry or create it
+    :param subdataset: Name of the subdataset
+    :param cache_entry: Entry of the metadata cache for the file (see scan_dataset)
+    :param input_option_dict: Dictionary with gisenv and nodata
+    :return: Path to the VRT
+    :rtype: str
+    """
+    vrt = cache_entry["vrts"].get(subdataset)
+    if not vrt or not Path(vrt).exists():
+        vrt = create_vrt(
+            subdataset, input_option_dict, input_option_dict["nodata"], recreate=True
+        )
+        cache_entry["vrts"][subdataset] = vrt
+    return vrt
+
+
 def map_semantic_labels(
-    raster_dataset, semantic_label_dict=None, input_option_dict=None
+    raster_dataset, semantic_label_dict=None, input_option_dict=None, cache_entry=None
 ):
     """
     Map semantic labels from config file to band(s) or subdataset(s) / variable(s) in input raster maps
     :param raster_dataset:
     :param semantic_labels:
+    :param cache_entry: Entry of the metadata cache for the file (see
+                        scan_dataset), VRTs created are added to it
     :return: List of tuples
     """
     raster_dataset = str(raster_dataset)
-    ds = gdal.Open(raster_dataset)
-    if not ds:
+    if cache_entry is None:
+        cache_entry = scan_dataset(raster_dataset, nodata=input_option_dict["nodata"])
+    if not cache_entry:
         gscript.warning(_("Cannot open dataset <{}>".format(raster_dataset)))
         print("Invalid input")
         return []
     # Map subdatasets if present
-    subdatasets = ds.GetSubDatasets()
+    subdatasets = cache_entry["subdatasets"]
     if subdatasets:
         if semantic_label_dict and not any(
-            [reference[1].split(" ")[1] in semantic_label_dict for reference in subdatasets]
+            [
+                reference[1].split(" ")[1] in semantic_label_dict
+                for reference in subdatasets
+            ]
         ):
             gscript.warning(_("No subdatasets to import."))
             return []
         elif semantic_label_dict:
             import_tuple = [
                 (
-                    create_vrt(
-                        subdataset[0], input_option_dict, input_option_dict["nodata"]
-                    ),
+                    get_vrt(subdataset[0], cache_entry, input_option_dict),
                     1,
                     semantic_label_dict[subdataset[1].split(" ")[1]],
                 )
@@ -336,9 +411,7 @@ def map_semantic_labels(
         else:
             import_tuple = [
                 (
-                    create_vrt(
-                        subdataset[0], input_option_dict, input_option_dict["nodata"]
-                    ),
+                    get_vrt(subdataset[0], cache_entry, input_option_dict),
                     1,
                     legalize_name_string(subdataset[1].split(" ")[1]),
                 )
@@ -349,14 +422,13 @@ def map_semantic_labels(
         if semantic_label_dict:
             import_tuple = [
                 (raster_dataset, band, semantic_label_dict[str(band)])
-                for band in range(1, ds.RasterCount + 1)
+                for band in range(1, cache_entry["band_count"] + 1)
             ]
         else:
             import_tuple = [
                 (raster_dataset, band, str(band))
-                for band in range(1, ds.RasterCount + 1)
+                for band in range(1, cache_entry["band_count"] + 1)
             ]
-    ds = None
     return import_tuple
 
 
@@ -397,38 +469,313 @@ def create_vrt(subdataset, gisenv, nodata, recreate=False):
     return vrt
 
 
-def import_data(import_tuple, metadata_dict=None, modules_dict=None):
+def get_map_name_and_time(import_tuple, metadata_dict):
     """
-    Link (import) external raster data and set relevant metadata
-    Implemented as a sequence of modules to run
-    Returns a line for registering the linked map in a STRDS
+    Get the name of the raster map and the time stamp for an import tuple
     :param import_tuple: tuple containing Path to the raster data file to import, band/subdataset, semantic_label
     :param metadata_dict: dictionary containing relevant metadata for the import
-    :param modules_dict: Dictionary of pyGRASS modules to run for import
-    :return: Line for registering the raster map in an STRDS
-    :rtype: str
+    :return: Name of the raster map and time stamp extracted from the file name
+    :rtype: tuple
     """
     file_path = Path(import_tuple[0])
     date_pattern = f".*({strftime_to_regex(metadata_dict['time_format'])}).*"
     time_string = re.match(date_pattern, str(file_path)).groups()[0]
     time_stamp = datetime.strptime(time_string, metadata_dict["time_format"])
-    time_stamp_iso = time_stamp.strftime("%Y-%m-%d")
     output_name = (
-        f"map_{file_path.stem}_{import_tuple[2]}" if file_path.stem[0].isdigit() else f"{file_path.stem}_{import_tuple[2]}"
+        f"map_{file_path.stem}_{import_tuple[2]}"
+        if file_path.stem[0].isdigit()
+        else f"{file_path.stem}_{import_tuple[2]}"
     )
-    mods = deepcopy(modules_dict)
-    mods["import"].inputs.input = str(file_path)
-    mods["import"].inputs.band = import_tuple[1]
-    mods["import"].outputs.output = output_name
-    mods["metadata"].inputs.map = output_name
-    mods["metadata"].inputs.units = metadata_dict["units"]
-    mods["metadata"].inputs.title = metadata_dict["long_name"]
-    mods["metadata"].inputs.semantic_label = import_tuple[2]
-    mods["timestamp"].inputs.map = output_name
-    mods["timestamp"].inputs.date = time_stamp.strftime("%-d %b %Y")
-    MultiModule(list(mods.values())).run()
+    return output_name, time_stamp
 
-    return f"{output_name},{time_stamp_iso},{time_stamp_iso},{import_tuple[2]}"
+
+def link_maps(import_tuples, metadata_dict=None, modules_dict=None):
+    """
+    Link (import) all bands / subdatasets of a raster data file and set
+    relevant metadata
+    All bands of a file are linked with one r.external call and renamed with
+    one g.rename call, only r.support runs per map (it takes a single map).
+    Time stamps are written to the maps when they are registered in the
+    temporal database, so r.timestamp is not needed
+    :param import_tuples: List of import tuples of a raster data file
+    :param metadata_dict: dictionary containing relevant metadata for the import
+    :param modules_dict: Dictionary of pyGRASS modules to run for import
+    :return: Lines for registering the raster maps in an STRDS
+    :rtype: list
+    """
+    register_lines = []
+    file_maps = {}
+    for import_tuple in import_tuples:
+        output_name, time_stamp = get_map_name_and_time(import_tuple, metadata_dict)
+        time_stamp_iso = time_stamp.strftime("%Y-%m-%d")
+        register_lines.append(
+            f"{output_name},{time_stamp_iso},{time_stamp_iso},{import_tuple[2]}"
+        )
+        # Subdatasets are linked through one VRT each
+        file_maps.setdefault(str(import_tuple[0]), []).append(
+            (import_tuple, output_name)
+        )
+
+    for file_path, maps in file_maps.items():
+        mods = deepcopy(modules_dict)
+        mods["import"].inputs.input = file_path
+        if len(maps) == 1:
+            mods["import"].inputs.band = maps[0][0][1]
+            mods["import"].outputs.output = maps[0][1]
+            mods["import"].run()
+        else:
+            # Without band, r.external links all bands as <output>.<band>
+            link_name = (
+                f"tmp_{os.getpid()}_{hashlib.md5(file_path.encode()).hexdigest()}"
+            )
+            mods["import"].outputs.output = link_name
+            mods["import"].run()
+            mods["rename"].inputs.raster = [
+                name
+                for import_tuple, output_name in maps
+                for name in (f"{link_name}.{import_tuple[1]}", output_name)
+            ]
+            mods["rename"].run()
+        for import_tuple, output_name in maps:
+            support = deepcopy(mods["metadata"])
+            support.inputs.map = output_name
+            support.inputs.units = metadata_dict["units"]
+            support.inputs.title = metadata_dict["long_name"]
+            support.inputs.semantic_label = import_tuple[2]
+            support.run()
+
+    return register_lines
+
+
+def match_and_link(file_tuple, match_function=None, link_function=None, nodata=None):
+    """
+    Match semantic labels (creating VRTs if needed) and link the maps of a
+    raster data file in one go, so files stream through a single pool
+    :param file_tuple: tuple containing Path to the raster data file and its
+                       entry of the metadata cache (or None)
+    :param match_function: Function returning the import tuples of a file
+                           (map_semantic_labels with pre-defined kwargs)
+    :param link_function: Function linking a list of import tuples
+                          (link_maps with pre-defined kwargs)
+    :param nodata: NoData value for VRTs
+    :return: Path to the raster data file, its (updated) entry of the metadata
+             cache and lines for registering its maps
+    :rtype: tuple
+    """
+    raster_file, cache_entry = file_tuple
+    cache_entry = scan_dataset(raster_file, cache_entry=cache_entry, nodata=nodata)
+    if not cache_entry:
+        gscript.warning(_("Cannot open dataset <{}>".format(raster_file)))
+        return raster_file, None, []
+    import_tuples = match_function(raster_file, cache_entry=cache_entry)
+    return raster_file, cache_entry, link_function(import_tuples)
+
+
+def file_digest(file_path, block_size=2**20):
+    """
+    Compute the SHA-256 hash of the content of a file
+    :param file_path: Path to the file
+    :param block_size: Number of bytes to read at once
+    :return: Hexadecimal digest of the file content
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_path):
+    """
+    Read the manifest of registered files
+    :param manifest_path: Path to the manifest file
+    :return: Dictionary with file path as key and dictionary with size, mtime,
+             hash and names of the produced maps as value
+    :rtype: dict
+    """
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(manifest_path, manifest):
+    """
+    Write the manifest of registered files (replacing the previous one at once)
+    :param manifest_path: Path to the manifest file
+    :param manifest: Dictionary with registered files (see read_manifest)
+    """
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def compare_with_manifest(raster_files, manifest, nprocs=1):
+    """
+    Compare files to register with the manifest of registered files
+    Files with the same size and modification time as in the manifest are
+    unchanged. For other files, the content hash is compared, so files that
+    are only touched are not registered again. Entries of changed files and
+    of files that do not exist anymore are removed from the manifest.
+    :param raster_files: List of paths to files to register
+    :param manifest: Dictionary with registered files (see read_manifest)
+    :param nprocs: Number of processes to use for hashing
+    :return: Dictionary with manifest entries (without maps) of new or changed
+             files and list of maps produced from changed or removed files
+    :rtype: tuple
+    """
+    candidates = {}
+    for raster_file in raster_files:
+        file_stat = raster_file.stat()
+        entry = manifest.get(str(raster_file))
+        if (
+            entry
+            and entry["size"] == file_stat.st_size
+            and entry["mtime"] == file_stat.st_mtime
+        ):
+            continue
+        candidates[str(raster_file)] = {
+            "size": file_stat.st_size,
+            "mtime": file_stat.st_mtime,
+        }
+
+    with Pool(processes=nprocs) as pool:
+        digests = pool.map(file_digest, candidates)
+
+    new_entries = {}
+    stale_maps = []
+    for (file_path, entry), digest in zip(candidates.items(), digests):
+        entry["hash"] = digest
+        if file_path in manifest and manifest[file_path]["hash"] == digest:
+            manifest[file_path].update(entry)
+            continue
+        if file_path in manifest:
+            stale_maps.extend(manifest.pop(file_path)["maps"])
+        new_entries[file_path] = entry
+
+    # Drop maps of files that have been removed from the file system
+    current_files = {str(raster_file) for raster_file in raster_files}
+    for file_path in list(manifest):
+        if file_path not in current_files and not Path(file_path).exists():
+            stale_maps.extend(manifest.pop(file_path)["maps"])
+
+    return new_entries, stale_maps
+
+
+def remove_maps(map_names, chunk_size=500):
+    """
+    Remove maps from the temporal database and the mapset
+    Maps are unregistered from the temporal database (not only from the
+    STRDS), which also updates every STRDS they were registered in, so no
+    orphaned records with stale extent and time remain when maps of changed
+    files are registered again
+    :param map_names: List of names of the maps to remove
+    :param chunk_size: Number of maps to remove per g.remove call
+    """
+    map_file = gscript.tempfile()
+    with open(map_file, "w") as m_f:
+        m_f.write("\n".join(map_names))
+    Module(
+        "t.unregister",
+        type="raster",
+        file=map_file,
+        quiet=True,
+    )
+    for idx in range(0, len(map_names), chunk_size):
+        Module(
+            "g.remove",
+            type="raster",
+            name=map_names[idx : idx + chunk_size],
+            flags="f",
+            quiet=True,
+        )
+
+
+def register_in_chunks(checkpoint_path, checkpoint, strds_long_name, resume=False):
+    """
+    Register linked maps in an STRDS in chunks
+    The maps of a chunk are inserted into the temporal database in one
+    transaction (register_maps_in_space_time_dataset) and then registered in
+    the STRDS (register_map, which commits its own statements), so a chunk is
+    not atomic. register_map is not batched into the transaction on purpose:
+    it creates the register table of the STRDS on first use and its SQL is
+    internal to the temporal framework. The checkpoint is only advanced when a chunk is done, so a
+    chunk interrupted by a crash is repeated when resuming. Maps of that chunk
+    that are already in the temporal database or the STRDS are skipped then.
+    The checkpoint is removed when all chunks are done.
+    Metadata of the STRDS has to be updated from the registered maps afterwards.
+    :param checkpoint_path: Path to the checkpoint file
+    :param checkpoint: Dictionary with the register file (lines for registering
+                       the maps), the chunk size, the number of registered chunks
+                       and the options of the run that linked the maps
+    :param strds_long_name: Name of the STRDS (with mapset)
+    :param resume: Whether registration is resumed from the checkpoint
+    """
+    with open(checkpoint["register_file"], "r") as register_file:
+        register_lines = register_file.read().splitlines()
+    chunk_size = checkpoint["chunk_size"]
+    chunk_count = -(-len(register_lines) // chunk_size)
+    for chunk_number in range(checkpoint["registered_chunks"], chunk_count):
+        chunk_lines = register_lines[
+            chunk_number * chunk_size : (chunk_number + 1) * chunk_size
+        ]
+        dbif = tgis.SQLDatabaseInterfaceConnection()
+        dbif.connect()
+        tgis_strds = tgis.open_old_stds(strds_long_name, "strds", dbif)
+        map_ids = [
+            f"{line.split(',')[0]}@{tgis_strds.get_mapset()}" for line in chunk_lines
+        ]
+        insert_lines, register_ids = chunk_lines, map_ids
+        if resume and chunk_number == checkpoint["registered_chunks"]:
+            # The chunk may have been registered partly before the crash
+            registered_ids = {
+                row["id"]
+                for row in tgis_strds.get_registered_maps("id", None, None, dbif) or []
+            }
+            register_ids = [
+                map_id for map_id in map_ids if map_id not in registered_ids
+            ]
+            insert_lines = [
+                line
+                for line, map_id in zip(chunk_lines, map_ids)
+                if map_id in register_ids
+                and not tgis.RasterDataset(map_id).is_in_db(dbif)
+            ]
+
+        # Register maps in the temporal database
+        if insert_lines:
+            chunk_file = gscript.tempfile()
+            with open(chunk_file, "w") as c_f:
+                c_f.write("\n".join(insert_lines))
+            register_maps_in_space_time_dataset(
+                "raster",
+                None,
+                file=chunk_file,
+                update_cmd_list=False,
+                fs=",",
+                dbif=dbif,
+            )
+            os.remove(chunk_file)
+        # Register maps in the STRDS without updating its metadata
+        for map_id in register_ids:
+            raster_map = tgis.RasterDataset(map_id)
+            raster_map.select(dbif)
+            tgis_strds.register_map(raster_map, dbif=dbif)
+        dbif.close()
+
+        checkpoint["registered_chunks"] = chunk_number + 1
+        write_manifest(checkpoint_path, checkpoint)
+        gscript.percent(chunk_number + 1, chunk_count, 1)
+        gscript.verbose(
+            _("Registered chunk {number}/{total} ({maps} maps)").format(
+                number=chunk_number + 1, total=chunk_count, maps=len(chunk_lines)
+            )
+        )
+    os.remove(checkpoint["register_file"])
+    checkpoint_path.unlink()
 
 
 def main():
@@ -481,7 +828,8 @@ def main():
             raster_files = list(raster_files)
 
     # Abort if no files to import are found
-    if not raster_files:
+    # (in incremental mode maps of removed files may still have to be unregistered)
+    if not raster_files and not flags["i"]:
         gscript.fatal(_("No files found to import."))
 
     # Initialize TGIS
@@ -491,15 +839,59 @@ def main():
     strds_long_name = f"{options['output']}@{mapset.name}"
     tgis_strds = tgis.SpaceTimeRasterDataset(strds_long_name)
 
+    # Resume registration of maps linked in a previous run that did not finish
+    # The run is complete then, if it had the same input (in incremental mode
+    # or with other input the run continues with the current input)
+    state_dir = Path(options["GISDBASE"]).joinpath(
+        options["LOCATION_NAME"], options["MAPSET"], "t.register.local"
+    )
+    checkpoint_path = state_dir.joinpath(f"{options['output']}.checkpoint.json")
+    run_options = {
+        key: options[key]
+        for key in (
+            "input",
+            "files",
+            "file_pattern",
+            "suffix",
+            "start_time",
+            "time_format",
+            "semantic_labels",
+        )
+    }
+    if checkpoint_path.exists():
+        checkpoint = read_manifest(checkpoint_path)
+        same_input = checkpoint.get("options") == run_options
+        gscript.info(
+            _("Resuming registration in <{strds}> after chunk {number}").format(
+                strds=options["output"], number=checkpoint["registered_chunks"]
+            )
+        )
+        if not same_input:
+            gscript.warning(
+                _(
+                    "Registration in <{strds}> of an interrupted run with other input "
+                    "is completed before the current input is processed"
+                ).format(strds=options["output"])
+            )
+        register_in_chunks(checkpoint_path, checkpoint, strds_long_name, resume=True)
+        tgis_strds.update_from_registered_maps(dbif=None)
+        if same_input and not flags["i"]:
+            gscript.info(_("Registration of the interrupted run is completed."))
+            return 0
+
     # Check if target STRDS exists and create it if not or abort if overwriting is not allowed
-    if tgis_strds.is_in_db() and not gscript.overwrite():
+    # (incremental registration extends an existing STRDS)
+    if tgis_strds.is_in_db() and not gscript.overwrite() and not flags["i"]:
         gscript.fatal(
             _(
                 "Output STRDS <{}> exists."
                 "Use --overwrite with or without -e to modify the existing STRDS."
             ).format(options["output"])
         )
-    if not tgis_strds.is_in_db() or (gscript.overwrite() and not flags["e"]):
+    strds_created = not tgis_strds.is_in_db() or (
+        gscript.overwrite() and not flags["e"] and not flags["i"]
+    )
+    if strds_created:
         Module(
             "t.create",
             output=options["output"],
@@ -510,6 +902,31 @@ def main():
             verbose=True,
         )
 
+    # Link and register only new or changed files if requested, using the
+    # manifest of registered files stored in the mapset
+    manifest_path = state_dir.joinpath(f"{options['output']}.json")
+    if flags["i"]:
+        manifest = {} if strds_created else read_manifest(manifest_path)
+        new_entries, stale_maps = compare_with_manifest(
+            raster_files, manifest, nprocs=nprocs
+        )
+        gscript.verbose(
+            _(
+                "{new} new or changed files, {stale} maps of changed or removed files".format(
+                    new=len(new_entries), stale=len(stale_maps)
+                )
+            )
+        )
+        if stale_maps:
+            remove_maps(stale_maps)
+        write_manifest(manifest_path, manifest)
+        raster_files = [Path(file_path) for file_path in new_entries]
+        if not raster_files:
+            gscript.info(_("No new or changed files to register."))
+            if stale_maps:
+                tgis_strds.update_from_registered_maps(dbif=None)
+            return 0
+
     # Create initial module objects for import of raster data
     modules = {
         "import": Module(
@@ -524,19 +941,22 @@ def main():
             title=options["long_name"],
             units=options["units"],
         ),
-        "timestamp": Module(
-            "r.timestamp",
+        "rename": Module(
+            "g.rename",
             run_=False,
+            quiet=True,
         ),
     }
 
     # Pre-define kwargs for import-function
     match_semantic_labels = partial(
-        map_semantic_labels, semantic_label_dict=semantic_labels, input_option_dict=options
+        map_semantic_labels,
+        semantic_label_dict=semantic_labels,
+        input_option_dict=options,
     )
 
     # Pre-define kwargs for import-function
-    run_import = partial(import_data, metadata_dict=options, modules_dict=modules)
+    run_import = partial(link_maps, metadata_dict=options, modules_dict=modules)
 
     # Get GRASS GIS environment info
     options.update(dict(gscript.gisenv()))
@@ -549,30 +969,73 @@ def main():
         vrt_dir.mkdir()
 
     print("Files filtered")
-    # Match semantic labels and create VRTs if needed
-    with Pool(processes=nprocs) as pool:
-        import_tuples = pool.map(match_semantic_labels, raster_files)
+    # Match semantic labels, create VRTs if needed and link raster maps into
+    # mapset in one pool, writing register lines as files are done
+    # (the register file is kept with the checkpoint until all maps are registered)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    map_file = state_dir.joinpath(f"{options['output']}.register")
+    register_lines = set()
+    run_match_and_link = partial(
+        match_and_link,
+        match_function=match_semantic_labels,
+        link_function=run_import,
+        nodata=options["nodata"],
+    )
+    # Subdatasets, band counts and VRTs of unchanged files are taken from the
+    # metadata cache shared by all runs in the mapset
+    metadata_cache_path = state_dir.joinpath("metadata_cache.json")
+    metadata_cache = {
+        file_path: cache_entry
+        for file_path, cache_entry in read_manifest(metadata_cache_path).items()
+        if Path(file_path).exists()
+    }
+    file_tuples = [
+        (raster_file, metadata_cache.get(str(raster_file)))
+        for raster_file in raster_files
+    ]
+    with Pool(processes=nprocs) as pool, open(map_file, "w") as m_f:
+        for file_number, (raster_file, cache_entry, file_lines) in enumerate(
+            pool.imap_unordered(run_match_and_link, file_tuples), start=1
+        ):
+            if cache_entry:
+                metadata_cache[str(raster_file)] = cache_entry
+            for line in file_lines:
+                if line not in register_lines:
+                    register_lines.add(line)
+                    m_f.write(f"{line}\n")
+            if flags["i"]:
+                # Record the maps produced from each file
+                manifest[str(raster_file)] = {
+                    **new_entries[str(raster_file)],
+                    "maps": [line.split(",")[0] for line in file_lines],
+                }
+            gscript.percent(file_number, len(raster_files), 1)
+            gscript.verbose(
+                _("Linked {maps} maps from <{file}> ({number}/{total})").format(
+                    maps=len(file_lines),
+                    file=raster_file,
+                    number=file_number,
+                    total=len(raster_files),
+                )
+            )
 
-    print("Semantic labels matched")
-    # Import / Link raster maps into mapset
-    with Pool(processes=nprocs) as pool:
-        register_string = pool.map(run_import, chain(*import_tuples))
+    write_manifest(metadata_cache_path, metadata_cache)
 
     print("Maps imported")
-    # Register imported maps in STRDS using register file
-    map_file = gscript.tempfile()
-    with open(map_file, "w") as m_f:
-        m_f.write("\n".join(set(register_string)))
-    print("\n".join(register_string))
-    print(len(register_string))
-    print(len(set(register_string)))
-    register_maps_in_space_time_dataset(
-        "raster",
-        strds_long_name,
-        file=map_file,
-        update_cmd_list=False,
-        fs=",",
-    )
+    print(len(register_lines))
+    # The maps of the new files are registered by this or a resumed run
+    if flags["i"]:
+        write_manifest(manifest_path, manifest)
+
+    # Register imported maps in STRDS in chunks using register file
+    checkpoint = {
+        "register_file": str(map_file),
+        "chunk_size": max(int(options["chunk_size"]), 1),
+        "registered_chunks": 0,
+        "options": run_options,
+    }
+    write_manifest(checkpoint_path, checkpoint)
+    register_in_chunks(checkpoint_path, checkpoint, strds_long_name)
 
     print("Maps registered")
 